@@ -15,3 +15,9 @@ class Config(object):
 
     # the log verbosity level
     LOG_LEVEL = "info"
+
+    # the directory where parsed stage steps are cached
+    STAGE_CACHE_DIR = "/var/cache/deepsea/stages"
+
+    # the maximum number of terminal repaints per second of the step list output
+    MAX_FPS = 10
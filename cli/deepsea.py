@@ -20,7 +20,8 @@ from .config import Config
 from .common import PrettyPrinter as PP, PrettyFormat as PF
 from .common import requires_root_privileges, clean_pyc_files
 from .monitor import Monitor
-from .monitors.terminal_outputter import StepListPrinter, SimplePrinter
+from .monitors.terminal_outputter import get_printer
+from .salt_event import SaltEventProcessor, StageJidFilter, EventRecorder, EventReplayer
 from .stage_executor import run_stage
 from .stage_parser import SLSParser, SaltRunner, SaltState, SaltStateFunction, \
                           SaltExecutionFunction, StageRenderingException, \
@@ -60,12 +61,18 @@ def _setup_logging():
     })
 
 
-def _run_monitor(show_state_steps, show_dynamic_steps, simple_output):
+def _run_monitor(show_state_steps, show_dynamic_steps, simple_output, record=None,
+                 replay=None, max_speed=False):
     """
     Run the DeepSea stage monitor and progress visualizer
     """
-    mon = Monitor(show_state_steps, show_dynamic_steps)
-    listener = SimplePrinter() if simple_output else StepListPrinter()
+    if replay:
+        processor = EventReplayer(replay, not max_speed, StageJidFilter())
+    else:
+        processor = SaltEventProcessor(StageJidFilter(),
+                                       EventRecorder(record) if record else None)
+    mon = Monitor(show_state_steps, show_dynamic_steps, processor)
+    listener = get_printer(simple_output, max_fps=Config.MAX_FPS)
     mon.add_listener(listener)
 
     logger = logging.getLogger(__name__)
@@ -109,6 +116,11 @@ def _run_monitor(show_state_steps, show_dynamic_steps, simple_output):
             time.sleep(2)
         mon.wait_to_finish()
 
+    if replay:
+        PP.println("Replayed {} events in {}s".format(processor.count,
+                                                     round(processor.duration, 3)))
+        PP.println("Event queue stats: {}".format(mon.stats()))
+
 
 def _validate_stage_file_exists(stage_name):
     """
@@ -252,8 +264,10 @@ def _run_show_stage_steps(stage_name, hide_state_steps, only_visible_steps):
 @click.option('--log-file', default='/var/log/deepsea.log',
               type=click.Path(dir_okay=False),
               help="the file path for the log to be stored (default: /var/log/deepsea.log)")
+@click.option('--max-fps', default=10, type=click.IntRange(1, 60),
+              help="maximum terminal repaints per second of the progress output (default: 10)")
 @click.version_option(pkg_resources.get_distribution('deepsea'), message="%(version)s")
-def cli(log_level, log_file):
+def cli(log_level, log_file, max_fps):
     """
     DeepSea CLI tool.
 
@@ -263,14 +277,22 @@ def cli(log_level, log_file):
     """
     Config.LOG_LEVEL = log_level
     Config.LOG_FILE_PATH = log_file
+    Config.MAX_FPS = max_fps
 
 
 @click.command(name='monitor')
 @click.option('--show-state-steps', is_flag=True, help="shows state visible steps progress")
 @click.option('--show-dynamic-steps', is_flag=True, help="shows runtime generated steps")
 @click.option('--simple-output', is_flag=True, help="minimalistic b&w output")
+@click.option('--record', type=click.Path(dir_okay=False),
+              help="record the Salt events into this file")
+@click.option('--replay', type=click.Path(dir_okay=False, exists=True),
+              help="replay the Salt events recorded with --record instead of "
+                   "listening to the Salt event bus")
+@click.option('--max-speed', is_flag=True,
+              help="replay the events as fast as possible instead of in real time")
 @requires_root_privileges
-def monitor(show_state_steps, show_dynamic_steps, simple_output):
+def monitor(show_state_steps, show_dynamic_steps, simple_output, record, replay, max_speed):
     """
     Starts DeepSea progress monitor.
 
@@ -278,7 +300,8 @@ def monitor(show_state_steps, show_dynamic_steps, simple_output):
     using salt-run commands in other terminal sessions.
     """
     _setup_logging()
-    _run_monitor(show_state_steps, show_dynamic_steps, simple_output)
+    _run_monitor(show_state_steps, show_dynamic_steps, simple_output, record, replay,
+                 max_speed)
 
 
 @click.group(short_help='stage related commands')
@@ -295,7 +318,9 @@ def stage():
               help="this will disable state files steps from being parsed")
 @click.option('--only-visible-steps', is_flag=True,
               help="only show the steps that will generate events in the Salt Event Bus")
-@click.option('--clear-cache', is_flag=True, help="clear steps cache")
+@click.option('--clear-cache', is_flag=True,
+              help="clear steps cache, needed after changes of grains or minion roles "
+                   "that the cache does not detect")
 @requires_root_privileges
 def stage_dryrun(stage_name, hide_state_steps, only_visible_steps, clear_cache):
     """
@@ -313,8 +338,17 @@ def stage_dryrun(stage_name, hide_state_steps, only_visible_steps, clear_cache):
 @click.option('--hide-state-steps', is_flag=True, help="shows state visible steps progress")
 @click.option('--hide-dynamic-steps', is_flag=True, help="shows runtime generated steps")
 @click.option('--simple-output', is_flag=True, help="minimalistic b&w output")
+@click.option('--clear-cache', is_flag=True,
+              help="clear steps cache of this stage, needed after changes of grains or "
+                   "minion roles that the cache does not detect")
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help="write the steps timing profile and critical path to this JSON file")
+@click.option('--json-lines', metavar='DEST',
+              help="stream the progress events as JSON lines to DEST: '-' for stdout "
+                   "(replaces the terminal output), a unix socket path, or host:port")
 @requires_root_privileges
-def stage_run(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
+def stage_run(stage_name, hide_state_steps, hide_dynamic_steps, simple_output, clear_cache,
+              profile, json_lines):
     """
     Runs a DeepSea stage
 
@@ -325,8 +359,11 @@ def stage_run(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
     clean_pyc_files()
     _setup_logging()
     _validate_stage_file_exists(stage_name)
+    if clear_cache:
+        SLSParser.clean_cache(stage_name)
 
-    ret = run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output)
+    ret = run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output, profile,
+                    json_lines)
     PP.flush()
     sys.exit(ret)
 
@@ -344,8 +381,14 @@ def salt_run():
 @click.option('--hide-state-steps', is_flag=True, help="shows state visible steps progress")
 @click.option('--hide-dynamic-steps', is_flag=True, help="shows runtime generated steps")
 @click.option('--simple-output', is_flag=True, help="minimalistic b&w output")
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help="write the steps timing profile and critical path to this JSON file")
+@click.option('--json-lines', metavar='DEST',
+              help="stream the progress events as JSON lines to DEST: '-' for stdout "
+                   "(replaces the terminal output), a unix socket path, or host:port")
 @requires_root_privileges
-def state_orch(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
+def state_orch(stage_name, hide_state_steps, hide_dynamic_steps, simple_output, profile,
+               json_lines):
     """
     Runs a DeepSea stage
 
@@ -356,7 +399,8 @@ def state_orch(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
     _setup_logging()
     _validate_stage_file_exists(stage_name)
 
-    ret = run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output)
+    ret = run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output, profile,
+                    json_lines)
     sys.exit(ret)
 
 
@@ -6,15 +6,18 @@ DeepSea stage's progress monitor
 from __future__ import absolute_import
 from __future__ import print_function
 
+import datetime
 import logging
 import operator
 import threading
+import time
+from collections import deque
 from functools import reduce
 
 from six.moves import range
 
 from .common import PrettyPrinter as PP
-from .salt_event import SaltEventProcessor
+from .salt_event import SaltEventProcessor, StageJidFilter
 from .salt_event import EventListener
 from .salt_event import NewJobEvent, NewRunnerEvent, RetJobEvent, RetRunnerEvent
 from .stage_parser import SLSParser, SaltRunner, SaltState, SaltStateFunction, \
@@ -26,6 +29,25 @@ from .stage_parser import SLSParser, SaltRunner, SaltState, SaltStateFunction, \
 logger = logging.getLogger(__name__)
 
 
+def _parse_stamp(event):
+    """
+    Returns the datetime of a salt event, or None
+    """
+    if event is None:
+        return None
+    return datetime.datetime.strptime(event.stamp, "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _seconds(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds(), 3)
+
+
+def _isoformat(ts):
+    return ts.isoformat() if ts else None
+
+
 class Stage(object):
     """
     Class that models the execution of a DeepSea stage
@@ -314,6 +336,107 @@ class Stage(object):
 
         return None
 
+    @staticmethod
+    def _step_profile(step, prev_end):
+        """
+        Returns the timing profile of a single step and its end time
+        """
+        start = _parse_stamp(step.start_event)
+        end = _parse_stamp(step.end_event)
+        profile = {
+            'order': step.order,
+            'name': step.name,
+            'args': step.args_str,
+            'type': 'state' if isinstance(step, Stage.TargetedStep) else 'runner',
+            'jid': step.jid,
+            'skipped': step.skipped,
+            'success': step.success,
+        }
+        if isinstance(step, Stage.TargetedStep) and step.targets:
+            minions = {}
+            for minion, target in step.targets.items():
+                minion_end = _parse_stamp(target.get('event'))
+                if minion_end and (end is None or minion_end > end):
+                    end = minion_end
+                states = []
+                for sstep in target['states']:
+                    if sstep.end_event is None:
+                        continue
+                    ret = sstep.end_event.raw_event['data']['data']['ret']
+                    states.append({
+                        'name': sstep.name,
+                        'success': sstep.success,
+                        'duration': round(ret['duration'] / 1000.0, 3)
+                                    if 'duration' in ret else None,
+                    })
+                minions[minion] = {
+                    'success': target['success'],
+                    'end': _isoformat(minion_end),
+                    'wall_time': _seconds(start, minion_end),
+                    'states': states,
+                }
+            profile['minions'] = minions
+        profile['start'] = _isoformat(start)
+        profile['end'] = _isoformat(end)
+        profile['wall_time'] = _seconds(start, end)
+        profile['queue_time'] = _seconds(prev_end, start)
+        return profile, end
+
+    def profile(self):
+        """
+        Returns the timing profile of the stage execution: start, end, wall
+        time and queue time (time since the previous step ended) of each
+        step and minion, and the critical path through the requisite graph,
+        i.e., the chain of dependent steps with the longest total wall time.
+        """
+        stage_start = _parse_stamp(self.start_event)
+        stage_end = _parse_stamp(self.end_event)
+
+        steps = []
+        prev_end = stage_start
+        for step in self._steps:
+            step_profile, end = self._step_profile(step, prev_end)
+            steps.append(step_profile)
+            if end:
+                prev_end = end
+
+        # longest path over the requisite DAG, the steps are already sorted
+        # in topological order by the parser
+        index = dict((id(step.step), idx) for idx, step in enumerate(self._steps))
+        path_time = []
+        path_prev = []
+        for idx, step in enumerate(self._steps):
+            best_time = 0.0
+            best_prev = None
+            for dep in step.step.on_success_deps + step.step.on_fail_deps:
+                dep_idx = index.get(id(dep))
+                if dep_idx is not None and dep_idx < idx and path_time[dep_idx] > best_time:
+                    best_time = path_time[dep_idx]
+                    best_prev = dep_idx
+            path_time.append(best_time + (steps[idx]['wall_time'] or 0.0))
+            path_prev.append(best_prev)
+
+        critical_path = []
+        if path_time:
+            idx = path_time.index(max(path_time))
+            while idx is not None:
+                critical_path.insert(0, self._steps[idx].order)
+                idx = path_prev[idx]
+
+        return {
+            'stage': self.name,
+            'jid': self.jid,
+            'success': self.success,
+            'start': _isoformat(stage_start),
+            'end': _isoformat(stage_end),
+            'wall_time': _seconds(stage_start, stage_end),
+            'steps': steps,
+            'critical_path': {
+                'steps': critical_path,
+                'wall_time': round(max(path_time), 3) if path_time else 0.0,
+            },
+        }
+
     def check_if_current_step_will_run(self):
         assert self._executing
 
@@ -463,6 +586,7 @@ class Monitor(threading.Thread):
             self.monitor = monitor
             self.func = func
             self.event = event
+            self.stamp = time.time()
 
         def call(self):
             logger.debug("handle: %s", self.event)
@@ -513,9 +637,23 @@ class Monitor(threading.Thread):
             logger.debug("buffer: %s", event)
             self.monitor.append_event(Monitor.Event(self.monitor, 'state_result_step', event))
 
-    def __init__(self, show_state_steps, show_dynamic_steps):
+        def handle_stage_parsed(self, stage_name, steps, output):
+            # pylint: disable=W0212
+            self.monitor._stage_steps[stage_name] = (SLSParser.load_steps(stage_name, steps),
+                                                     output)
+
+    def __init__(self, show_state_steps, show_dynamic_steps, processor=None):
+        """
+        Args:
+            show_state_steps (bool): track the steps inside state files
+            show_dynamic_steps (bool): track runtime generated steps
+            processor (SaltEventProcessor): the source of events, defaults to
+                                            the Salt event bus
+        """
         super(Monitor, self).__init__()
-        self._processor = SaltEventProcessor()
+        if processor is None:
+            processor = SaltEventProcessor(StageJidFilter())
+        self._processor = processor
         self._processor.add_listener(Monitor.DeepSeaEventListener(self))
         self._show_state_steps = show_state_steps
         self._show_dynamic_steps = show_dynamic_steps
@@ -523,9 +661,18 @@ class Monitor(threading.Thread):
         self._monitor_listeners = []
         self._event_lock = threading.Lock()
         self._event_cond = threading.Condition(self._event_lock)
-        self._event_buffer = []
+        self._event_buffer = deque()
         self._running = False
         self._stage_steps = {}
+        self._announced_stages = set()
+        self._stats = {
+            'handled': 0,
+            'max_queue_depth': 0,
+            'queue_latency_total': 0.0,
+            'queue_latency_max': 0.0,
+            'handling_time_total': 0.0,
+            'handling_time_max': 0.0,
+        }
 
     def parse_stage(self, stage_name):
         self._fire_event('stage_started', stage_name)
@@ -538,12 +685,39 @@ class Monitor(threading.Thread):
             self._fire_event('stage_parsing_finished', None, None, ex)
             raise ex
         self._stage_steps[stage_name] = (parsed_steps, out)
+        self._announced_stages.add(stage_name)
+        self._record_stage(stage_name, parsed_steps, out)
+
+    def _record_stage(self, stage_name, parsed_steps, out):
+        if self._processor.recorder:
+            self._processor.recorder.record_stage(stage_name,
+                                                  SLSParser.dump_steps(parsed_steps), out)
 
     def append_event(self, event):
         with self._event_cond:
             self._event_buffer.append(event)
+            if len(self._event_buffer) > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = len(self._event_buffer)
             self._event_cond.notify()
 
+    def stats(self):
+        """
+        Returns the event queue counters, to check if the monitor is lagging
+        behind the Salt event bus.
+
+        Returns:
+            dict: current and max queue depth, number of handled events, and
+                  the average and max time (in seconds) that events waited in
+                  the queue and took to be handled
+        """
+        with self._event_cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._event_buffer)
+        handled = stats['handled']
+        stats['queue_latency_avg'] = stats['queue_latency_total'] / handled if handled else 0.0
+        stats['handling_time_avg'] = stats['handling_time_total'] / handled if handled else 0.0
+        return stats
+
     def start(self):
         """
         Start the monitoring thread
@@ -557,6 +731,7 @@ class Monitor(threading.Thread):
         Stop the monitoring thread
         """
         logger.info("Stopping the DeepSea event monitoring")
+        logger.info("Event queue stats: %s", self.stats())
         self._running = False
         self._processor.stop()
 
@@ -580,11 +755,28 @@ class Monitor(threading.Thread):
         self._running = True
         while self._running:
             with self._event_cond:
-                if self._event_buffer:
-                    event = self._event_buffer.pop(0)
-                    event.call()
-                else:
+                if not self._event_buffer:
+                    if not self._processor.is_running():
+                        # no more events will arrive, e.g. end of a replay
+                        break
                     self._event_cond.wait(0.2)
+                    continue
+                event = self._event_buffer.popleft()
+
+            # listeners run outside of the lock so that the event processor
+            # thread is not blocked while the output is rendered
+            t0 = time.time()
+            event.call()
+            self._account(event.stamp, t0, time.time())
+
+    def _account(self, stamp, t0, t1):
+        stats = self._stats
+        with self._event_cond:
+            stats['handled'] += 1
+            stats['queue_latency_total'] += t0 - stamp
+            stats['queue_latency_max'] = max(stats['queue_latency_max'], t0 - stamp)
+            stats['handling_time_total'] += t1 - t0
+            stats['handling_time_max'] = max(stats['handling_time_max'], t1 - t0)
 
     def add_listener(self, listener):
         """
@@ -609,6 +801,11 @@ class Monitor(threading.Thread):
         stage_name = event.args[0]
         if stage_name in self._stage_steps:
             parsed_steps, out = self._stage_steps[stage_name]
+            if stage_name in self._announced_stages:
+                # already announced by parse_stage
+                self._announced_stages.remove(stage_name)
+            else:
+                self._fire_event('stage_started', stage_name)
         else:
             self._fire_event('stage_started', stage_name)
             self._fire_event('stage_parsing_started', stage_name)
@@ -618,6 +815,7 @@ class Monitor(threading.Thread):
             except RenderingException as ex:
                 self._fire_event('stage_parsing_finished', None, None, ex)
                 return
+            self._record_stage(stage_name, parsed_steps, out)
         self._running_stage = Stage(stage_name, parsed_steps, self._show_dynamic_steps)
 
         self._fire_event('stage_parsing_finished', self._running_stage, out, None)
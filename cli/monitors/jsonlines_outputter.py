@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+This module is responsible for streaming the DeepSea stage execution progress
+as JSON lines, one JSON object per monitor event, to be consumed by other
+programs instead of the terminal outputters
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+from ..monitor import MonitorListener
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def open_json_stream(dest):
+    """
+    Opens the stream where to write the JSON lines
+    Args:
+        dest (str): '-' for stdout, a unix socket path, or host:port of a TCP
+                    socket
+    Raises:
+        IOError, OSError: when the socket cannot be connected
+    """
+    if dest == '-':
+        return sys.stdout
+    if ':' in dest and not dest.startswith('/'):
+        host, port = dest.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(dest)
+        except (IOError, OSError):
+            sock.close()
+            raise
+    stream = sock.makefile('w')
+    # the socket is released once the stream is closed
+    sock.close()
+    return stream
+
+
+def _step_info(step):
+    info = {
+        'order': step.order,
+        'name': step.name,
+        'args': step.args_str,
+        'jid': step.jid,
+        'success': step.success,
+    }
+    if getattr(step, 'targets', None) is not None:
+        info['targets'] = sorted(step.targets)
+    return info
+
+
+class JsonLinesPrinter(MonitorListener):
+    """
+    Writes a JSON object for each monitor event. Each object has the 'event'
+    name, a sequence number 'seq', the wall clock 'time' and a 'monotonic'
+    timestamp, to order and measure events independently of clock changes.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def _emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        fields['monotonic'] = _monotonic()
+        with self._lock:
+            fields['seq'] = self.seq
+            self.seq += 1
+            line = json.dumps(fields, separators=(',', ':'), default=str)
+            try:
+                self.stream.write(line + "\n")
+                self.stream.flush()
+            except (IOError, OSError) as ex:
+                logger.error("failed to write JSON event: %s", ex)
+
+    def close(self):
+        """
+        Closes the stream, unless it is stdout
+        """
+        with self._lock:
+            if self.stream is sys.stdout:
+                return
+            try:
+                self.stream.close()
+            except (IOError, OSError) as ex:
+                logger.error("failed to close JSON stream: %s", ex)
+
+    def stage_started(self, stage_name):
+        self._emit('stage_started', stage=stage_name)
+
+    def stage_parsing_started(self, stage_name):
+        self._emit('stage_parsing_started', stage=stage_name)
+
+    def stage_parsing_state(self, states, minion=None):
+        self._emit('stage_parsing_state', states=states, minion=minion)
+
+    def stage_parsing_finished(self, stage, output, exception):
+        if exception:
+            self._emit('stage_parsing_finished', error=str(exception), output=output)
+            self.close()
+        else:
+            self._emit('stage_parsing_finished', stage=stage.name,
+                       total_steps=stage.total_steps())
+
+    def stage_finished(self, stage):
+        self._emit('stage_finished', stage=stage.name, jid=stage.jid, success=stage.success)
+        self.close()
+
+    def step_runner_started(self, step):
+        self._emit('step_runner_started', step=_step_info(step))
+
+    def step_runner_finished(self, step):
+        self._emit('step_runner_finished', step=_step_info(step))
+
+    def step_runner_skipped(self, step):
+        self._emit('step_runner_skipped', step=_step_info(step))
+
+    def step_state_started(self, step):
+        self._emit('step_state_started', step=_step_info(step))
+
+    def step_state_minion_finished(self, step, minion):
+        self._emit('step_state_minion_finished', step=_step_info(step), minion=minion,
+                   success=step.targets[minion]['success'])
+
+    def step_state_result(self, step, event):
+        self._emit('step_state_result', step=_step_info(step), minion=event.minion,
+                   state_id=event.state_id, name=event.name, result=event.result)
+
+    def step_state_finished(self, step):
+        self._emit('step_state_finished', step=_step_info(step))
+
+    def step_state_skipped(self, step):
+        self._emit('step_state_skipped', step=_step_info(step))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+This module is responsible for writing the timing profile of a DeepSea stage
+execution to a JSON file
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+
+from ..monitor import MonitorListener
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+
+
+class ProfileWriter(MonitorListener):
+    """
+    Writes the timing profile of the stage, as returned by Stage.profile(),
+    to a JSON file once the stage finishes
+    """
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+    def stage_finished(self, stage):
+        self.profile = stage.profile()
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            with open(tmp_path, "w") as fout:
+                json.dump(self.profile, fout, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            logger.error("failed to write stage profile to %s: %s", self.path, ex)
+            return
+        logger.info("stage %s profile written to %s", stage.name, self.path)
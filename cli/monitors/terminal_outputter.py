@@ -10,6 +10,7 @@ import datetime
 import logging
 import os
 import re
+import sys
 import threading
 import time
 
@@ -289,6 +290,65 @@ class SimplePrinter(MonitorListener):
         return "{}({})".format(fun_name, args)
 
 
+class Screen(object):
+    """
+    Virtual model of the terminal lines that are still being updated, i.e.,
+    the lines of the running step.
+
+    A frame is composed with print/println and then flushed. Only the lines
+    that differ from the previous frame are rewritten in the terminal.
+    """
+    def __init__(self):
+        self.lines = []
+        self._frame = []
+        self._current = []
+
+    def print(self, text):
+        self._current.append(text)
+
+    def println(self, text=None):
+        if text:
+            self._current.append(text)
+        self._frame.append(u"".join(self._current))
+        self._current = []
+
+    def flush(self):
+        """
+        Repaints the lines of the composed frame that changed since the
+        previous frame
+        """
+        if self._current:
+            self.println()
+        new, old = self._frame, self.lines
+        self._frame = []
+
+        first = 0
+        while first < len(new) and first < len(old) and new[first] == old[first]:
+            first += 1
+        if first == len(new) and first == len(old):
+            return
+
+        out = []
+        if len(old) > first:
+            out.append(u"\x1B[{}A".format(len(old) - first))
+        for idx in range(first, len(new)):
+            if idx < len(old) and new[idx] == old[idx]:
+                # skip unchanged line
+                out.append(u"\n")
+            else:
+                out.append(u"\r\x1B[K{}\n".format(new[idx]))
+        if len(old) > len(new):
+            out.append(u"\x1B[J")
+        PP.print(u"".join(out))
+        self.lines = new
+
+    def commit(self):
+        """
+        Leaves the current lines in the terminal and starts a new empty area
+        """
+        self.lines = []
+
+
 class StepListPrinter(MonitorListener):
     """
     This class takes care of printing DeepSea execution in the terminal as a list of steps, but
@@ -317,9 +377,7 @@ class StepListPrinter(MonitorListener):
             step (StepListPrinter.Step): the step object
             depth (int): the step depth, if depth > 0 it's a substep
         """
-        num_cols = get_terminal_size()[1]
-        if num_cols > 100:
-            num_cols = 100
+        num_cols = self.num_cols
 
         step_order_width = 9
         step_desc_width = num_cols - 20
@@ -344,15 +402,10 @@ class StepListPrinter(MonitorListener):
 
         desc_width = step_desc_width - (offset - step_order_width)
 
-        if not step.reprint:
-            step.reprint = True
-        elif depth == 0:
-            step.clean(desc_width)
-
         if depth == 0:
-            PP.print(PP.bold("{}{} ".format(step_order, " " * rest)))
+            self.screen.print(PP.bold("{}{} ".format(step_order, " " * rest)))
         else:
-            PP.print("{} |_ ".format(" " * prefix_indent))
+            self.screen.print("{} |_ ".format(" " * prefix_indent))
 
         step.print(offset, desc_width, depth)
 
@@ -399,7 +452,6 @@ class StepListPrinter(MonitorListener):
             self.printer = printer
             self.step = step
             self.finished = False
-            self.reprint = False
             self.substeps = OrderedDict()
             self.args = step.args_str
             if step.start_event:
@@ -434,20 +486,10 @@ class StepListPrinter(MonitorListener):
                     return True
             return False
 
-        # pylint: disable=W0613
         def print(self, offset, desc_width, depth):
             """
             Prints the status of a step
             """
-            # if not self.reprint:
-            #     self.reprint = True
-            # else:
-            #     self.clean(desc_width)
-
-        def clean(self, desc_width):
-            """
-            Prepare for re-print of step
-            """
             raise NotImplementedError()
 
         @staticmethod
@@ -457,108 +499,77 @@ class StepListPrinter(MonitorListener):
             return "{}s".format(round(tr.seconds+tr.microseconds/1000000.0, 1))
 
     class Runner(Step):
-        def clean(self, desc_width):
-            for substep in self.substeps.values():
-                if substep.reprint:
-                    substep.clean(desc_width-5)
-            PP.print("\x1B[A\x1B[K")
-            if self.args and len(self.step.name) + len(self.args)+2 >= desc_width:
-                PP.print("\x1B[A\x1B[K" * len(SP.format_desc(self.args,
-                                                             desc_width-2)))
-
         def print(self, offset, desc_width, depth):
-            super(SP.Runner, self).print(offset, desc_width, depth)
-
+            out = self.printer.screen
             if len(self.step.name) + len(self.args)+2 < desc_width:
                 if self.args:
                     desc_length = len(self.step.name) + len(self.args) + 2
-                    PP.print(SP.RUNNER("{}({})".format(self.step.name, self.args)))
+                    out.print(SP.RUNNER("{}({})".format(self.step.name, self.args)))
                 else:
                     desc_length = len(self.step.name)
-                    PP.print(SP.RUNNER("{}".format(self.step.name)))
-                PP.print(SP.RUNNER("{} ".format("." * (desc_width - desc_length))))
+                    out.print(SP.RUNNER("{}".format(self.step.name)))
+                out.print(SP.RUNNER("{} ".format("." * (desc_width - desc_length))))
                 print_args = False
             else:
                 desc_length = len(self.step.name)
-                PP.print(SP.RUNNER("{}".format(self.step.name)))
-                PP.print(SP.RUNNER("{} ".format("." * (desc_width - desc_length))))
+                out.print(SP.RUNNER("{}".format(self.step.name)))
+                out.print(SP.RUNNER("{} ".format("." * (desc_width - desc_length))))
                 print_args = True
 
             if self.finished:
                 if self.step.skipped:
-                    PP.println(PP.grey("skipped"))
+                    out.println(PP.grey("skipped"))
                 else:
-                    PP.print(SP.OK if self.step.success else SP.FAIL)
+                    out.print(SP.OK if self.step.success else SP.FAIL)
                     if self.step.end_event:
                         ts = datetime.datetime.strptime(
                             self.step.end_event.stamp, "%Y-%m-%dT%H:%M:%S.%f")
                     else:
                         ts = datetime.datetime.now()
-                    PP.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
+                    out.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
             else:
                 ts = datetime.datetime.utcnow()
-                PP.print(SP.WAITING)
-                PP.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
+                out.print(SP.WAITING)
+                out.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
 
             if self.args and print_args:
                 lines = StepListPrinter.format_desc(self.args, desc_width-2)
                 lines[-1] += ")"
                 first = True
                 for line in lines:
-                    PP.print(" " * offset)
+                    out.print(" " * offset)
                     if first:
-                        PP.println(SP.RUNNER("({}".format(line)))
+                        out.println(SP.RUNNER("({}".format(line)))
                         first = False
                     else:
-                        PP.println(SP.RUNNER(" {}".format(line)))
+                        out.println(SP.RUNNER(" {}".format(line)))
 
             for substep in self.substeps.values():
                 self.printer.print_step(substep, depth+1)
 
     class State(Step):
-        def clean(self, desc_width):
-            if self.args and len(self.step.name) + len(self.args) + 5 >= desc_width:
-                PP.print("\x1B[A\x1B[K" * len(SP.format_desc(self.args,
-                                                             desc_width-2)))
-
-            if self.step.skipped:
-                PP.print("\x1B[A\x1B[K")
-            else:
-                for substep in self.substeps.values():
-                    if substep.reprint:
-                        substep.clean(desc_width-5)
-
-                for target in self.step.targets.values():
-                    for state_res in target['states']:
-                        lines = SP.format_desc(state_res.step.pretty_string(),
-                                               desc_width - 7)
-                        PP.print("\x1B[A\x1B[K" * len(lines))
-                    PP.print("\x1B[A\x1B[K")
-                PP.print("\x1B[A\x1B[K")
-
         def print(self, offset, desc_width, depth):
-            super(SP.State, self).print(offset, desc_width, depth)
-
+            out = self.printer.screen
             if len(self.step.name) + len(self.args)+2 < desc_width:
                 if self.args:
                     desc_length = len(self.step.name) + len(self.args) + 2
-                    PP.print(SP.STATE("{}({})".format(self.step.name, self.args)))
+                    out.print(SP.STATE("{}({})".format(self.step.name, self.args)))
                 else:
                     desc_length = len(self.step.name)
-                    PP.print(SP.STATE("{}".format(self.step.name)))
+                    out.print(SP.STATE("{}".format(self.step.name)))
                 if not self.step.skipped:
-                    PP.print(SP.STATE(" on"))
+                    out.print(SP.STATE(" on"))
                 print_args = False
             else:
                 desc_length = len(self.step.name)
-                PP.print(SP.STATE("{}".format(self.step.name)))
+                out.print(SP.STATE("{}".format(self.step.name)))
                 print_args = True
 
             if self.step.skipped:
-                PP.print(SP.STATE("{} ".format("." * (desc_width - desc_length))))
-                PP.println(PP.grey('skipped'))
+                out.print(SP.STATE("{} ".format("." * (desc_width - desc_length))))
+                out.println(PP.grey('skipped'))
             else:
-                PP.println()
+                out.println()
 
             if self.args and print_args:
                 lines = SP.format_desc(self.args, desc_width-2)
@@ -567,12 +578,12 @@ class StepListPrinter(MonitorListener):
                     lines[-1] += " on"
                 first = True
                 for line in lines:
-                    PP.print(" " * offset)
+                    out.print(" " * offset)
                     if first:
-                        PP.println(SP.STATE("({}".format(line)))
+                        out.println(SP.STATE("({}".format(line)))
                         first = False
                     else:
-                        PP.println(SP.STATE(" {}".format(line)))
+                        out.println(SP.STATE(" {}".format(line)))
 
             if self.step.skipped:
                 return
@@ -581,41 +592,41 @@ class StepListPrinter(MonitorListener):
                 self.printer.print_step(substep, depth+1)
 
             for target, data in self.step.targets.items():
-                PP.print(" " * offset)
-                PP.print(SP.MINION(target))
-                PP.print(SP.MINION("{} ".format("." * (desc_width - len(target)))))
+                out.print(" " * offset)
+                out.print(SP.MINION(target))
+                out.print(SP.MINION("{} ".format("." * (desc_width - len(target)))))
                 if data['finished']:
-                    PP.print(SP.OK if data['success'] else SP.FAIL)
+                    out.print(SP.OK if data['success'] else SP.FAIL)
                     ts = datetime.datetime.strptime(data['event'].stamp,
                                                     "%Y-%m-%dT%H:%M:%S.%f")
-                    PP.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
+                    out.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
                 else:
                     ts = datetime.datetime.utcnow()
-                    PP.print(SP.WAITING)
-                    PP.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
+                    out.print(SP.WAITING)
+                    out.println(" ({})".format(SP.Step.ftime(ts-self.start_ts)))
 
                 for state_res in data['states']:
                     lines = SP.format_desc(state_res.step.pretty_string(),
                                            desc_width - 7)
                     for idx, line in enumerate(lines):
-                        PP.print(" " * offset)
+                        out.print(" " * offset)
                         if idx == 0:
-                            PP.print(SP.STATE_RES("  |_ {}".format(line)))
+                            out.print(SP.STATE_RES("  |_ {}".format(line)))
                         else:
-                            PP.print("     ")
-                            PP.print(SP.STATE_RES(line))
+                            out.print("     ")
+                            out.print(SP.STATE_RES(line))
                         if idx == len(lines)-1:
                             msg_rest = desc_width - (len(line) + 3) - 2
-                            PP.print(SP.STATE_RES("{} ".format("." * msg_rest)))
+                            out.print(SP.STATE_RES("{} ".format("." * msg_rest)))
                             if state_res.finished:
                                 if state_res.success:
-                                    PP.println(u"{}".format(SP.OK))
+                                    out.println(u"{}".format(SP.OK))
                                 else:
-                                    PP.println(u"{}".format(SP.FAIL))
+                                    out.println(u"{}".format(SP.FAIL))
                             else:
-                                PP.println(SP.WAITING)
+                                out.println(SP.WAITING)
                         else:
-                            PP.println()
+                            out.println()
 
     class PrinterThread(threading.Thread):
         def __init__(self, printer):
@@ -631,17 +642,31 @@ class StepListPrinter(MonitorListener):
         def run(self):
             self.running = True
             PP.print("\x1B[?25l")  # hides cursor
+            frame_interval = 1.0 / self.printer.max_fps
             while self.running:
-                time.sleep(0.5)
+                time.sleep(frame_interval)
                 with self.printer.print_lock:
-                    if self.printer.step:
-                        self.printer.print_step(self.printer.step)
+                    # repaint on changes, and at least twice a second to
+                    # update the clock counters
+                    if self.printer.dirty or \
+                            time.time() - self.printer.last_paint >= SP.CLOCK_INTERVAL:
+                        self.printer.repaint()
 
             PP.print("\x1B[?25h")  # shows cursor
 
-    def __init__(self, clear_screen=True):
+    # seconds between repaints of the clock counters of a running step
+    CLOCK_INTERVAL = 0.5
+
+    def __init__(self, clear_screen=True, max_fps=10):
+        """
+        Args:
+            clear_screen (bool): whether to clear the terminal when the stage starts
+            max_fps (int): the maximum number of repaints per second, updates
+                           received in between are coalesced
+        """
         super(StepListPrinter, self).__init__()
         self._clear_screen = clear_screen
+        self.max_fps = max_fps
         self.stage_name = None
         self.stage = None
         self.total_steps = None
@@ -651,6 +676,32 @@ class StepListPrinter(MonitorListener):
         self.print_lock = threading.Lock()
         self.init_output = None
         self.init_output_printed = False
+        self.screen = Screen()
+        self.num_cols = 100
+        self.dirty = False
+        self.last_paint = 0
+
+    def repaint(self):
+        """
+        Composes the frame of the running step and repaints the lines that
+        changed. Must be called with print_lock held.
+        """
+        self.dirty = False
+        self.last_paint = time.time()
+        if not self.step:
+            return
+        self.num_cols = min(get_terminal_size()[1], 100)
+        self.print_step(self.step)
+        self.screen.flush()
+
+    def _finish_root_step(self):
+        """
+        Paints the final frame of the running step and leaves it on the
+        terminal. Must be called with print_lock held.
+        """
+        self.repaint()
+        self.screen.commit()
+        self.step = None
 
     def stage_started(self, stage_name):
         if self._clear_screen:
@@ -714,6 +765,7 @@ class StepListPrinter(MonitorListener):
         self.step = None
         self.thread.stop()
         self.thread = None
+        self.screen.commit()
 
         PP.println("\x1B[K")
 
@@ -842,7 +894,7 @@ class StepListPrinter(MonitorListener):
                     PP.println()
                 elif step.order > 1:
                     PP.println()
-            self.print_step(self.step)
+            self.dirty = True
 
     def step_runner_finished(self, step):
         if step.order > 0 and not step.success:
@@ -854,15 +906,16 @@ class StepListPrinter(MonitorListener):
                 # maybe it's a substep
                 if not self.step.finish_substep(step):
                     logger.error("substep jid=%s not found: event=\n%s", step.jid, step.end_event)
+                self.dirty = True
             elif self.step:
                 self.step.finished = True
-                self.print_step(self.step)
-                self.step = None
+                self._finish_root_step()
 
     def step_runner_skipped(self, step):
         # the step_runner_started already handles skipped steps
         self.step_runner_started(step)
-        self.step = None
+        with self.print_lock:
+            self._finish_root_step()
 
     def step_state_started(self, step):
         with self.print_lock:
@@ -880,7 +933,7 @@ class StepListPrinter(MonitorListener):
                     PP.println()
                 elif step.order > 1:
                     PP.println()
-            self.print_step(self.step)
+            self.dirty = True
 
     def step_state_minion_finished(self, step, minion):
         if step.order > 0 and not step.targets[minion]['success']:
@@ -893,25 +946,36 @@ class StepListPrinter(MonitorListener):
                 # maybe it's a substep
                 if not self.step.finish_substep(step):
                     logger.error("substep jid=%s not found: event=\n%s", step.jid, step.end_event)
-            elif self.step:
-                self.print_step(self.step)
+            self.dirty = True
 
     def step_state_finished(self, step):
         with self.print_lock:
             if self.step and self.step.step.jid == step.jid:
                 self.step.finished = True
-                self.step = None
+                self._finish_root_step()
 
     def step_state_result(self, step, event):
         with self.print_lock:
             assert self.step
             assert isinstance(self.step, StepListPrinter.State)
-            self.print_step(self.step)
+            self.dirty = True
 
     def step_state_skipped(self, step):
         # the step_state_started already handles skipped steps
         self.step_state_started(step)
-        self.step = None
+        with self.print_lock:
+            self._finish_root_step()
+
+
+def get_printer(simple_output, clear_screen=True, max_fps=10):
+    """
+    Returns the monitor listener that prints the stage progress. The step
+    list printer repaints the terminal in place, so it is only used when
+    stdout is a terminal.
+    """
+    if simple_output or not sys.stdout.isatty():
+        return SimplePrinter()
+    return StepListPrinter(clear_screen, max_fps)
 
 
 SP = StepListPrinter
@@ -4,9 +4,11 @@ Salt Event Processor module
 """
 from __future__ import absolute_import
 
-import fnmatch
+import gzip
+import json
 import logging
 import threading
+import time
 
 import salt.config
 import salt.utils.event
@@ -162,17 +164,153 @@ class EventListener(object):
         """
         pass
 
+    def handle_stage_parsed(self, stage_name, steps, output):
+        """Handle a stage parsing result read from an event recording
+        Args:
+            stage_name (str): the stage name
+            steps (list): the parsed stage steps
+            output (str): the stage rendering output
+        """
+        pass
+
+
+class StageJidFilter(object):
+    """
+    Event filter that only lets through the events of DeepSea stages.
+
+    The stage orchestration is detected by its runner start event. While a
+    stage is running, every job or runner start event is let through, since
+    it may be one of the stage steps, and its jid is remembered. Return and
+    state result events are only let through for remembered jids. When no
+    stage is running, everything but the start of a new stage is dropped.
+    """
+    def __init__(self):
+        self.stage_jids = set()
+        self.jids = set()
+
+    def accept(self, kind, action, jid, data):
+        """
+        Checks whether an event should be processed
+        Args:
+            kind (str): the event kind ("job", "run" or "state_result")
+            action (str): the event action ("new", "ret" or None)
+            jid (str): the job id
+            data (dict): the raw event data
+        """
+        if kind == 'run' and action == 'new' and data.get('fun') == 'runner.state.orch':
+            self.stage_jids.add(jid)
+            self.jids.add(jid)
+            return True
+        if not self.stage_jids:
+            return False
+        if action == 'new':
+            self.jids.add(jid)
+            return True
+        if jid not in self.jids:
+            return False
+        if kind == 'run' and jid in self.stage_jids:
+            self.stage_jids.remove(jid)
+            if not self.stage_jids:
+                self.jids.clear()
+        return True
+
+
+class EventRecorder(object):
+    """
+    Records the raw Salt events seen by the event processor, so that a monitor
+    session can be replayed later without a Salt master.
+
+    The recording is a gzip compressed file of JSON lines, each one a [time
+    offset, tag, data] list. The stage parsing results are recorded as well,
+    under STAGE_PARSED_TAG, since replaying a stage requires its steps.
+    """
+    STAGE_PARSED_TAG = 'deepsea/cli/stage_parsed'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb')
+        self.lock = threading.Lock()
+        self.start_ts = time.time()
+        self.count = 0
+
+    def record(self, tag, data):
+        """
+        Appends an event to the recording
+        Args:
+            tag (str): the event tag
+            data (dict): the event data
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            line = json.dumps([time.time() - self.start_ts, tag, data], default=str)
+            self.file.write((line + "\n").encode('utf-8'))
+            self.count += 1
+
+    def record_stage(self, stage_name, steps, output):
+        """
+        Appends a stage parsing result to the recording
+        Args:
+            stage_name (str): the stage name
+            steps (list): the parsed steps, as returned by SLSParser.dump_steps
+            output (str): the stage rendering output
+        """
+        self.record(self.STAGE_PARSED_TAG,
+                    {'stage_name': stage_name, 'steps': steps, 'output': output})
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        logger.info("Recorded %s events to %s", self.count, self.path)
+
+
+def read_event_recording(path):
+    """
+    Reads an event recording created by EventRecorder
+    Args:
+        path (str): the recording file path
+    Returns:
+        generator: (time offset, tag, data) tuples
+    """
+    with gzip.open(path, 'rb') as rec_file:
+        for line in rec_file:
+            try:
+                stamp, tag, data = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.warning("skipping malformed record in %s", path)
+                continue
+            yield stamp, tag, data
+
 
 class SaltEventProcessor(threading.Thread):
     """
     This class implements an execution loop to listen for the Salt event BUS.
     """
-    def __init__(self):
+
+    # (kind, action, number of tag parts) -> (event class, listener method)
+    _DISPATCH_TABLE = {
+        ('job', 'new', 4): (NewJobEvent, 'handle_new_job_event'),
+        ('run', 'new', 4): (NewRunnerEvent, 'handle_new_runner_event'),
+        ('job', 'ret', 5): (RetJobEvent, 'handle_ret_job_event'),
+        ('run', 'ret', 4): (RetRunnerEvent, 'handle_ret_runner_event'),
+    }
+
+    def __init__(self, event_filter=None, recorder=None):
+        """
+        Args:
+            event_filter (StageJidFilter): optional filter applied to the raw
+                                           events before they are dispatched
+            recorder (EventRecorder): optional recorder of the raw events
+        """
         super(SaltEventProcessor, self).__init__()
         self.running = False
         self.listeners = []
         self.io_loop = None
         self.event = threading.Event()
+        self.event_filter = event_filter
+        self.recorder = recorder
 
     def add_listener(self, listener):
         """Adds an event listener to the listener list
@@ -212,14 +350,41 @@ class SaltEventProcessor(threading.Thread):
         """
         self.running = False
         self.io_loop.stop()
+        if self.recorder:
+            self.recorder.close()
 
     def _handle_event_recv(self, raw):
         """
         Handles the asynchronous reception of raw events
         """
         mtag, data = salt.utils.event.SaltEvent.unpack(raw)
+        if self.recorder:
+            self.recorder.record(mtag, data)
         self._process({'tag': mtag, 'data': data})
 
+    @classmethod
+    def _route(cls, tag):
+        """
+        Finds the event class and listener method for an event tag
+        Args:
+            tag (str): the event tag
+        Returns:
+            tuple: (kind, action, jid, event class, listener method) or None
+                   if the event is not handled
+        """
+        parts = tag.split('/', 4)
+        if len(parts) < 3 or parts[0] != 'salt':
+            return None
+        if parts[1] == 'state_result':
+            return 'state_result', None, parts[2], StateResultEvent, \
+                   'handle_state_result_event'
+        if len(parts) < 4:
+            return None
+        route = cls._DISPATCH_TABLE.get((parts[1], parts[3], len(parts)))
+        if route is None:
+            return None
+        return (parts[1], parts[3], parts[2]) + route
+
     def _process(self, event):
         """Processes a raw event
 
@@ -228,30 +393,74 @@ class SaltEventProcessor(threading.Thread):
         Args:
             event (dict): the raw event data
         """
+        route = self._route(event['tag'])
+        if route is None:
+            return
+        kind, action, jid, event_class, handler = route
+        if self.event_filter and not self.event_filter.accept(kind, action, jid,
+                                                              event['data']):
+            return
+
         logger.debug("Process event -> %s", event)
-        wrapper = None
-        if fnmatch.fnmatch(event['tag'], 'salt/job/*/new'):
-            wrapper = NewJobEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_new_job_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/run/*/new'):
-            wrapper = NewRunnerEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_new_runner_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/job/*/ret/*'):
-            wrapper = RetJobEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_ret_job_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/run/*/ret'):
-            wrapper = RetRunnerEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_ret_runner_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/state_result/*'):
-            wrapper = StateResultEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_state_result_event(wrapper)
+        wrapper = event_class(event)
+        for listener in self.listeners:
+            listener.handle_salt_event(wrapper)
+            getattr(listener, handler)(wrapper)
+
+
+class EventReplayer(SaltEventProcessor):
+    """
+    Event processor that reads the events from a recording made by
+    EventRecorder instead of the Salt event bus.
+
+    The recorded stage parsing results are handed to the listeners before
+    any event, since a stage may be recorded after its start event.
+    """
+    def __init__(self, path, realtime=True, event_filter=None):
+        """
+        Args:
+            path (str): the recording file path
+            realtime (bool): replay the events with their original timing,
+                             otherwise as fast as possible
+            event_filter (StageJidFilter): optional filter applied to the raw
+                                           events before they are dispatched
+        """
+        super(EventReplayer, self).__init__(event_filter)
+        self.path = path
+        self.realtime = realtime
+        self.count = 0
+        self.duration = None
+
+    def run(self):
+        """
+        Feeds the recorded events to the listeners
+        """
+        self.event.set()
+        start_ts = time.time()
+        try:
+            for _, tag, data in read_event_recording(self.path):
+                if tag == EventRecorder.STAGE_PARSED_TAG:
+                    for listener in self.listeners:
+                        listener.handle_stage_parsed(data['stage_name'], data['steps'],
+                                                     data['output'])
+            for stamp, tag, data in read_event_recording(self.path):
+                if not self.running:
+                    break
+                if tag == EventRecorder.STAGE_PARSED_TAG:
+                    continue
+                if self.realtime:
+                    delay = start_ts + stamp - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.count += 1
+                self._process({'tag': tag, 'data': data})
+        finally:
+            self.duration = time.time() - start_ts
+            self.running = False
+        logger.info("Replayed %s events in %ss", self.count, self.duration)
+
+    def stop(self):
+        """
+        Sets running flag to False
+        """
+        self.running = False
@@ -19,9 +19,12 @@ import threading
 import time
 import sys
 
-from .common import clean_pyc_files
+from .common import clean_pyc_files, PrettyPrinter as PP
+from .config import Config
 from .monitor import Monitor
-from .monitors.terminal_outputter import SimplePrinter, StepListPrinter
+from .monitors.jsonlines_outputter import JsonLinesPrinter, open_json_stream
+from .monitors.profile_outputter import ProfileWriter
+from .monitors.terminal_outputter import get_printer
 from .stage_parser import RenderingException
 
 
@@ -63,7 +66,8 @@ class StageExecutor(threading.Thread):
         return self.proc is not None and self.retcode is None
 
 
-def run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
+def run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output,
+              profile=None, json_lines=None):
     """
     Runs a stage
     Args:
@@ -71,10 +75,27 @@ def run_stage(stage_name, hide_state_steps, hide_dynamic_steps, simple_output):
         hide_state_steps (bool): don't show state result steps
         hide_dynamic_steps (bool): don't show runtime generated steps
         simple_output (bool): use the minimal outputter
+        profile (str): path of the file where to write the stage timing profile
+        json_lines (str): where to stream the progress events as JSON lines,
+                          '-' replaces the terminal output
     """
+    json_stream = None
+    if json_lines:
+        try:
+            json_stream = open_json_stream(json_lines)
+        except (IOError, OSError) as ex:
+            logger.error("failed to open JSON lines stream %s: %s", json_lines, ex)
+            PP.println("{}: Cannot open JSON lines stream {}: {}"
+                       .format(PP.red("ERROR"), PP.cyan(json_lines), ex))
+            return 1
+
     mon = Monitor(not hide_state_steps, not hide_dynamic_steps)
-    printer = SimplePrinter() if simple_output else StepListPrinter(False)
-    mon.add_listener(printer)
+    if json_lines != '-':
+        mon.add_listener(get_printer(simple_output, False, Config.MAX_FPS))
+    if json_stream:
+        mon.add_listener(JsonLinesPrinter(json_stream))
+    if profile:
+        mon.add_listener(ProfileWriter(profile))
     try:
         mon.parse_stage(stage_name)
     except RenderingException:
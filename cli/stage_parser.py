@@ -5,8 +5,11 @@ This module is responsible for the parsing of DeepSea stage files
 from __future__ import absolute_import
 from __future__ import print_function
 
+import hashlib
+import heapq
 import logging
 import os
+import pickle
 import pwd
 import time
 import sys
@@ -21,6 +24,7 @@ import salt.minion
 import salt.exceptions
 
 from .common import redirect_output
+from .config import Config
 
 
 # pylint: disable=C0103
@@ -141,6 +145,19 @@ class SLSRenderer(object):
 
     @classmethod
     def _render_in_minion(cls, state_name, target, retry=True):
+        return cls.collect_in_minion(cls.submit_in_minion(state_name, target), retry)
+
+    @classmethod
+    def submit_in_minion(cls, state_name, target):
+        """
+        Publishes the rendering job without waiting for the minions to reply,
+        so that several targets can be rendered concurrently.
+        Args:
+            state_name (str|list): the salt state names
+            target (str): the compound target
+        Returns:
+            dict: the job handle to be passed to collect_in_minion
+        """
         logger.info("Rendering states=%s on=%s", state_name, target)
         if sys.version_info >= (3, 0):
             err = StringIO()
@@ -149,14 +166,55 @@ class SLSRenderer(object):
             err = BytesIO()
             out = BytesIO()
 
+        if isinstance(state_name, str):
+            state_name = [state_name]
+
+        with redirect_output(out, err):
+            pub_data = SaltClient.local().run_job(target, 'deepsea.show_low_sls',
+                                                  state_name, tgt_type="compound",
+                                                  listen=True)
+        return {'state_name': state_name, 'target': target, 'pub_data': pub_data,
+                'out': out, 'err': err}
+
+    @classmethod
+    def _wait_returns(cls, job):
+        """
+        Waits for the returns of a published job, mimicking LocalClient.cmd
+        """
+        pub_data = job['pub_data']
+        if not pub_data:
+            return {}
+        local = SaltClient.local()
+        res = {}
+        for fn_ret in local.get_cli_event_returns(pub_data['jid'], pub_data['minions'],
+                                                  local.opts['timeout'], job['target'],
+                                                  "compound"):
+            if fn_ret:
+                for minion, data in fn_ret.items():
+                    res[minion] = data.get('ret', {})
+        for failed in set(pub_data['minions']) - set(res):
+            res[failed] = False
+        return res
+
+    @classmethod
+    def collect_in_minion(cls, job, retry=True):
+        """
+        Waits for the rendering job submitted by submit_in_minion and
+        processes its result
+        Args:
+            job (dict): the job handle
+            retry (bool): whether to sync the deepsea module and render again
+                          when it is not available in the minion
+        """
+        state_name = job['state_name']
+        target = job['target']
+        out = job['out']
+        err = job['err']
+
         out2 = None
         err2 = None
         with redirect_output(out, err):
-            if isinstance(state_name, str):
-                state_name = [state_name]
-
-            res = SaltClient.local().cmd(target, 'deepsea.show_low_sls',
-                                         state_name, tgt_type="compound")
+            res = cls._wait_returns(job)
 
             logger.debug("Rendering result: %s", res)
             for minion, states in res.items():
@@ -265,6 +323,98 @@ class SLSRenderer(object):
         return res, out, err
 
 
+class StageCache(object):
+    """
+    On-disk cache of parsed stage steps.
+
+    Each entry is stored together with a fingerprint of everything that can
+    influence the rendering result: the salt file roots, the pillar tree,
+    the extension modules and the set of accepted minions.  A mismatching
+    fingerprint is treated as a miss and the stage is parsed again.
+
+    Runtime inputs of the rendering are not part of the fingerprint: grains,
+    pillar data that does not come from /srv/pillar and the results of
+    runners called by the templates, e.g. select.minions.  When these change
+    the cached steps may be stale until the cache is cleared with
+    --clear-cache.
+    """
+
+    FINGERPRINT_PATHS = ['/srv/salt', '/srv/pillar', '/srv/modules',
+                         '/etc/salt/pki/master/minions']
+
+    @classmethod
+    def fingerprint(cls):
+        """
+        Computes a hash over the path, size and mtime of every file that
+        may be read while rendering a stage
+        """
+        digest = hashlib.sha1()
+        for root_path in cls.FINGERPRINT_PATHS:
+            for root, dirs, files in os.walk(root_path):
+                dirs.sort()
+                for filename in sorted(files):
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    digest.update("{}:{}:{}\n".format(path, stat.st_size, stat.st_mtime)
+                                  .encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def _path(cls, stage_name, hide_state_steps, only_visible_steps):
+        key = "{}-{}-{}".format(stage_name, int(hide_state_steps),
+                                int(only_visible_steps))
+        return os.path.join(Config.STAGE_CACHE_DIR, "{}.pickle".format(key))
+
+    @classmethod
+    def load(cls, stage_name, hide_state_steps, only_visible_steps, fingerprint):
+        """
+        Returns the cached (steps, out) tuple or None
+        """
+        path = cls._path(stage_name, hide_state_steps, only_visible_steps)
+        try:
+            with open(path, 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError):
+            return None
+        if entry.get('fingerprint') != fingerprint:
+            logger.info("stage cache for %s is stale", stage_name)
+            return None
+        return entry['steps'], entry['out']
+
+    @classmethod
+    def store(cls, stage_name, hide_state_steps, only_visible_steps, fingerprint,
+              steps, out):
+        """
+        Stores the parsed steps, replacing any previous entry atomically
+        """
+        path = cls._path(stage_name, hide_state_steps, only_visible_steps)
+        tmp_path = "{}.{}".format(path, os.getpid())
+        try:
+            if not os.path.exists(Config.STAGE_CACHE_DIR):
+                os.makedirs(Config.STAGE_CACHE_DIR)
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump({'fingerprint': fingerprint, 'steps': steps, 'out': out},
+                            cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, pickle.PicklingError) as ex:
+            logger.warning("failed to store stage cache for %s: %s", stage_name, ex)
+
+    @classmethod
+    def clean(cls, stage_name=None):
+        """
+        Removes the cache entries of a stage, or all entries if stage_name is None
+        """
+        if not os.path.exists(Config.STAGE_CACHE_DIR):
+            return
+        for filename in os.listdir(Config.STAGE_CACHE_DIR):
+            if stage_name is None or filename.startswith("{}-".format(stage_name)):
+                os.remove(os.path.join(Config.STAGE_CACHE_DIR, filename))
+
+
 class SLSParser(object):
     """
     SLS files parser
@@ -291,17 +441,83 @@ class SLSParser(object):
 
         return SaltStateFunction(step_dict, target)
 
+    @classmethod
+    def dump_steps(cls, steps):
+        """
+        Returns the parsed steps as JSON serializable data, to be rebuilt by
+        load_steps
+        """
+        dumped = []
+        for step in steps:
+            entry = {'step': step.step_dict}
+            if isinstance(step, SaltState):
+                entry['target_expanded'] = step.target_expanded
+                entry['steps'] = dict((minion, cls.dump_steps(s_steps))
+                                      for minion, s_steps in step.steps.items())
+            dumped.append(entry)
+        return dumped
+
+    @classmethod
+    def load_steps(cls, stage_name, dumped):
+        """
+        Rebuilds the steps returned by dump_steps without rendering the stage
+        """
+        return cls._process_states_requisites(stage_name, cls._load_steps(dumped))
+
+    @classmethod
+    def _load_steps(cls, dumped, target=None):
+        steps = []
+        for entry in dumped:
+            step = cls.parse_step(entry['step'], target)
+            if isinstance(step, SaltState):
+                step.target_expanded = entry['target_expanded']
+                for minion, s_steps in entry['steps'].items():
+                    step.steps[minion] = cls._load_steps(s_steps, minion)
+            steps.append(step)
+        return steps
+
     @staticmethod
     def notify_listener(listeners, states, minion=None):
         for l in listeners:
             l.stage_parsing_state(states, minion)
 
+    @staticmethod
+    def clean_cache(stage_name):
+        """
+        Removes the parsed steps cache of a stage, or of all stages if
+        stage_name is None
+        """
+        StageCache.clean(stage_name)
+
     @classmethod
     def parse_stage(cls, stage_name, hide_state_steps, only_visible_steps,
-                    monitor_listeners=None):
+                    monitor_listeners=None, use_cache=True):
         if monitor_listeners is None:
             monitor_listeners = []
 
+        if not use_cache:
+            return cls._parse_stage(stage_name, hide_state_steps, only_visible_steps,
+                                    monitor_listeners)
+
+        t0 = time.time()
+        fingerprint = StageCache.fingerprint()
+        cached = StageCache.load(stage_name, hide_state_steps, only_visible_steps,
+                                 fingerprint)
+        if cached is not None:
+            SLSParser.notify_listener(monitor_listeners, [stage_name])
+            logger.info("loaded stage %s from cache in: %ss", stage_name,
+                        time.time() - t0)
+            return cached
+
+        steps, out = cls._parse_stage(stage_name, hide_state_steps, only_visible_steps,
+                                      monitor_listeners)
+        StageCache.store(stage_name, hide_state_steps, only_visible_steps, fingerprint,
+                         steps, out)
+        return steps, out
+
+    @classmethod
+    def _parse_stage(cls, stage_name, hide_state_steps, only_visible_steps,
+                     monitor_listeners):
         steps = []
         t0 = time.time()
         SLSParser.notify_listener(monitor_listeners, [stage_name])
@@ -327,9 +543,13 @@ class SLSParser(object):
         t0 = time.time()
         states_rendering = defaultdict(lambda: defaultdict(
             lambda: defaultdict(dict)))
-        for target, states in states_to_render.items():
+        # publish all rendering jobs first, so that the minions render in
+        # parallel, and only then wait for each target in turn
+        jobs = [(target, states, SLSRenderer.submit_in_minion(list(states), target))
+                for target, states in states_to_render.items()]
+        for target, states, job in jobs:
             SLSParser.notify_listener(monitor_listeners, states, target)
-            res, _, _ = SLSRenderer.render(list(states), target)
+            res, _, _ = SLSRenderer.collect_in_minion(job)
             for minion, state_res in res.items():
                 if isinstance(state_res, list):
                     assert len(states) == 1
@@ -356,24 +576,40 @@ class SLSParser(object):
 
         return steps, out
 
-    @classmethod
-    def _search_step(cls, steps, state, sid):
+    @staticmethod
+    def _index_steps(steps):
         """
-        Searches a step that matches the module name and state id
+        Builds the requisite lookup table of a list of steps
         Args:
             steps (list): list of steps
-            mod_name (str): salt module name, can be None
-            sid (str): state id
+        Returns:
+            dict: maps (state, name/desc) and (None, name/desc) to the first
+                  step that matches
         """
+        index = {}
         for step in steps:
-            if state is None or step.state == state:
-                if step.get_arg('name') == sid or step.desc == sid:
-                    return step
+            for sid in (step.get_arg('name'), step.desc):
+                if sid is None or isinstance(sid, (list, dict)):
+                    continue
+                index.setdefault((step.state, sid), step)
+                index.setdefault((None, sid), step)
+        return index
 
-        return None
+    @classmethod
+    def _search_step(cls, index, state, sid):
+        """
+        Searches a step that matches the module name and state id
+        Args:
+            index (dict): the lookup table built by _index_steps
+            state (str): salt module name, can be None
+            sid (str): state id
+        """
+        return index.get((state, sid))
 
     @classmethod
     def _process_states_requisites(cls, stage_name, steps):
+        index = cls._index_steps(steps)
+
         def process_requisite_directive(step, directive):
             """
             Processes a requisite directive
@@ -391,7 +627,7 @@ class SLSParser(object):
 
             for mod, sid in reqs_t:
                 logger.debug("searching for state=%s desc/name=%s", mod, sid)
-                req_step = cls._search_step(steps, mod, sid)
+                req_step = cls._search_step(index, mod, sid)
                 logger.debug("found state dependency from: %s to: %s", step,
                              req_step)
                 assert req_step
@@ -410,29 +646,65 @@ class SLSParser(object):
 
         return steps
 
+    @staticmethod
+    def _step_deps(step):
+        return step.on_success_deps + step.on_fail_deps
+
+    @classmethod
+    def _find_cycle(cls, steps, pending):
+        """
+        Returns a requisite cycle among the steps that could not be ordered
+        Args:
+            steps (list): list of steps
+            pending (dict): number of unsatisfied requisites by step position
+        """
+        remaining = set(id(steps[idx]) for idx, count in pending.items() if count)
+        step = steps[min(idx for idx, count in pending.items() if count)]
+        path = []
+        seen = {}
+        while id(step) not in seen:
+            seen[id(step)] = len(path)
+            path.append(step)
+            deps = [dep for dep in cls._step_deps(step) if id(dep) in remaining]
+            if not deps:
+                # the step requires a step that is not part of this list
+                return path
+            step = deps[0]
+        return path[seen[id(step)]:] + [step]
+
     @classmethod
     def _reorder(cls, stage_name, steps):
-        def all_deps_available(p_nsteps, p_deps):
-            for p_dep in p_deps:
-                if p_dep not in p_nsteps:
-                    return False
-            return True
+        """
+        Orders the steps so that each step comes after its requisites. Among
+        the steps whose requisites are satisfied, the one that comes first in
+        the stage is always picked, to keep the order of the stage file.
+        """
+        pending = {}
+        dependants = defaultdict(list)
+        ready = []
+        for idx, step in enumerate(steps):
+            deps = set(id(dep) for dep in cls._step_deps(step))
+            pending[idx] = len(deps)
+            for dep in deps:
+                dependants[dep].append(idx)
+            if not deps:
+                ready.append(idx)
+        heapq.heapify(ready)
 
         nsteps = []
-        prev_len = len(steps)
-        while steps:
-            for idx, step in enumerate(steps):
-                deps = list(step.on_success_deps)
-                deps.extend(step.on_fail_deps)
-                if all_deps_available(nsteps, deps):
-                    nsteps.append(step)
-                    steps.pop(idx)
-                    break
-
-            if len(steps) == prev_len:
-                raise StageRenderingException(stage_name,
-                                              ["Recursive requisite found"])
-            prev_len = len(steps)
+        while ready:
+            idx = heapq.heappop(ready)
+            nsteps.append(steps[idx])
+            for dependant in dependants[id(steps[idx])]:
+                pending[dependant] -= 1
+                if not pending[dependant]:
+                    heapq.heappush(ready, dependant)
+
+        if len(nsteps) != len(steps):
+            cycle = cls._find_cycle(steps, pending)
+            raise StageRenderingException(
+                stage_name, ["Recursive requisite found: {}".format(
+                    " -> ".join([step.desc for step in cycle]))])
 
         return nsteps
 
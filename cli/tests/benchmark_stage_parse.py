@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the stage parser requisite resolution and step ordering on
+synthetic stages.  It does not need a running salt master.
+
+    $ python3 -m cli.tests.benchmark_stage_parse [steps] [requisites per step]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import logging
+import random
+import sys
+import time
+
+from .. import stage_parser
+from ..stage_parser import SLSParser, SaltRunner
+
+
+def synthetic_stage(num_steps, num_reqs, seed=0):
+    """
+    Returns a list of steps where each step requires up to num_reqs of the
+    previous steps, using all the forms of requisite lookup
+    """
+    rand = random.Random(seed)
+    steps = []
+    for idx in range(num_steps):
+        step_dict = {
+            '__id__': 'step {}'.format(idx),
+            'name': 'runner.fun{}'.format(idx),
+            'state': 'salt',
+            'fun': 'runner',
+        }
+        reqs = []
+        for _ in range(min(idx, num_reqs)):
+            dep = rand.randrange(idx)
+            choice = rand.randrange(3)
+            if choice == 0:
+                reqs.append('step {}'.format(dep))
+            elif choice == 1:
+                reqs.append({'salt': 'step {}'.format(dep)})
+            else:
+                reqs.append({'salt': 'runner.fun{}'.format(dep)})
+        if reqs:
+            step_dict['require'] = reqs
+        steps.append(SaltRunner(step_dict))
+    # shuffle so that the ordering has real work to do
+    rand.shuffle(steps)
+    return steps
+
+
+def run(num_steps, num_reqs):
+    # same as the default "deepsea --log-level info"
+    logging.getLogger(stage_parser.__name__).setLevel(logging.INFO)
+    steps = synthetic_stage(num_steps, num_reqs)
+
+    t0 = time.time()
+    steps = SLSParser._process_states_requisites("benchmark", steps)
+    t1 = time.time()
+    steps = SLSParser._reorder("benchmark", steps)
+    t2 = time.time()
+
+    print("steps={} requisites/step={}".format(num_steps, num_reqs))
+    print("  requisite resolution: {:.3f}s".format(t1 - t0))
+    print("  topological ordering: {:.3f}s".format(t2 - t1))
+
+
+def main(argv):
+    num_steps = int(argv[1]) if len(argv) > 1 else 10000
+    num_reqs = int(argv[2]) if len(argv) > 2 else 3
+    run(num_steps, num_reqs)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -3,9 +3,11 @@ from __future__ import absolute_import
 
 import os
 import shutil
+import tempfile
 import unittest
 import yaml
 
+from ..config import Config
 from ..stage_parser import SaltClient
 
 
@@ -81,7 +83,14 @@ def test(**kwargs):
 
         cls.STATE_FILES_INDEX.append(state_file)
 
+    def setUp(self):
+        # keep the parsed steps cache of the tests away from the real one
+        self.stage_cache_dir = Config.STAGE_CACHE_DIR
+        Config.STAGE_CACHE_DIR = tempfile.mkdtemp()
+
     def tearDown(self):
+        shutil.rmtree(Config.STAGE_CACHE_DIR)
+        Config.STAGE_CACHE_DIR = self.stage_cache_dir
         if self.CLEAN_STATE_FILES:
             for sf in self.STATE_FILES_INDEX:
                 os.remove(sf)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from ..monitor import Stage
+from ..monitors.jsonlines_outputter import JsonLinesPrinter
+from ..salt_event import NewRunnerEvent
+from ..stage_executor import run_stage
+from ..stage_parser import SaltRunner
+
+
+class _Stream(io.StringIO):
+    """
+    Keeps the written value readable after close
+    """
+    def close(self):
+        self.closed_by_printer = True
+
+
+class TestJsonLinesPrinter(unittest.TestCase):
+
+    def _lines(self, stream):
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_events(self):
+        stream = _Stream()
+        printer = JsonLinesPrinter(stream)
+        step = Stage.Step(SaltRunner({'__id__': 'a', 'name': 'runner.a', 'state': 'salt',
+                                      'fun': 'runner'}), 'runner.a', 1)
+        step.start(NewRunnerEvent({'tag': 'salt/run/2/new',
+                                   'data': {'jid': '2', '_stamp': '', 'fun': 'runner.runner.a',
+                                            'fun_args': ['arg1']}}))
+
+        printer.stage_started('ceph.stage.0')
+        printer.step_runner_started(step)
+        printer.stage_parsing_finished(None, 'output', Exception('error'))
+
+        events = self._lines(stream)
+        self.assertEqual([e['event'] for e in events],
+                         ['stage_started', 'step_runner_started', 'stage_parsing_finished'])
+        self.assertEqual([e['seq'] for e in events], [0, 1, 2])
+        self.assertEqual(events[0]['stage'], 'ceph.stage.0')
+        self.assertEqual(events[1]['step'], {'order': 1, 'name': 'runner.a', 'args': 'arg1',
+                                             'jid': '2', 'success': None})
+        self.assertEqual(events[2]['error'], 'error')
+        monotonic = [e['monotonic'] for e in events]
+        self.assertEqual(monotonic, sorted(monotonic))
+        self.assertTrue(stream.closed_by_printer)
+
+    def test_stage_finished_closes(self):
+        stream = _Stream()
+        printer = JsonLinesPrinter(stream)
+        stage = Stage('ceph.stage.0', [], False)
+        printer.stage_finished(stage)
+        self.assertEqual(self._lines(stream)[0]['event'], 'stage_finished')
+        self.assertTrue(stream.closed_by_printer)
+
+    def test_stdout_not_closed(self):
+        printer = JsonLinesPrinter(sys.stdout)
+        printer.close()
+        self.assertFalse(sys.stdout.closed)
+
+    def test_unreachable_stream(self):
+        path = os.path.join(tempfile.mkdtemp(), 'missing.sock')
+        ret = run_stage('ceph.stage.0', False, False, True, json_lines=path)
+        os.rmdir(os.path.dirname(path))
+        self.assertEqual(ret, 1)
@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import patch
+
 from ..tests.helper import SaltTestCase
-from ..monitor import MonitorListener, Monitor
+from ..monitor import MonitorListener, Monitor, Stage
+from ..salt_event import NewRunnerEvent, RetRunnerEvent, EventRecorder, EventReplayer, \
+                         StageJidFilter
 from ..stage_executor import StageExecutor
-from ..stage_parser import SaltRunner, SaltState
+from ..stage_parser import SaltRunner, SaltState, SLSParser
 
 
 class MonTestListener(MonitorListener):
@@ -332,3 +343,111 @@ test state 3:
         self.assertEqual(len(states), 1)
         self.assertEqual(states[0].name, 'skip')
         self.assertTrue(states[0].result)
+
+
+class MonitorQueueTest(unittest.TestCase):
+
+    def test_event_queue_stats(self):
+        monitor = Monitor(False, False)
+        handled = []
+        monitor.handle_test = handled.append
+        for idx in range(3):
+            monitor.append_event(Monitor.Event(monitor, 'handle_test', idx))
+        self.assertEqual(monitor.stats()['queue_depth'], 3)
+
+        thread = threading.Thread(target=monitor.run)
+        thread.start()
+        for _ in range(50):
+            if len(handled) == 3:
+                break
+            time.sleep(0.1)
+        monitor._running = False
+        thread.join()
+
+        self.assertEqual(handled, [0, 1, 2])
+        stats = monitor.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['max_queue_depth'], 3)
+        self.assertEqual(stats['handled'], 3)
+        self.assertGreaterEqual(stats['queue_latency_max'], stats['queue_latency_avg'])
+
+
+class StageProfileTest(unittest.TestCase):
+
+    @staticmethod
+    def _runner_event(event_class, jid, second, action, fun='runner.state.orch'):
+        data = {'jid': jid, '_stamp': '2018-01-01T10:00:{:02d}.000000'.format(second),
+                'fun': fun, 'fun_args': [], 'return': True, 'success': True}
+        return event_class({'tag': 'salt/run/{}/{}'.format(jid, action), 'data': data})
+
+    def _runner(self, name, reqs=None):
+        step_dict = {'__id__': name, 'name': 'runner.{}'.format(name), 'state': 'salt',
+                     'fun': 'runner'}
+        if reqs:
+            step_dict['require'] = [{'salt': req} for req in reqs]
+        return SaltRunner(step_dict)
+
+    def test_profile(self):
+        steps = [self._runner('a'), self._runner('b'), self._runner('c', ['a']),
+                 self._runner('d', ['b'])]
+        steps = SLSParser._process_states_requisites('test', steps)
+        stage = Stage('test', steps, False)
+        stage.start(self._runner_event(NewRunnerEvent, '1', 0, 'new'))
+        # a: 0-10, b: 11-12, c: 12-20, d: 20-21
+        times = [('a', 1, 10), ('b', 11, 12), ('c', 12, 20), ('d', 20, 21)]
+        for idx, (name, start, end) in enumerate(times):
+            jid = str(idx + 2)
+            fun = 'runner.runner.{}'.format(name)
+            stage.start_step(self._runner_event(NewRunnerEvent, jid, start, 'new', fun))
+            stage.finish_step(self._runner_event(RetRunnerEvent, jid, end, 'ret', fun))
+        stage.finish(self._runner_event(RetRunnerEvent, '1', 22, 'ret'))
+
+        profile = stage.profile()
+        self.assertEqual(profile['wall_time'], 22.0)
+        self.assertEqual([s['wall_time'] for s in profile['steps']], [9.0, 1.0, 8.0, 1.0])
+        self.assertEqual([s['queue_time'] for s in profile['steps']], [1.0, 1.0, 0.0, 0.0])
+        self.assertEqual(profile['critical_path'], {'steps': [1, 3], 'wall_time': 17.0})
+
+
+class MonitorReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "events.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def _runner_event(jid, action, fun, fun_args=None):
+        data = {'jid': jid, '_stamp': '2018-01-01T10:00:00.000000', 'fun': fun,
+                'fun_args': fun_args or [], 'return': True, 'success': True}
+        return 'salt/run/{}/{}'.format(jid, action), data
+
+    def test_replay_without_master(self):
+        steps = [SaltRunner({'__id__': 'a', 'name': 'runner.a', 'state': 'salt',
+                             'fun': 'runner'})]
+        recorder = EventRecorder(self.path)
+        # a live monitor records the stage after its start event
+        recorder.record(*self._runner_event('1', 'new', 'runner.state.orch', ['test.stage']))
+        recorder.record_stage('test.stage', SLSParser.dump_steps(steps), 'output')
+        recorder.record(*self._runner_event('2', 'new', 'runner.runner.a'))
+        recorder.record(*self._runner_event('2', 'ret', 'runner.runner.a'))
+        recorder.record(*self._runner_event('1', 'ret', 'runner.state.orch'))
+        recorder.close()
+
+        listener = MonTestListener()
+        started = []
+        listener.stage_started = started.append
+        monitor = Monitor(False, False, EventReplayer(self.path, False, StageJidFilter()))
+        monitor.add_listener(listener)
+        with patch.object(SLSParser, 'parse_stage', side_effect=Exception("no master")):
+            monitor.start()
+            monitor.wait_to_finish()
+
+        self.assertEqual(started, ['test.stage'])
+        self.assertIsNone(listener.parsing_error)
+        self.assertEqual(listener.stage.name, 'test.stage')
+        self.assertEqual(listener.parsing_output, 'output')
+        self.assertTrue(listener.steps[0]['finished'])
+        self.assertTrue(listener.finished)
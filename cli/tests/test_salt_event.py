@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..salt_event import SaltEventProcessor, EventListener, StageJidFilter, \
+                         NewJobEvent, RetJobEvent, NewRunnerEvent, RetRunnerEvent, \
+                         StateResultEvent, EventRecorder, EventReplayer, \
+                         read_event_recording
+
+
+class RecordingListener(EventListener):
+    def __init__(self):
+        self.events = []
+
+    def handle_new_job_event(self, event):
+        self.events.append(event)
+
+    def handle_ret_job_event(self, event):
+        self.events.append(event)
+
+    def handle_new_runner_event(self, event):
+        self.events.append(event)
+
+    def handle_ret_runner_event(self, event):
+        self.events.append(event)
+
+    def handle_state_result_event(self, event):
+        self.events.append(event)
+
+    def handle_stage_parsed(self, stage_name, steps, output):
+        self.events.append((stage_name, steps, output))
+
+
+def new_runner(jid, fun):
+    return {'tag': 'salt/run/{}/new'.format(jid),
+            'data': {'jid': jid, '_stamp': '', 'fun': fun, 'fun_args': []}}
+
+
+def ret_runner(jid, fun):
+    return {'tag': 'salt/run/{}/ret'.format(jid),
+            'data': {'jid': jid, '_stamp': '', 'fun': fun, 'return': True,
+                     'success': True}}
+
+
+def new_job(jid):
+    return {'tag': 'salt/job/{}/new'.format(jid),
+            'data': {'jid': jid, '_stamp': '', 'fun': 'state.sls', 'arg': [],
+                     'minions': ['minion1']}}
+
+
+def ret_job(jid):
+    return {'tag': 'salt/job/{}/ret/minion1'.format(jid),
+            'data': {'jid': jid, '_stamp': '', 'fun': 'state.sls', 'id': 'minion1',
+                     'success': True, 'retcode': 0, 'return': {}}}
+
+
+def state_result(jid):
+    return {'tag': 'salt/state_result/{}/minion1/some/name'.format(jid),
+            'data': {'jid': jid, '_stamp': '', 'id': 'minion1',
+                     'data': {'ret': {'__id__': 'id', 'result': True, 'name': 'name'}}}}
+
+
+class TestSaltEventProcessor(unittest.TestCase):
+
+    def _process(self, processor, events):
+        listener = RecordingListener()
+        processor.add_listener(listener)
+        for event in events:
+            processor._process(event)
+        return listener.events
+
+    def test_dispatch(self):
+        events = self._process(SaltEventProcessor(), [
+            new_runner('1', 'runner.state.orch'),
+            new_job('2'),
+            ret_job('2'),
+            state_result('2'),
+            {'tag': 'salt/auth', 'data': {}},
+            {'tag': 'minion_start', 'data': {}},
+            {'tag': 'salt/job/2/ret', 'data': {}},
+            ret_runner('1', 'runner.state.orch'),
+        ])
+        self.assertEqual([type(e) for e in events],
+                         [NewRunnerEvent, NewJobEvent, RetJobEvent, StateResultEvent,
+                          RetRunnerEvent])
+
+    def test_filter_outside_stage(self):
+        events = self._process(SaltEventProcessor(StageJidFilter()), [
+            new_job('2'),
+            ret_job('2'),
+            new_runner('3', 'runner.jobs.active'),
+        ])
+        self.assertEqual(events, [])
+
+    def test_filter_inside_stage(self):
+        events = self._process(SaltEventProcessor(StageJidFilter()), [
+            new_job('1'),
+            new_runner('2', 'runner.state.orch'),
+            ret_job('1'),
+            new_job('3'),
+            state_result('3'),
+            ret_job('3'),
+            state_result('4'),
+            ret_runner('2', 'runner.state.orch'),
+            new_job('5'),
+        ])
+        self.assertEqual([e.jid for e in events], ['2', '3', '3', '3', '2'])
+
+
+class TestEventRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "events.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _record(self, events, stage_first=True):
+        recorder = EventRecorder(self.path)
+        if stage_first:
+            recorder.record_stage('test.stage', ['step'], 'output')
+        for event in events:
+            recorder.record(event['tag'], event['data'])
+        if not stage_first:
+            recorder.record_stage('test.stage', ['step'], 'output')
+        recorder.close()
+
+    def test_read_recording(self):
+        self._record([new_job('1'), ret_job('1')])
+        records = list(read_event_recording(self.path))
+        self.assertEqual([tag for _, tag, _ in records],
+                         [EventRecorder.STAGE_PARSED_TAG, 'salt/job/1/new',
+                          'salt/job/1/ret/minion1'])
+        stamps = [stamp for stamp, _, _ in records]
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_replay(self):
+        self._record([new_runner('1', 'runner.state.orch'), new_job('2'), ret_job('2'),
+                      ret_runner('1', 'runner.state.orch')])
+        replayer = EventReplayer(self.path, False)
+        listener = RecordingListener()
+        replayer.add_listener(listener)
+        replayer.start()
+        replayer.join()
+
+        self.assertFalse(replayer.is_running())
+        self.assertEqual(replayer.count, 4)
+        self.assertEqual(listener.events[0], ('test.stage', ['step'], 'output'))
+        self.assertEqual([type(e) for e in listener.events[1:]],
+                         [NewRunnerEvent, NewJobEvent, RetJobEvent, RetRunnerEvent])
+
+    def test_json_lines(self):
+        self._record([new_job('1')])
+        with gzip.open(self.path, 'rb') as rec_file:
+            records = [json.loads(line.decode('utf-8')) for line in rec_file]
+        self.assertEqual([tag for _, tag, _ in records],
+                         [EventRecorder.STAGE_PARSED_TAG, 'salt/job/1/new'])
+
+    def test_replay_stage_recorded_late(self):
+        self._record([new_runner('1', 'runner.state.orch'), new_job('2')], False)
+        replayer = EventReplayer(self.path, False)
+        listener = RecordingListener()
+        replayer.add_listener(listener)
+        replayer.start()
+        replayer.join()
+
+        self.assertEqual(replayer.count, 2)
+        self.assertEqual(listener.events[0], ('test.stage', ['step'], 'output'))
+        self.assertEqual([type(e) for e in listener.events[1:]],
+                         [NewRunnerEvent, NewJobEvent])
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import json
+import shutil
+import tempfile
+import unittest
+
 from .helper import SaltTestCase
+from ..config import Config
 from ..stage_parser import SLSParser, SaltRunner, SaltExecutionFunction, \
                            StageRenderingException, SaltState, \
-                           SaltStateFunction, StateRenderingException
+                           SaltStateFunction, StateRenderingException, StageCache
 
 
 class TestStageParser(SaltTestCase):
@@ -480,3 +486,123 @@ error state:
         self.assertIsInstance(ctx.exception.pretty_error_desc_str(), str)
         self.assertIn("No minions matched the target",
                       ctx.exception.pretty_error_desc_str())
+
+    def test_parse_stage_cache(self):
+        self.write_state_file("test.test-orch105", [
+            ('test runner', {
+                'salt.runner': [{
+                    'name': 'jobs.active'
+                }]
+            })
+        ])
+        SLSParser.clean_cache("test.test-orch105")
+        steps, _ = SLSParser.parse_stage("test.test-orch105", False, False)
+        self.assertEqual(steps[0].function, "jobs.active")
+        cached = StageCache.load("test.test-orch105", False, False,
+                                 StageCache.fingerprint())
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached[0][0].function, "jobs.active")
+
+        # any change in the file roots invalidates the entry
+        self.write_state_file("test.test-state105", {
+            'nop state': {
+                'test.nop': []
+            }
+        })
+        self.assertIsNone(StageCache.load("test.test-orch105", False, False,
+                                          StageCache.fingerprint()))
+        SLSParser.clean_cache("test.test-orch105")
+
+
+class TestStageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = Config.STAGE_CACHE_DIR
+        Config.STAGE_CACHE_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(Config.STAGE_CACHE_DIR)
+        Config.STAGE_CACHE_DIR = self.cache_dir
+
+    def test_store_load(self):
+        step = SaltRunner({'__id__': 'test runner', 'name': 'jobs.active',
+                           'state': 'salt', 'fun': 'runner'})
+        StageCache.store("ceph.stage.0", False, True, "abc", [step], "out")
+        steps, out = StageCache.load("ceph.stage.0", False, True, "abc")
+        self.assertEqual(steps[0].desc, "test runner")
+        self.assertEqual(out, "out")
+
+    def test_load_stale(self):
+        StageCache.store("ceph.stage.0", False, True, "abc", [], "")
+        self.assertIsNone(StageCache.load("ceph.stage.0", False, True, "def"))
+
+    def test_load_flags(self):
+        StageCache.store("ceph.stage.0", False, True, "abc", [], "")
+        self.assertIsNone(StageCache.load("ceph.stage.0", True, True, "abc"))
+
+    def test_clean(self):
+        StageCache.store("ceph.stage.0", False, True, "abc", [], "")
+        StageCache.store("ceph.stage.1", False, True, "abc", [], "")
+        StageCache.clean("ceph.stage.0")
+        self.assertIsNone(StageCache.load("ceph.stage.0", False, True, "abc"))
+        self.assertIsNotNone(StageCache.load("ceph.stage.1", False, True, "abc"))
+        StageCache.clean()
+        self.assertIsNone(StageCache.load("ceph.stage.1", False, True, "abc"))
+
+
+class TestStageReorder(unittest.TestCase):
+
+    @staticmethod
+    def _runner(name, **requisites):
+        step_dict = {'__id__': name, 'name': name, 'state': 'salt', 'fun': 'runner'}
+        step_dict.update(requisites)
+        return SaltRunner(step_dict)
+
+    def test_reorder_keeps_stage_order(self):
+        steps = [self._runner("a"), self._runner("b"), self._runner("c")]
+        steps = SLSParser._process_states_requisites("stage", steps)
+        steps = SLSParser._reorder("stage", steps)
+        self.assertEqual([s.desc for s in steps], ["a", "b", "c"])
+
+    def test_reorder_requisites(self):
+        steps = [self._runner("a", require=[{'salt': 'c'}]),
+                 self._runner("b", onfail=['a']),
+                 self._runner("c")]
+        steps = SLSParser._process_states_requisites("stage", steps)
+        steps = SLSParser._reorder("stage", steps)
+        self.assertEqual([s.desc for s in steps], ["c", "a", "b"])
+
+    def test_reorder_cycle(self):
+        steps = [self._runner("a"),
+                 self._runner("b", require=['c']),
+                 self._runner("c", watch=['b'])]
+        steps = SLSParser._process_states_requisites("stage", steps)
+        with self.assertRaises(StageRenderingException) as ctx:
+            SLSParser._reorder("stage", steps)
+        self.assertEqual(ctx.exception.error_list,
+                         ["Recursive requisite found: b -> c -> b"])
+
+    def test_search_step_first_match(self):
+        steps = [self._runner("a"), self._runner("a")]
+        index = SLSParser._index_steps(steps)
+        self.assertIs(SLSParser._search_step(index, None, "a"), steps[0])
+        self.assertIs(SLSParser._search_step(index, "salt", "a"), steps[0])
+        self.assertIsNone(SLSParser._search_step(index, "cmd", "a"))
+
+    def test_dump_load_steps(self):
+        state = SaltState({'__id__': 's', 'name': 's', 'state': 'salt', 'fun': 'state',
+                           'tgt': 'minion*', 'sls': 'test.state'})
+        state.target_expanded = ['minion1']
+        state.steps['minion1'] = [SLSParser.parse_step(
+            {'__id__': 'f', 'name': 'f', 'state': 'file', 'fun': 'managed'}, 'minion1')]
+        steps = [self._runner("a"), state, self._runner("b", require=['a'])]
+        steps = SLSParser._process_states_requisites("stage", steps)
+
+        dumped = json.loads(json.dumps(SLSParser.dump_steps(steps)))
+        loaded = SLSParser.load_steps("stage", dumped)
+        self.assertEqual([type(s) for s in loaded], [SaltRunner, SaltState, SaltRunner])
+        self.assertEqual(loaded[1].target, ['minion1'])
+        self.assertEqual(loaded[1].steps['minion1'][0].target, 'minion1')
+        self.assertEqual(loaded[1].steps['minion1'][0].step_dict,
+                         state.steps['minion1'][0].step_dict)
+        self.assertIs(loaded[2].on_success_deps[0], loaded[0])
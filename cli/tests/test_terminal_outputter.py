@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+
+from mock import patch
+
+from ..monitors.terminal_outputter import Screen, SimplePrinter, StepListPrinter, \
+                                          get_printer
+
+
+class TestScreen(unittest.TestCase):
+
+    def _frame(self, screen, lines):
+        for line in lines:
+            screen.println(line)
+        with patch('sys.stdout') as stdout:
+            screen.flush()
+        return "".join(call[0][0] for call in stdout.write.call_args_list)
+
+    def test_first_frame(self):
+        screen = Screen()
+        out = self._frame(screen, ["a", "b"])
+        self.assertEqual(out, "\r\x1B[Ka\n\r\x1B[Kb\n")
+
+    def test_unchanged_frame(self):
+        screen = Screen()
+        self._frame(screen, ["a", "b"])
+        self.assertEqual(self._frame(screen, ["a", "b"]), "")
+
+    def test_only_changed_lines(self):
+        screen = Screen()
+        self._frame(screen, ["a", "b", "c"])
+        out = self._frame(screen, ["a", "B", "c", "d"])
+        self.assertEqual(out, "\x1B[2A\r\x1B[KB\n\n\r\x1B[Kd\n")
+
+    def test_shorter_frame(self):
+        screen = Screen()
+        self._frame(screen, ["a", "b", "c"])
+        out = self._frame(screen, ["a"])
+        self.assertEqual(out, "\x1B[2A\x1B[J")
+
+    def test_commit(self):
+        screen = Screen()
+        self._frame(screen, ["a"])
+        screen.commit()
+        self.assertEqual(self._frame(screen, ["a"]), "\r\x1B[Ka\n")
+
+
+class TestGetPrinter(unittest.TestCase):
+
+    @patch('sys.stdout')
+    def test_tty(self, stdout):
+        stdout.isatty.return_value = True
+        self.assertIsInstance(get_printer(False), StepListPrinter)
+        self.assertIsInstance(get_printer(True), SimplePrinter)
+
+    @patch('sys.stdout')
+    def test_not_tty(self, stdout):
+        stdout.isatty.return_value = False
+        self.assertIsInstance(get_printer(False), SimplePrinter)
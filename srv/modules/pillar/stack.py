@@ -197,6 +197,29 @@ So PillarStack ``ext_pillar`` returns the ``stack`` dict, the contents of which
 Salt takes care to merge in with all of the other pillars and finally return
 the whole pillar to the minion.
 
+Caching
+-------
+
+The compiled templates and the parsed ``yaml`` files are cached by each salt
+master process, and reloaded when a file changes its inode, mtime or size, so
+refreshing the pillar of many minions only compiles and parses each distinct
+file once.  Because compiled templates are shared between minions, the
+variables above are passed when rendering and not as Jinja2 globals: a
+template imported from a PillarStack file must be imported ``with context`` to
+use them.
+
+Minions whose files render the same text, in the same order, also share the
+merged result of those files: only the files rendering differently, like
+``minions/{{ minion_id }}.yml``, are parsed and merged for each minion.
+
+Profiling
+---------
+
+Setting ``deepsea_stack_profile: True`` in the master configuration records
+the time spent rendering, parsing and merging each file.  A summary is logged
+for every minion, and the ``deepsea_stack_profile_top`` (10 by default)
+slowest files are written to ``<cachedir>/deepsea/stack_profile/<minion>.json``.
+
 Merging strategies
 ------------------
 
@@ -363,8 +386,14 @@ You can also select a custom merging strategy using a ``__`` object in a list:
 '''
 
 from __future__ import absolute_import
+import copy
+import hashlib
+import json
 import os
 import logging
+import sys
+import time
+import types
 from functools import partial
 
 import yaml
@@ -375,15 +404,224 @@ import six
 log = logging.getLogger(__name__)
 strategies = ('overwrite', 'merge-first', 'merge-last', 'remove')
 
+# The salt loader executes this module again for every pillar compilation, so
+# the caches live in a holder module registered once per process.
+_CACHE_MODULE = 'deepsea_pillar_stack_cache'
+# Distinct renderings of a single yaml file kept in the parse cache
+_PARSED_PER_FILE = 1024
+# Signatures and merged stacks kept to be shared between minions
+_SHARED_STACKS = 4096
+
+
+def _stat_key(filename):
+    st = os.stat(filename)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class _StackLoader(FileSystemLoader):
+    '''
+    FileSystemLoader whose templates stay up to date as long as the file keeps
+    its inode, mtime and size
+    '''
+    def get_source(self, environment, template):
+        contents, filename, _ = super(_StackLoader, self).get_source(
+            environment, template)
+        key = _stat_key(filename)
+
+        def uptodate():
+            try:
+                return _stat_key(filename) == key
+            except OSError:
+                return False
+        return contents, filename, uptodate
+
+
+def _process_cache():
+    '''
+    Returns the process-wide cache of jinja environments (and thus compiled
+    templates) by base directory, of parsed yaml by file and of the stacks
+    shared between minions
+    '''
+    cache = sys.modules.get(_CACHE_MODULE)
+    if cache is None:
+        cache = types.ModuleType(_CACHE_MODULE)
+        cache.environments = {}
+        cache.parsed = {}
+        cache.signatures = {}
+        cache.shared_stacks = {}
+        sys.modules[_CACHE_MODULE] = cache
+    return cache
+
+
+def _environment(basedir):
+    cache = _process_cache()
+    jenv = cache.environments.get(basedir)
+    if jenv is None:
+        jenv = Environment(loader=_StackLoader(basedir), cache_size=-1,
+                           auto_reload=True)
+        cache.environments[basedir] = jenv
+    return jenv
+
+
+def _load_yaml(filename, content, digest):
+    '''
+    Parses the rendered content of a yaml file.  Files rendering the same text
+    are parsed once, and all the callers get the same object, which must not
+    be modified.
+    '''
+    cache = _process_cache()
+    key = _stat_key(filename)
+    entry = cache.parsed.get(filename)
+    if entry is None or entry[0] != key or len(entry[1]) >= _PARSED_PER_FILE:
+        entry = (key, {})
+        cache.parsed[filename] = entry
+    if digest not in entry[1]:
+        entry[1][digest] = yaml.safe_load(content)
+    return entry[1][digest]
+
+
+class _Stack(object):
+    '''
+    The stack being merged for a minion, and the signature of the rendered
+    files merged into it so far.  Minions whose files render the same text in
+    the same order get the same signature, and share the merged stack: the
+    first time a signature is seen for a second minion, the stack is kept as a
+    snapshot that the following minions reuse instead of parsing and merging
+    those files.  Stacks only ever reached by one minion, like its complete
+    stack on every pillar refresh, are not kept.  Merging never modifies its
+    inputs, so the snapshots and the parsed files are shared as they are.
+    '''
+    def __init__(self, data=None, profile=None, minion_id=None):
+        # an initial stack given by the caller can't be shared
+        self.signature = hashlib.sha1().hexdigest() if not data else None
+        self.data = data or {}
+        self.profile = profile
+        self.minion_id = minion_id
+
+    def render(self, template, variables):
+        '''
+        Renders a stack config or yaml file and returns the text and its digest
+        '''
+        start = time.time()
+        content = template.render(stack=self.data, **variables)
+        if self.profile:
+            entry = self.profile.file(template.filename)
+            entry['render'] += time.time() - start
+            entry['bytes'] = len(content)
+        return content, hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def merge(self, template, content, digest):
+        '''
+        Merges the rendered yaml file into the stack.  Returns False if the
+        file does not contain a yaml dictionary.
+        '''
+        cache = _process_cache()
+        signature = None
+        if self.signature is not None:
+            signature = hashlib.sha1("{}\0{}\0{}".format(
+                self.signature, template.filename, digest).encode('utf-8')).hexdigest()
+            if signature in cache.shared_stacks:
+                self.data = cache.shared_stacks[signature]
+                self.signature = signature
+                if self.profile:
+                    self.profile.file(template.filename)['shared'] = True
+                return True
+
+        start = time.time()
+        obj = _load_yaml(template.filename, content, digest)
+        log.debug('obj: %s', obj)
+        if not isinstance(obj, dict):
+            return False
+        parsed = time.time()
+        self.data = _merge_dict(self.data, obj)
+        self.signature = signature
+        if self.profile:
+            entry = self.profile.file(template.filename)
+            entry['parse'] += parsed - start
+            entry['merge'] += time.time() - parsed
+            entry['keys'] = len(obj)
+        if signature is not None:
+            first_minion = cache.signatures.get(signature)
+            if first_minion is None:
+                if len(cache.signatures) >= _SHARED_STACKS:
+                    cache.signatures.clear()
+                cache.signatures[signature] = self.minion_id
+            elif first_minion != self.minion_id:
+                if len(cache.shared_stacks) >= _SHARED_STACKS:
+                    cache.shared_stacks.clear()
+                cache.shared_stacks[signature] = self.data
+        return True
+
+    def private(self):
+        '''
+        Returns a copy of the merged stack that shares nothing with the caches
+        or other minions
+        '''
+        return copy.deepcopy(self.data)
+
+
+class _Profile(object):
+    '''
+    Time spent rendering, parsing and merging each file of a minion's stack,
+    with the size of the rendered text and the number of top level keys
+    '''
+    def __init__(self, minion_id):
+        self.minion_id = minion_id
+        self.files = {}
+
+    def file(self, filename):
+        entry = self.files.get(filename)
+        if entry is None:
+            entry = {'file': filename, 'render': 0.0, 'parse': 0.0, 'merge': 0.0,
+                     'bytes': 0, 'keys': 0, 'shared': False}
+            self.files[filename] = entry
+        return entry
+
+    def slowest(self, count):
+        return sorted(self.files.values(),
+                      key=lambda e: e['render'] + e['parse'] + e['merge'],
+                      reverse=True)[:count]
+
+    def report(self, count, directory):
+        '''
+        Logs a summary of the profile, and dumps the slowest files to
+        <directory>/<minion_id>.json
+        '''
+        slowest = self.slowest(count)
+        totals = dict((step, sum(e[step] for e in self.files.values()))
+                      for step in ('render', 'parse', 'merge'))
+        log.info('PillarStack profile of %s: %d files, render %.3fs, parse %.3fs, '
+                 'merge %.3fs, slowest: %s', self.minion_id, len(self.files),
+                 totals['render'], totals['parse'], totals['merge'],
+                 ', '.join('{0} ({1:.3f}s)'.format(
+                     e['file'], e['render'] + e['parse'] + e['merge'])
+                           for e in slowest[:3]))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            filename = os.path.join(directory, '{0}.json'.format(self.minion_id))
+            with open(filename + '.tmp', 'w') as dump:
+                json.dump({'minion_id': self.minion_id, 'totals': totals,
+                           'files': slowest}, dump, indent=2)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            log.warning('Cannot dump pillar stack profile: {0}'.format(e))
+
 
 def ext_pillar(minion_id, pillar, *args, **kwargs):
-    import salt.utils
-    stack = {}
+    try:
+        from salt.utils.data import traverse_dict_and_list
+    except ImportError:
+        from salt.utils import traverse_dict_and_list
+    profile = None
+    if __opts__.get('deepsea_stack_profile', False):
+        profile = _Profile(minion_id)
+    stack = _Stack(profile=profile, minion_id=minion_id)
     stack_config_files = list(args)
     traverse = {
-        'pillar': partial(salt.utils.traverse_dict_and_list, pillar),
-        'grains': partial(salt.utils.traverse_dict_and_list, __grains__),
-        'opts': partial(salt.utils.traverse_dict_and_list, __opts__),
+        'pillar': partial(traverse_dict_and_list, pillar),
+        'grains': partial(traverse_dict_and_list, __grains__),
+        'opts': partial(traverse_dict_and_list, __opts__),
         }
     for matcher, matchs in six.iteritems(kwargs):
         t, matcher = matcher.split(':', 1)
@@ -399,33 +637,43 @@ def ext_pillar(minion_id, pillar, *args, **kwargs):
             log.warning('Ignoring pillar stack cfg "{0}": '
                      'file does not exist'.format(cfg))
             continue
-        stack = _process_stack_cfg(cfg, stack, minion_id, pillar)
-    return stack
+        _merge_stack_cfg(cfg, stack, minion_id, pillar)
+    if profile:
+        profile.report(__opts__.get('deepsea_stack_profile_top', 10),
+                       os.path.join(__opts__['cachedir'], 'deepsea', 'stack_profile'))
+    return stack.private()
 
 
 def _process_stack_cfg(cfg, stack, minion_id, pillar):
-    log.debug('Config: {0}'.format(cfg))
+    stack = _Stack(stack, minion_id=minion_id)
+    _merge_stack_cfg(cfg, stack, minion_id, pillar)
+    return stack.private()
+
+
+def _merge_stack_cfg(cfg, stack, minion_id, pillar):
+    log.debug('Config: %s', cfg)
     basedir, filename = os.path.split(cfg)
-    jenv = Environment(loader=FileSystemLoader(basedir))
-    jenv.globals.update({
+    jenv = _environment(basedir)
+    # the compiled templates are shared between minions, so the minion
+    # specific variables are passed on rendering instead of as globals
+    variables = {
         "__opts__": __opts__,
         "__salt__": __salt__,
         "__grains__": __grains__,
         "minion_id": minion_id,
         "pillar": pillar,
-        })
-    for path in _parse_stack_cfg(jenv.get_template(filename).render(stack=stack)):
+        }
+    content, _ = stack.render(jenv.get_template(filename), variables)
+    for path in _parse_stack_cfg(content):
         try:
-            log.debug('YAML: basedir={0}, path={1}'.format(basedir, path))
-            obj = yaml.safe_load(jenv.get_template(path).render(stack=stack))
-            log.debug('obj: {0}'.format(obj))
-            
-            if not isinstance(obj, dict):
+            log.debug('YAML: basedir=%s, path=%s', basedir, path)
+            template = jenv.get_template(path)
+            content, digest = stack.render(template, variables)
+            if not stack.merge(template, content, digest):
                 log.info('Ignoring pillar stack template "{0}": Can\'t parse '
                          'as a valid yaml dictionary'.format(path))
                 continue
-            stack = _merge_dict(stack, obj)
-            log.debug('stack: {0}'.format(stack))
+            log.debug('stack: %s', stack.data)
         except TemplateNotFound as e:
             if hasattr(e, 'name') and e.name != path:
                 log.info('Jinja include file "{0}" not found '
@@ -436,30 +684,53 @@ def _process_stack_cfg(cfg, stack, minion_id, pillar):
                 log.info('Ignoring pillar stack template "{0}": can\'t find from '
                          'root dir "{1}"'.format(path, basedir))
             continue
-    return stack
 
 
 def _cleanup(obj):
+    '''
+    Returns obj without the merging strategy markers.  Only the dicts and
+    lists that contain a marker are copied, obj is not modified.
+    '''
     if obj:
         if isinstance(obj, dict):
-            obj.pop('__', None)
+            cleaned = None
             for k, v in six.iteritems(obj):
-                obj[k] = _cleanup(v)
+                if k == '__':
+                    continue
+                cleaned_v = _cleanup(v)
+                if cleaned_v is not v:
+                    if cleaned is None:
+                        cleaned = dict(obj)
+                    cleaned[k] = cleaned_v
+            if '__' in obj:
+                if cleaned is None:
+                    cleaned = dict(obj)
+                del cleaned['__']
+            if cleaned is not None:
+                return cleaned
         elif isinstance(obj, list) and isinstance(obj[0], dict) \
                 and '__' in obj[0]:
-            del obj[0]
+            return obj[1:]
     return obj
 
 
 def _merge_dict(stack, obj):
-    strategy = obj.pop('__', 'merge-last')
+    '''
+    Returns the merge of obj into stack.  Neither stack nor obj are modified:
+    the dicts along the merged keys are copied, and the result shares every
+    other value with its inputs.
+    '''
+    strategy = obj.get('__', 'merge-last')
     if strategy not in strategies:
         raise Exception('Unknown strategy "{0}", should be one of {1}'.format(
             strategy, strategies))
     if strategy == 'overwrite':
         return _cleanup(obj)
     else:
+        stack = dict(stack)
         for k, v in six.iteritems(obj):
+            if k == '__':
+                continue
             if strategy == 'remove':
                 stack.pop(k, None)
                 continue
@@ -472,7 +743,7 @@ def _merge_dict(stack, obj):
                     v = stack_k
                 if type(stack[k]) != type(v):
                     log.debug('Force overwrite, types differ: '
-                              '\'{0}\' != \'{1}\''.format(stack[k], v))
+                              '\'%s\' != \'%s\'', stack[k], v)
                     stack[k] = _cleanup(v)
                 elif isinstance(v, dict):
                     stack[k] = _merge_dict(stack[k], v)
@@ -486,10 +757,13 @@ def _merge_dict(stack, obj):
 
 
 def _merge_list(stack, obj):
+    '''
+    Returns the merge of obj into stack, without modifying them
+    '''
     strategy = 'merge-last'
     if obj and isinstance(obj[0], dict) and '__' in obj[0]:
         strategy = obj[0]['__']
-        del obj[0]
+        obj = obj[1:]
     if strategy not in strategies:
         raise Exception('Unknown strategy "{0}", should be one of {1}'.format(
             strategy, strategies))
@@ -9,15 +9,28 @@ locked".  Increasing timeouts, moving the database to tmpfs or adding retry
 logic is moving the problem.
 
 This runner will rely on file existence, creation and removal.  If a system
-is loaded, operations will block but eventually complete.
+is loaded, operations will block but eventually complete.  Operations on a
+queue are serialized with an flock, set lock_timeout=<seconds> to give up
+waiting.
+
+With backend=journal, a queue is kept in an append-only journal instead of
+one file per item, see JournalQueue.
 """
 
 from __future__ import absolute_import
 from __future__ import print_function
+import errno
+import fcntl
 import time
 import logging
 import os
 import glob
+import collections
+import json
+import socket
+import sys
+import types
+import uuid
 
 import salt.loader
 import salt.utils.event
@@ -25,6 +38,10 @@ import salt.ext.six as six
 
 log = logging.getLogger(__name__)
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_CACHE_MODULE = 'deepsea_filequeue_cache'
+
 
 class FileQueue(object):
     """
@@ -102,11 +119,37 @@ class FileQueue(object):
         files = [mtime[k] for k in sorted(mtime.keys())]
         return files
 
+    def _ls(self):
+        """
+        List items in any order
+        """
+        return self.ls()
+
+    def oldest(self):
+        """
+        Return the first item
+        """
+        return self.items()[0]
+
+    def newest(self):
+        """
+        Return the last item
+        """
+        return self.items()[-1]
+
+    def _exists(self, item):
+        return os.path.isfile("{}/{}".format(self.queue_dir, item))
+
+    def _delete(self, item):
+        filename = "{}/{}".format(self.queue_dir, item)
+        log.debug("removing {}".format(filename))
+        os.remove(filename)
+
     def empty(self):
         """
         Check if no files are present
         """
-        files = self.ls()
+        files = self._ls()
         if files:
             log.debug("queue {} contains {}".format(self.queue_dir, files))
             self._fire_event(False, ["populated"])
@@ -120,10 +163,8 @@ class FileQueue(object):
         """
         Remove file
         """
-        filename = "{}/{}".format(self.queue_dir, item)
-        if os.path.isfile(filename):
-            log.debug("removing {}".format(filename))
-            os.remove(filename)
+        if self._exists(item):
+            self._delete(item)
             self._fire_event(True, [item, "remove"])
             return True
         self._fire_event(False, [item, "absent"])
@@ -136,13 +177,11 @@ class FileQueue(object):
         Note: Timing in Salt events creates race conditions if remove and empty
         are called separately from the same reactor file.
         """
-        files = self.ls()
+        files = self._ls()
         log.debug("queue {} contains {}".format(self.queue_dir, files))
-        filename = "{}/{}".format(self.queue_dir, item)
 
-        if os.path.isfile(filename):
-            log.debug("deleting {}".format(filename))
-            os.remove(filename)
+        if self._exists(item):
+            self._delete(item)
 
         if len(files) == 1:
             if files[0] == item:
@@ -154,20 +193,19 @@ class FileQueue(object):
                 self._fire_event(False, ["occupied"])
                 return False
         else:
-            log.debug("filename {} does not exist".format(filename))
+            log.debug("item {} does not exist in {}".format(item, self.queue_dir))
             return None
 
     def check(self, item):
         """
         Return whether the file exists
         """
-        filename = "{}/{}".format(self.queue_dir, item)
-        ret = os.path.isfile(filename)
+        ret = self._exists(item)
         if ret:
-            log.info("file {} exists".format(filename))
+            log.info("item {} exists in {}".format(item, self.queue_dir))
             self._fire_event(True, [item, "exists"])
         else:
-            log.info("file {} is missing".format(filename))
+            log.info("item {} is missing from {}".format(item, self.queue_dir))
             self._fire_event(False, [item, "missing"])
         return ret
 
@@ -192,36 +230,334 @@ class FileQueue(object):
             event.fire_event(settings, "/".join(tags))
 
 
+def _journal_cache():
+    """
+    Returns the process-wide cache of journal indexes by journal path.  Salt
+    reloads runner modules, so the cache lives in its own module.
+    """
+    cache = sys.modules.get(_CACHE_MODULE)
+    if cache is None:
+        cache = types.ModuleType(_CACHE_MODULE)
+        cache.journals = {}
+        sys.modules[_CACHE_MODULE] = cache
+    return cache
+
+
+class JournalIndex(object):
+    """
+    In memory index of a journal: the items in FIFO order, the inode and
+    generation of the journal, the offset up to which it was replayed and the
+    number of records
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.inode = None
+        self.generation = None
+        self.offset = 0
+        self.records = 0
+
+    def apply(self, operation, item):
+        """
+        Apply a journal record.  Adding an item again moves it to the end,
+        as touching a file updates its mtime.  The header record carries the
+        generation.
+        """
+        if operation == "=":
+            self.generation = item
+            return
+        self.records += 1
+        if operation == "+":
+            self.entries.pop(item, None)
+            self.entries[item] = True
+        elif operation == "-":
+            self.entries.pop(item, None)
+
+
+class JournalQueue(FileQueue):
+    """
+    Keep the queue in an append-only journal, {root_dir}/.{queue}.journal, next
+    to the queue directory so it is never listed as an item, with one
+    JSON record per line: ["+", item] when added, ["-", item] when removed.
+    The journal is replayed into an ordered index kept between calls, only
+    the records appended since the previous call are read.  Operations are
+    constant time and items keep their insertion order, even when added
+    within the same mtime tick.
+
+    A torn last record, from a crash while appending, is ignored and
+    truncated by the next append.  Once removed records outnumber live items
+    the journal is compacted into a new file, synced and renamed over the
+    old one.  Each journal starts with a ["=", generation] header, so that a
+    cached index is not resumed on a newer journal that reused the inode.
+    """
+
+    def __init__(self, **kwargs):
+        super(JournalQueue, self).__init__(**kwargs)
+        self.journal = "{}/.{}.journal".format(self.root_dir, self.settings['queue'])
+
+    @property
+    def index(self):
+        """
+        Bring the cached index up to date with the journal.  Only read under
+        the queue Lock.
+        """
+        cache = _journal_cache().journals
+        index = cache.get(self.journal)
+        try:
+            stat = os.stat(self.journal)
+        except OSError:
+            cache[self.journal] = JournalIndex()
+            return cache[self.journal]
+        if (index is None or index.inode != stat.st_ino or stat.st_size < index.offset or
+                self._generation() != index.generation):
+            index = JournalIndex()
+            index.inode = stat.st_ino
+        if stat.st_size > index.offset:
+            with open(self.journal, "rb") as journal:
+                journal.seek(index.offset)
+                data = journal.read()
+            # skip a torn record
+            complete = data.rfind(b"\n") + 1
+            for line in data[:complete].splitlines():
+                try:
+                    operation, item = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    log.warning("skipping corrupt record in {}".format(self.journal))
+                    continue
+                index.apply(operation, item)
+            index.offset += complete
+        cache[self.journal] = index
+        return index
+
+    def _generation(self):
+        """
+        Return the generation in the header of the journal, None without one
+        """
+        try:
+            with open(self.journal, "rb") as journal:
+                operation, generation = json.loads(journal.readline().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        return generation if operation == "=" else None
+
+    @staticmethod
+    def _header(index):
+        """
+        Start a new generation, returns its header record
+        """
+        index.generation = uuid.uuid4().hex
+        return json.dumps(["=", index.generation]) + "\n"
+
+    def _append(self, operation, item):
+        """
+        Append a record to the journal and apply it to the index
+        """
+        index = self.index
+        record = json.dumps([operation, item]) + "\n"
+        with open(self.journal, "ab") as journal:
+            if journal.tell() != index.offset:
+                journal.truncate(index.offset)
+                journal.seek(index.offset)
+            if index.offset == 0:
+                record = self._header(index) + record
+            journal.write(record.encode('utf-8'))
+            journal.flush()
+            index.inode = os.fstat(journal.fileno()).st_ino
+            index.offset = journal.tell()
+        index.apply(operation, item)
+        self._compact(index)
+
+    def _compact(self, index):
+        """
+        Rewrite the journal with the live items once it is mostly removals
+        """
+        if index.records < 1024 or index.records < 2 * len(index.entries):
+            return
+        log.debug("compacting {}".format(self.journal))
+        tmp = "{}.{}".format(self.journal, os.getpid())
+        with open(tmp, "wb") as journal:
+            journal.write(self._header(index).encode('utf-8'))
+            for item in index.entries:
+                journal.write((json.dumps(["+", item]) + "\n").encode('utf-8'))
+            journal.flush()
+            os.fsync(journal.fileno())
+            index.offset = journal.tell()
+            index.inode = os.fstat(journal.fileno()).st_ino
+        os.rename(tmp, self.journal)
+        index.records = len(index.entries)
+
+    def touch(self, item):
+        """
+        Append or move item to the end.  Return based on duplicate_fail.
+        """
+        ret = item in self.index.entries
+        self._append("+", item)
+
+        if (ret and 'duplicate_fail' in self.settings and
+            self.settings['duplicate_fail']):
+            self._fire_event(False, [item, "present"])
+            return False
+        self._fire_event(True, [item, "added"])
+        return True
+
+    # pylint: disable=invalid-name
+    def ls(self):
+        """
+        List items in alpha-numeric order
+        """
+        return sorted(self.index.entries)
+
+    def items(self):
+        """
+        List items in insertion order
+        """
+        return list(self.index.entries)
+
+    def _ls(self):
+        return list(self.index.entries)
+
+    def oldest(self):
+        """
+        Return the first item, IndexError when empty like FileQueue
+        """
+        entries = self.index.entries
+        if not entries:
+            raise IndexError("queue is empty")
+        return next(iter(entries))
+
+    def newest(self):
+        """
+        Return the last item, IndexError when empty like FileQueue
+        """
+        entries = self.index.entries
+        if not entries:
+            raise IndexError("queue is empty")
+        return next(reversed(entries))
+
+    def _exists(self, item):
+        return item in self.index.entries
+
+    def _delete(self, item):
+        self._append("-", item)
+
+
+class LockTimeout(Exception):
+    """
+    The queue lock could not be acquired within lock_timeout seconds
+    """
+    pass
+
+
 class Lock(object):
     """
-    Serialize operations on queue
+    Serialize operations on queue.  The lock is an flock on the lockfile, held
+    by the kernel: waiters sleep until it is released and a lock held by a
+    crashed process is released with its file descriptor.
+
+    The holder writes its pid and hostname in the lockfile.  The wait time,
+    whether the lock was contended and the holder seen while waiting are kept
+    in settings['lock'], which is included in the fired events.
     """
 
     def __init__(self, settings):
         """
         Derive lockfile from settings
         """
-        self.lockfile = "{}/.{}.lock".format(settings['root_dir'], settings['queue'])
+        # .{queue}.lock is the symlink semaphore of previous versions, leave
+        # it to them
+        self.lockfile = "{}/.{}.flock".format(settings['root_dir'], settings['queue'])
+        self.settings = settings
+        self.timeout = settings.get('lock_timeout')
+        if self.timeout is not None:
+            self.timeout = float(self.timeout)
+        self.handle = None
         log.info("locking {}".format(self.lockfile))
 
-    def __enter__(self):
+    def _holder(self):
+        """
+        Returns the pid and hostname written by the current holder
         """
-        Symlink makes a cheap semaphore
+        self.handle.seek(0)
+        return self.handle.read().strip() or None
+
+    def _wait(self):
         """
+        Blocks until the lock is acquired or the timeout expires.  Without a
+        timeout, the kernel wakes us up on release.  With a timeout, retry with
+        an exponential backoff since flock has no timed variant.
+        """
+        if self.timeout is None:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+            return
+        deadline = _monotonic() + self.timeout
+        delay = .001
         while True:
             try:
-                os.symlink("/dev/null", self.lockfile)
-                break
-            except OSError:
-                log.debug("{} locked".format(self.lockfile))
-            time.sleep(.2)
+                fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                raise LockTimeout("timed out after {}s waiting for {} held by {}".format(
+                                  self.timeout, self.lockfile, self._holder()))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, .05)
+
+    def __enter__(self):
+        """
+        Acquire the flock, recording the contention
+        """
+        self.handle = open(self.lockfile, "a+")
+        start = _monotonic()
+        holder = None
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                self.handle.close()
+                raise
+            holder = self._holder()
+            log.debug("{} locked by {}".format(self.lockfile, holder))
+            try:
+                self._wait()
+            except Exception:
+                self.handle.close()
+                raise
+        wait = _monotonic() - start
+
+        self.handle.seek(0)
+        self.handle.truncate()
+        self.handle.write("{} {}\n".format(os.getpid(), socket.gethostname()))
+        self.handle.flush()
+        self.settings['lock'] = {'wait': round(wait, 6),
+                                 'contended': holder is not None,
+                                 'holder': holder}
+        if holder is not None:
+            log.info("waited {:.3f}s for {} held by {}".format(wait, self.lockfile, holder))
         return
 
     def __exit__(self, type_, value, traceback):
         """
-        Remove symlink
+        Release the flock.  The lockfile is kept, removing it would let a
+        waiter lock an unlinked file.
         """
-        os.remove(self.lockfile)
+        self.handle.seek(0)
+        self.handle.truncate()
+        self.handle.flush()
+        fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+
+def _queue(**kwargs):
+    """
+    Return the queue of the requested backend, files by default
+    """
+    if kwargs.get('backend', 'files') == 'journal':
+        return JournalQueue(**kwargs)
+    return FileQueue(**kwargs)
 
 
 def _skip_dunder(settings):
@@ -301,7 +637,11 @@ def help_():
              '    CLI Example:\n\n'
              '        salt-run filequeue.vacant abc\n'
              '        salt-run filequeue.vacant abc queue=prep\n'
-             '        salt-run filequeue.vacant item=abc queue=prep\n')
+             '        salt-run filequeue.vacant item=abc queue=prep\n'
+             '\n\n'
+             'All commands accept lock_timeout=<seconds> to limit the wait\n'
+             'on the queue lock and backend=journal to keep the queue in an\n'
+             'append-only journal instead of a file per item.\n')
     print(usage)
     return ""
 
@@ -311,7 +651,7 @@ def queues(**kwargs):
     List queues
     """
     log.debug("queues: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         return "\n".join(filequeue.dirs())
 
@@ -321,7 +661,7 @@ def enqueue(queue=None, **kwargs):
     Add item
     """
     log.debug("enqueue: queue = {}, kwargs = {}".format(queue, _skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         if queue:
             ret = filequeue.touch(queue)
@@ -353,9 +693,9 @@ def dequeue(**kwargs):
     Remove oldest item
     """
     log.debug("dequeue: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
-        oldest = list(filequeue.items())[0]
+        oldest = filequeue.oldest()
         filequeue.remove(oldest)
     return oldest
 
@@ -365,9 +705,9 @@ def pop(**kwargs):
     Remove newest item
     """
     log.debug("pop: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
-        newest = list(filequeue.items())[-1]
+        newest = filequeue.newest()
         filequeue.remove(newest)
     return newest
 
@@ -378,7 +718,7 @@ def ls(**kwargs):
     List items
     """
     log.debug("ls: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         return "\n".join(filequeue.ls())
 
@@ -388,7 +728,7 @@ def items(**kwargs):
     List items in time order
     """
     log.debug("items: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         return "\n".join(list(filequeue.items()))
 
@@ -398,7 +738,7 @@ def empty(**kwargs):
     Check if queue is empty
     """
     log.debug("empty: kwargs = {}".format(_skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         return filequeue.empty()
 
@@ -408,7 +748,7 @@ def check(queue=None, **kwargs):
     Check if item exists
     """
     log.debug("check: queue = {}, kwargs = {}".format(queue, _skip_dunder(kwargs)))
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         if queue:
             return filequeue.check(queue)
@@ -425,7 +765,7 @@ def remove(queue=None, **kwargs):
     """
     log.debug("remove: queue = {}, kwargs = {}".format(queue, _skip_dunder(kwargs)))
 
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         if queue:
             return filequeue.remove(queue)
@@ -442,7 +782,7 @@ def vacate(queue=None, **kwargs):
     """
     log.debug("vacate: queue = {}, kwargs = {}".format(queue, _skip_dunder(kwargs)))
 
-    filequeue = FileQueue(**kwargs)
+    filequeue = _queue(**kwargs)
     with Lock(filequeue.settings):
         if queue:
             return filequeue.vacate(queue)
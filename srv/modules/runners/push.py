@@ -39,7 +39,10 @@ Customization:
     desired values in /srv/pillar/ceph/stack directory tree and likely
     unnecessary.  This will still work and may prove useful for some.
 
-All files are overwritten in the destination tree /srv/pillar/ceph/stack/default.sls
+All files are written in the destination tree /srv/pillar/ceph/stack/default.
+A manifest of the source files of each output file is kept, so that outputs
+whose sources did not change are not written again, and only the files of
+stack/default that are no longer part of the policy are removed.
 
 """
 
@@ -47,10 +50,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 import os
 import errno
-import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import re
-import shutil
 import sys
 import yaml
 sys.path.append('/srv/modules/pillar')
@@ -60,6 +64,18 @@ from stack import _merge_dict
 
 log = logging.getLogger(__name__)
 
+# Use the libyaml bindings when available
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class _FriendlyDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """
+    Keep yaml human readable/editable
+    """
+    # pylint: disable=unused-argument
+    def ignore_aliases(self, data):
+        return True
+
 
 def help_():
     """
@@ -67,22 +83,33 @@ def help_():
     """
     usage = ('salt-run push.proposal:\n\n'
              '    Reads the policy.cfg and generates the Salt configuration\n'
+             '\n'
+             'salt-run push.proposal workers=4:\n\n'
+             '    Merges the files in 4 worker processes\n'
              '\n\n')
     print(usage)
     return ""
 
 
-def proposal(filename="/srv/pillar/ceph/proposals/policy.cfg", dryrun=False):
+def proposal(filename="/srv/pillar/ceph/proposals/policy.cfg", dryrun=False, workers=1):
     """
     Read the passed filename, organize the files with common subdirectories
-    and output the merged contents into the pillar.
+    and output the merged contents into the pillar.  With more than one
+    worker, the output files are merged by a pool of processes.
     """
     if not os.path.isfile(filename):
         log.warning("{} is missing - nothing to push".format(filename))
         return True
-    pillar_data = PillarData(dryrun)
+    pillar_data = PillarData(dryrun, int(workers))
     common = pillar_data.organize(filename)
     pillar_data.output(common)
+    log.info("push.proposal: {} added, {} changed, {} unchanged, {} removed".format(
+        len(pillar_data.changes['added']), len(pillar_data.changes['changed']),
+        len(pillar_data.changes['unchanged']), len(pillar_data.changes['removed'])))
+    for change in ['added', 'changed', 'removed']:
+        if pillar_data.changes[change]:
+            log.info("push.proposal {}: {}".format(
+                change, ", ".join(sorted(pillar_data.changes[change]))))
     return True
 
 
@@ -98,6 +125,42 @@ def organize(filename="/srv/pillar/ceph/proposals/policy.cfg"):
     return common
 
 
+def _hash_file(filename):
+    """
+    Returns the sha256 of a file, or None if it does not exist
+    """
+    try:
+        with open(filename, "rb") as content:
+            return hashlib.sha256(content.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def _hash_sources(filenames):
+    """
+    Returns a digest of the names and contents of the files merged into an
+    output file
+    """
+    digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update(filename.encode('utf-8'))
+        digest.update(b'\0')
+        with open(filename, "rb") as content:
+            digest.update(hashlib.sha256(content.read()).digest())
+    return digest.hexdigest()
+
+
+def _write_atomic(filename, text):
+    """
+    Writes the file through a temporary file renamed over it, so readers
+    never see a partially written file
+    """
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "w") as tmp:
+        tmp.write(text)
+    os.rename(tmp_filename, filename)
+
+
 def _create_dirs(path, root):
     """
     Verbose mkdir
@@ -120,38 +183,59 @@ class PillarData(object):
     tree.
     """
 
-    def __init__(self, dryrun=False):
+    def __init__(self, dryrun=False, workers=1):
         """
         The source is proposals_dir and the destination is pillar_dir
         """
         self.proposals_dir = "/srv/pillar/ceph/proposals"
         self.pillar_dir = "/srv/pillar/ceph"
+        self.manifest_file = "{}/.push_manifest.json".format(self.pillar_dir)
         self.dryrun = dryrun
-
-        # Keep yaml human readable/editable
-        self.friendly_dumper = yaml.SafeDumper
-        self.friendly_dumper.ignore_aliases = lambda self, data: True
+        self.workers = workers
+        self.changes = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
 
     def output(self, common):
         """
         Write the merged YAML files to the correct locations,
         /srv/pillar/ceph/cluster and /srv/pillar/ceph/stack/default.
+        Outputs whose sources and contents match the manifest are skipped.
         """
+        manifest = self._load_manifest()
+        new_manifest = {}
 
-        self._clean()
+        stale = []
+        for pathname in common.keys():
+            filename = self.pillar_dir + "/" + pathname
+            sources = _hash_sources(common[pathname])
+            entry = manifest.get(filename)
+            if (entry and entry.get('sources') == sources and
+                    entry.get('output') == _hash_file(filename)):
+                log.debug("Unchanged {}".format(filename))
+                self.changes['unchanged'].append(filename)
+                new_manifest[filename] = entry
+            else:
+                new_manifest[filename] = {'sources': sources}
+                stale.append(pathname)
+        merged_files = self._merge_all(stale, common)
 
         for pathname in common.keys():
-            merged = _merge(pathname, common)
             filename = self.pillar_dir + "/" + pathname
-            self._default(filename, merged)
+            entry = new_manifest[filename]
+            if pathname in merged_files:
+                text, cluster = merged_files[pathname]
+                change = 'changed' if os.path.exists(filename) else 'added'
+                entry['output'] = self._default(filename, text)
+                if pathname.startswith("cluster"):
+                    entry['cluster'] = cluster
+                self.changes[change].append(filename)
 
             if pathname.startswith("cluster"):
                 # Use the entire list of minions under cluster to populate
                 # stack/{cluster_name}/minions.  Skip unassigned.
-                if merged['cluster'] != "unassigned":
+                if entry['cluster'] != "unassigned":
                     newpath = re.sub(r'sls', 'yml', pathname)
                     relative = re.sub(r'cluster',
-                                      "stack/{}/minions".format(merged['cluster']), newpath)
+                                      "stack/{}/minions".format(entry['cluster']), newpath)
                     custom = (self.pillar_dir + "/" + relative)
                     self._custom(custom)
 
@@ -161,28 +245,69 @@ class PillarData(object):
                 custom = self.pillar_dir + "/" + default_path
                 self._custom(custom)
 
-    def _clean(self):
+        self._clean(new_manifest)
+        if not self.dryrun:
+            _write_atomic(self.manifest_file, json.dumps(new_manifest, indent=1,
+                                                         sort_keys=True))
+
+    def _load_manifest(self):
         """
-        Remove the stack/default tree to remove any leftover files from a
-        previous removal
+        Returns the manifest of the previous run, empty if missing or invalid
         """
-        stack_default = "{}/stack/default".format(self.pillar_dir)
-        if os.path.isdir(stack_default):
-            shutil.rmtree(stack_default)
+        try:
+            with open(self.manifest_file, "r") as manifest:
+                return json.load(manifest)
+        except (IOError, ValueError):
+            return {}
 
-    def _default(self, filename, merged):
+    def _clean(self, outputs):
+        """
+        Remove the files of the stack/default tree that are not outputs of
+        this run, leftovers from a previous removal
+        """
+        stack_default = "{}/stack/default".format(self.pillar_dir)
+        for root, dirs, files in os.walk(stack_default, topdown=False):
+            for name in files:
+                filename = os.path.join(root, name)
+                if filename not in outputs:
+                    log.info("Removing {}".format(filename))
+                    self.changes['removed'].append(filename)
+                    if not self.dryrun:
+                        os.remove(filename)
+            if not self.dryrun and root != stack_default and not os.listdir(root):
+                os.rmdir(root)
+
+    def _merge_all(self, pathnames, common):
+        """
+        Returns the merged yaml text and cluster of each pathname.  The
+        pathnames are independent of each other, so they are merged in a pool
+        of worker processes when there is more than one worker.
+        """
+        sources = [common[pathname] for pathname in pathnames]
+        if self.workers > 1 and len(pathnames) > 1:
+            pool = multiprocessing.Pool(min(self.workers, len(pathnames)))
+            try:
+                results = pool.map(_merge_dump, sources,
+                                   chunksize=max(1, len(sources) // (self.workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_merge_dump(filenames) for filenames in sources]
+        return dict(zip(pathnames, results))
+
+    def _default(self, filename, text):
         """
-        Output the merged contents to the default tree
+        Output the merged contents to the default tree, returns the hash of
+        the contents
         """
         path_dir = os.path.dirname(filename)
         if not os.path.isdir(path_dir):
             _create_dirs(path_dir, self.pillar_dir)
         log.info("Writing {}".format(filename))
         if not self.dryrun:
-            with open(filename, "w") as yml:
-                yml.write(yaml.dump(merged,
-                          Dumper=self.friendly_dumper,
-                          default_flow_style=False))
+            _write_atomic(filename, text)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
     def _custom(self, custom):
         """
@@ -207,8 +332,10 @@ class PillarData(object):
 
     def organize(self, policy_filename):
         """
-        Associate all filenames with their common subdirectory.
+        Associate all filenames with their common subdirectory.  The policy
+        lines are matched against an index of the proposals tree built once.
         """
+        index = __utils__['proposals.index'](self.proposals_dir)
         common = {}
         with open(policy_filename, "r") as policy:
             for line in policy:
@@ -220,7 +347,7 @@ class PillarData(object):
                     log.debug("Ignoring '{}'".format(line))
                     continue
                 try:
-                    proposal_files = _parse(self.proposals_dir + "/" + line)
+                    proposal_files = index.parse(self.proposals_dir + "/" + line)
                 except ValueError:
                     log.exception('''
                     ERROR: Mailformed {}: {}
@@ -231,10 +358,10 @@ class PillarData(object):
                 log.debug(line)
                 log.debug(proposal_files)
                 for proposal_file in proposal_files:
-                    if os.stat(proposal_file).st_size == 0:
+                    if index.isfile(proposal_file) and index.size(proposal_file) == 0:
                         log.warning("Skipping empty file {}".format(proposal_file))
                         continue
-                    if os.path.isfile(proposal_file):
+                    if index.isfile(proposal_file):
                         pathname = _shift_dir(proposal_file.replace(
                                               self.proposals_dir, ""))
                         if pathname not in common:
@@ -272,36 +399,29 @@ def _merge(pathname, common):
     """
     Merge the files via stack.py
     """
+    return _merge_files(common[pathname])
+
+
+def _merge_files(filenames):
+    """
+    Merge the files in order via stack.py
+    """
     merged = {}
-    for filename in common[pathname]:
+    for filename in filenames:
         with open(filename, "r") as content:
-            content = yaml.safe_load(content)
+            content = yaml.load(content, Loader=_Loader)
             # pylint: disable=protected-access
             merged = _merge_dict(merged, content)
     return merged
 
 
-def _parse(line):
+def _merge_dump(filenames):
     """
-    Return globbed files constrained by optional slices or regexes.
+    Returns the yaml text of the merged files and their cluster
     """
-    if " " in line:
-        parts = re.split(r'\s+', line)
-        files = sorted(glob.glob(parts[0]))
-        for optional in parts[1:]:
-            filter_type, value = optional.split('=')
-            if filter_type == "re":
-                regex = re.compile(value)
-                files = [m.group(0) for l in files for m in [regex.search(l)] if m]
-            elif filter_type == "slice":
-                # pylint: disable=eval-used
-                files = eval("files{}".format(value))
-            else:
-                log.warning("keyword {} unsupported".format(filter_type))
-
-    else:
-        files = glob.glob(line)
-    return files
+    merged = _merge_files(filenames)
+    return (yaml.dump(merged, Dumper=_FriendlyDumper, default_flow_style=False),
+            merged.get('cluster'))
 
 
 def _shift_dir(path):
@@ -6,16 +6,39 @@ The list of minions related to a Salt target is often needed for operations.
 
 from __future__ import absolute_import
 from __future__ import print_function
+import contextlib
+import fcntl
+import json
 import logging
 import os
 import sys
 import re
+import threading
+import time
+import types
+import uuid
 # pylint: disable=import-error,3rd-party-module-not-gated,redefined-builtin
 import salt.client
 import netaddr
 
 log = logging.getLogger(__name__)
 
+_CACHE_MODULE = 'deepsea_select_cache'
+
+
+def _scopes():
+    """
+    Returns the thread local holding the scope opened by the calling
+    orchestration.  Salt reloads runner modules, so it lives in its own
+    module.
+    """
+    holder = sys.modules.get(_CACHE_MODULE)
+    if holder is None:
+        holder = types.ModuleType(_CACHE_MODULE)
+        holder.local = threading.local()
+        sys.modules[_CACHE_MODULE] = holder
+    return holder.local
+
 
 def help_():
     """
@@ -43,24 +66,155 @@ def help_():
              'salt-run select.from pillar=var role=default_role attr=value1,value2 :\n\n'
              '    Returns an array of grain values that matches the pillar variable.\n'
              '    Defaults to role if variable is not found.\n'
+             '\n\n'
+             'salt-run select.cache_begin:\n\n'
+             '    Start caching minions and first results while an orchestration\n'
+             '    is rendered, returns the scope id\n'
+             '\n\n'
+             'salt-run select.cache_clear [scope=id] [key=value...]:\n\n'
+             '    Close a scope, drop the cached result of a single search or\n'
+             '    stop caching\n'
              '\n\n')
     print(usage)
     return ""
 
 
-def _grain_host(client, minion):
+class SelectCache(object):
     """
-    Return the host grain for a given minion, for use a short hostname
+    Memoize search results while one orchestration is rendered.
+
+    Rendering a stage calls select.minions and select.first many times with
+    identical criteria.  Every runner call loads a fresh copy of this module,
+    so the results are kept in a small file under the master cachedir.  A
+    stage opens a scope with select.cache_begin while it is rendered and
+    closes it with select.cache_clear as its first step, before any runner
+    of the stage can change roles.  A scope belongs to the thread rendering
+    the orchestration: other callers, such as ad-hoc salt-run calls or
+    another orchestration run by the reactor in the same master process,
+    never see its entries.  Scopes also expire after the ttl.  Updates of
+    the file are serialized with an flock.
     """
-    return list(client.cmd(minion, 'grains.item', ['host']).values())[0]['host']
 
+    def __init__(self, opts):
+        self.filename = os.path.join(opts.get('cachedir', '/var/cache/salt/master'),
+                                     'deepsea', 'select.json')
+        self.ttl = opts.get('deepsea_select_cache_ttl', 120)
 
-def minions(host=False, format='{}', **kwargs):
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the cache file
+        """
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open("{}.lock".format(self.filename), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _load(self):
+        """
+        Return the contents of the cache file, empty when missing or corrupt
+        """
+        try:
+            with open(self.filename, 'r') as cache_file:
+                contents = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {'scopes': {}}
+        if not isinstance(contents.get('scopes'), dict):
+            return {'scopes': {}}
+        return contents
+
+    def _save(self, contents):
+        """
+        Write the cache file atomically
+        """
+        tmp = "{}.{}".format(self.filename, os.getpid())
+        with open(tmp, 'w') as cache_file:
+            json.dump(contents, cache_file)
+        os.rename(tmp, self.filename)
+
+    def _active(self, scope):
+        """
+        Check that a scope has not expired
+        """
+        return time.time() - scope['started'] < self.ttl
+
+    def _scope(self, contents):
+        """
+        Return the active scope of the calling thread or None
+        """
+        scope = contents['scopes'].get(getattr(_scopes(), 'scope_id', None))
+        if scope is None or not self._active(scope):
+            return None
+        return scope
+
+    def begin(self):
+        """
+        Open a new scope for the calling thread, dropping expired ones.
+        Returns the scope id.
+        """
+        scope_id = uuid.uuid4().hex
+        with self._locked():
+            contents = self._load()
+            contents['scopes'] = dict((key, scope) for key, scope
+                                      in contents['scopes'].items()
+                                      if self._active(scope))
+            contents['scopes'][scope_id] = {'started': time.time(), 'entries': {}}
+            self._save(contents)
+        _scopes().scope_id = scope_id
+        return scope_id
+
+    def clear(self, key=None, scope_id=None):
+        """
+        Close a scope, drop a single entry from all scopes, or drop
+        everything
+        """
+        with self._locked():
+            if key is None and scope_id is None:
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                return
+            contents = self._load()
+            if scope_id is not None:
+                contents['scopes'].pop(scope_id, None)
+                if getattr(_scopes(), 'scope_id', None) == scope_id:
+                    _scopes().scope_id = None
+            if key is not None:
+                for scope in contents['scopes'].values():
+                    scope['entries'].pop(key, None)
+            self._save(contents)
+
+    def get(self, key):
+        """
+        Return the cached value or None
+        """
+        scope = self._scope(self._load())
+        if scope is None:
+            return None
+        return scope['entries'].get(key)
+
+    def set(self, key, value):
+        """
+        Store a value when the calling thread has an open scope
+        """
+        with self._locked():
+            contents = self._load()
+            scope = self._scope(contents)
+            if scope is None:
+                return
+            scope['entries'][key] = value
+            self._save(contents)
+
+
+def _search(kwargs):
     """
-    Some targets needs to match all minions within a search criteria.
+    Normalize the search criteria into a compound target.  Sorting the
+    criteria lets differently ordered keyword arguments share a cache entry.
     """
-    if not isinstance(format, str):
-        raise TypeError("format argument is not a string")
     criteria = []
     for key in kwargs:
         if key[0] == "_":
@@ -70,21 +224,44 @@ def minions(host=False, format='{}', **kwargs):
             values = [values]
         for value in values:
             criteria.append("I@{}:{}".format(key, value))
+    return " and ".join(sorted(criteria))
 
-    search = " and ".join(criteria)
 
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
+def _grain_host(client, minion):
+    """
+    Return the host grain for a given minion, for use a short hostname
+    """
+    return list(client.cmd(minion, 'grains.item', ['host']).values())[0]['host']
 
-    local = salt.client.LocalClient()
-    _minions = local.cmd(search, 'pillar.get', ['id'], tgt_type="compound")
 
-    sys.stdout = _stdout
+def minions(host=False, format='{}', **kwargs):
+    """
+    Some targets needs to match all minions within a search criteria.
+    """
+    if not isinstance(format, str):
+        raise TypeError("format argument is not a string")
+    search = _search(kwargs)
+    cache = SelectCache(__opts__)
 
-    if host:
-        return sorted([format.format(_grain_host(local, k)) for k in _minions.keys()])
-    return sorted([format.format(m) for m in _minions.keys()])
+    key = "hosts {}".format(search) if host else search
+    names = cache.get(key)
+    if names is None:
+        # When search matches no minions, salt prints to stdout.  Suppress stdout.
+        _stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+        local = salt.client.LocalClient()
+        _minions = local.cmd(search, 'pillar.get', ['id'], tgt_type="compound")
+
+        sys.stdout = _stdout
+
+        if host:
+            names = [_grain_host(local, k) for k in _minions.keys()]
+        else:
+            names = list(_minions.keys())
+        cache.set(key, names)
+
+    return sorted([format.format(name) for name in names])
 
 
 def one_minion(**kwargs):
@@ -242,6 +419,33 @@ def from_(pillar, role, *args, **kwargs):
         return results
     return [[None] * (1 + len(args))]
 
+def cache_begin():
+    """
+    Start memoizing select.minions and select.first while the calling
+    orchestration is rendered.  Called at the top of each stage, returns the
+    scope id to pass to cache_clear.
+    """
+    return SelectCache(__opts__).begin()
+
+
+def cache_clear(scope=None, **kwargs):
+    """
+    Close a scope, invalidate the cached result of a single search, or stop
+    caching altogether when neither is given.
+    """
+    criteria = dict((key, kwargs[key]) for key in kwargs if key[0] != "_")
+    cache = SelectCache(__opts__)
+    if criteria:
+        search = _search(criteria)
+        cache.clear(search)
+        cache.clear("hosts {}".format(search))
+    if scope is not None:
+        cache.clear(scope_id=scope)
+    if not criteria and scope is None:
+        cache.clear()
+    return True
+
+
 __func_alias__ = {
                  'from_': 'from',
                  'help_': 'help',
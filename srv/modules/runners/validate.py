@@ -897,6 +897,7 @@ class Validate(Preparation):
         """
         accumulated_files = []
         proposals_dir = "/srv/pillar/ceph/proposals"
+        index = __utils__['proposals.index'](proposals_dir)
 
         with open(policy_file, "r") as policy:
             for line in policy:
@@ -906,13 +907,13 @@ class Validate(Preparation):
                 if line.startswith('#') or not line:
                     log.debug("Ignoring '{}'".format(line))
                     continue
-                proposal_files = self._parse(proposals_dir + "/" + line)
+                proposal_files = index.parse(proposals_dir + "/" + line)
                 if not proposal_files:
                     log.warning("{} matched no files".format(line))
                 log.debug(line)
                 log.debug(proposal_files)
                 for proposal_file in proposal_files:
-                    if os.stat(proposal_file).st_size == 0:
+                    if index.isfile(proposal_file) and index.size(proposal_file) == 0:
                         log.warning("Skipping empty file {}".format(proposal_file))
                         continue
                     accumulated_files.append(proposal_file)
@@ -957,29 +958,6 @@ class Validate(Preparation):
                     self.errors.setdefault('yaml_syntax', []).append(message)
         self._set_pass_status('yaml_syntax')
 
-    def _parse(self, line):
-        """
-        Return globbed files constrained by optional slices or regexes.
-        """
-        if " " in line:
-            parts = re.split(r'\s+', line)
-            files = sorted(glob.glob(parts[0]))
-            for keyvalue in parts[1:]:
-                key, value = keyvalue.split('=')
-                if key == "re":
-                    regex = re.compile(value)
-                    files = [match.group(0) for _file in files
-                             for match in [regex.search(_file)] if match]
-                elif key == "slice":
-                    # pylint: disable=eval-used
-                    files = eval("files{}".format(value))
-                else:
-                    log.warning("keyword {} unsupported".format(key))
-
-        else:
-            files = glob.glob(line)
-        return files
-
     def deepsea_minions(self):
         """
         Verify deepsea_minions is set
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=modernize-parse-error
+"""
+In memory index of the proposals tree.  The tree is walked once, keeping the
+type and size of every entry, and the policy.cfg lines are evaluated against
+the index instead of globbing and stat'ing the filesystem for every line.
+"""
+
+from __future__ import absolute_import
+import fnmatch
+import glob
+import logging
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+PROPOSALS_DIR = "/srv/pillar/ceph/proposals"
+
+
+def _scan(path):
+    """
+    Yields the name, whether it is a directory and the size of each entry of
+    a directory.  Symlinks are followed, like glob does.
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir():
+                    yield entry.name, True, 0
+                else:
+                    yield entry.name, False, entry.stat().st_size
+            except OSError:
+                # dangling symlink
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            yield name, os.path.isdir(os.path.join(path, name)), stat.st_size
+
+
+class ProposalIndex(object):
+    """
+    Directory listing and file sizes of a tree, from a single walk
+    """
+
+    def __init__(self, root=PROPOSALS_DIR):
+        self.root = root.rstrip('/')
+        # directory path -> sorted list of (name, is_dir)
+        self.children = {}
+        # file path -> size
+        self.sizes = {}
+        self._walk(self.root, set())
+
+    def _walk(self, path, visited):
+        real = os.path.realpath(path)
+        if real in visited:
+            return
+        visited.add(real)
+        try:
+            entries = sorted(_scan(path))
+        except OSError:
+            return
+        self.children[path] = [(name, is_dir) for name, is_dir, _ in entries]
+        for name, is_dir, size in entries:
+            child = "{}/{}".format(path, name)
+            if is_dir:
+                self._walk(child, visited)
+            else:
+                self.sizes[child] = size
+
+    def isfile(self, path):
+        """
+        Returns whether path is a file of the tree
+        """
+        return path in self.sizes
+
+    def size(self, path):
+        """
+        Returns the size of a file of the tree
+        """
+        return self.sizes[path]
+
+    def glob(self, pattern):
+        """
+        Returns the sorted paths of the tree matching a glob pattern, as
+        glob.glob would.  Patterns outside of the tree fall back to glob.
+        """
+        if not pattern.startswith(self.root + "/") or '/../' in pattern or \
+                pattern.endswith('/..'):
+            return sorted(glob.glob(pattern))
+        paths = [self.root]
+        for part in pattern[len(self.root) + 1:].split('/'):
+            if not part:
+                continue
+            matched = []
+            for path in paths:
+                children = self.children.get(path)
+                if children is None:
+                    continue
+                if not glob.has_magic(part):
+                    if any(name == part for name, _ in children):
+                        matched.append("{}/{}".format(path, part))
+                    continue
+                for name, _ in children:
+                    if name.startswith('.') and not part.startswith('.'):
+                        continue
+                    if fnmatch.fnmatchcase(name, part):
+                        matched.append("{}/{}".format(path, name))
+            paths = matched
+        return paths
+
+    def parse(self, line):
+        """
+        Return globbed files constrained by optional slices or regexes.
+        """
+        if " " in line:
+            parts = re.split(r'\s+', line)
+            files = self.glob(parts[0])
+            for optional in parts[1:]:
+                filter_type, value = optional.split('=')
+                if filter_type == "re":
+                    regex = re.compile(value)
+                    files = [m.group(0) for l in files for m in [regex.search(l)] if m]
+                elif filter_type == "slice":
+                    # pylint: disable=eval-used
+                    files = eval("files{}".format(value))
+                else:
+                    log.warning("keyword {} unsupported".format(filter_type))
+        else:
+            files = self.glob(line)
+        return files
+
+
+def index(root=PROPOSALS_DIR):
+    """
+    Salt exporter func
+    """
+    return ProposalIndex(root)
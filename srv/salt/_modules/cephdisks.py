@@ -2,14 +2,33 @@
 # pylint: disable=fixme,modernize-parse-error
 """
 Query ceph-volume's API for devices on the node
+
+Probing the devices runs lsblk, blkid and lvs for every device.  The results
+of all, list, used, unused, devices and attr_list are cached in the minion's
+cachedir for cephdisks_cache_ttl seconds (60 by default, 0 disables the
+cache).  The cache is dropped as soon as a block device, its udev database
+entry or the LVM metadata changes.  Pass cache=False to bypass the cache
+or call cephdisks.refresh to drop it.
+
+These queries skip cdroms, rbds, small disks and the root disk based on
+their sysfs facts, before ceph-volume probes the devices.  Pass
+prefilter=False to probe every device.
 """
 
 from __future__ import absolute_import
+import hashlib
+import json
 import logging
+import os
 import re
+import time
 # pytest: disable=import-error
 log = logging.getLogger(__name__)
 
+CACHE_TTL = 60
+_UDEV_DB = '/run/udev/data'
+_LVM_BACKUP = '/etc/lvm/backup'
+
 
 # pylint: disable=import-error
 def load_ceph_volume_devices():
@@ -37,14 +56,64 @@ def load_ceph_volume_device():
         log.error("Could not import from ceph_volume.util.device.")
 
 
+# pylint: disable=import-error
+def load_ceph_volume_sys_devices():
+    """ To simplify import mocking in the tests
+
+    The sysfs facts (size, rotational, removable..) of the block devices
+    by device path, as gathered once by ceph-volume for all its Devices.
+    ceph-volume is not present during unittesting.
+    """
+    try:
+        from ceph_volume.util.device import sys_info
+        from ceph_volume.util.disk import get_devices
+    except ImportError:
+        log.error("Could not import from ceph_volume.util.")
+        return None
+    if not sys_info.devices:
+        sys_info.devices = get_devices()
+    return sys_info.devices
+
+
 class Inventory(object):
     """ Inventory wrapper class for ceph-volume's device api """
 
     def __init__(self, **kwargs) -> None:
         self.kwargs: dict = kwargs
-        self.devices = load_ceph_volume_devices().devices
         self.device = load_ceph_volume_device()
         self.root_disk = self._find_root_disk()
+        self.devices = self._load_devices()
+
+    @property
+    def prefilter(self) -> bool:
+        """ The sysfs fast path, for inventories that filter_ """
+        return self.kwargs.get('prefilter', False)
+
+    def _load_devices(self) -> list:
+        """ Build the ceph-volume Devices
+
+        Building a Device probes it with lsblk, blkid and the LVM tools. With
+        prefilter, the devices that filter_ always drops (cdroms, rbds, small
+        disks and the root disk) are skipped based on their sysfs facts, read
+        once for all devices, and only the other ones are built.
+        """
+        if self.prefilter:
+            sys_devices = load_ceph_volume_sys_devices()
+            if sys_devices is not None:
+                return [
+                    self.device(path)
+                    for path, facts in sys_devices.items()
+                    if self._is_candidate(path, facts)
+                ]
+        return load_ceph_volume_devices().devices
+
+    def _is_candidate(self, path: str, facts: dict) -> bool:
+        """ Whether a device can pass filter_, from its sysfs facts """
+        if self.exclude_root_disk and path == self.root_disk:
+            return False
+        if self._is_cdrom(path) or self._is_rbd(path):
+            return False
+        return self._has_sufficient_size(float(facts.get('size', 0)))
 
     @property
     def exclude_unavailable(self) -> bool:
@@ -96,20 +165,28 @@ class Inventory(object):
         return osd_ids
 
     @staticmethod
-    # pylint: disable=inconsistent-return-statements
     def _find_root_disk() -> str:
-        """ Return the root disk of a device set """
-        with open('/proc/mounts', 'rb') as _fd:
+        """ Return the root disk of a device set
+
+        The mount source of '/' in /proc/self/mountinfo, the last one if '/'
+        is mounted over, without its partition number.
+        """
+        device_path_full = None
+        with open('/proc/self/mountinfo', 'rb') as _fd:
             for _line in _fd.readlines():
-                line = _line.decode()
-                mount_point = line.split(' ')[1]
-                if mount_point == '/':
-                    device_path_full = line.split(' ')[0]
-                    device_ident = device_path_full.split('/')[-1]
-                    if device_ident.startswith('nvme'):
-                        # nvme partitions are nvme0n1p1,p2,p3..
-                        return re.sub(r'p\d+$', '', device_path_full)
-                    return re.sub(r'\d+$', '', device_path_full)
+                # id parent major:minor root mount_point options
+                # [optional fields..] - fstype source super_options
+                fields = _line.decode().split(' ')
+                if len(fields) < 10 or fields[4] != '/' or '-' not in fields:
+                    continue
+                device_path_full = fields[fields.index('-', 6) + 2]
+        if device_path_full is None:
+            return None
+        device_ident = device_path_full.split('/')[-1]
+        if device_ident.startswith('nvme'):
+            # nvme partitions are nvme0n1p1,p2,p3..
+            return re.sub(r'p\d+$', '', device_path_full)
+        return re.sub(r'\d+$', '', device_path_full)
 
     @staticmethod
     def _is_cdrom(path: str) -> bool:
@@ -219,6 +296,113 @@ class Inventory(object):
         return devs
 
 
+def _mtime(path: str) -> float:
+    """ mtime of a path, None if missing """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _block_signature() -> str:
+    """ Fingerprint of the block devices and LVM metadata of the node
+
+    Built from the mtimes of /dev and the udev database, the major:minor
+    and size of every block device with the mtime of its udev database
+    entry, rewritten on every udev event of the device, and the mtimes of
+    the LVM metadata backups, rewritten on every LVM metadata change.
+    """
+    signature: list = [(path, _mtime(path)) for path in
+                       ('/dev', '/dev/mapper', '/dev/disk/by-id', _UDEV_DB,
+                        _LVM_BACKUP)]
+    try:
+        names = sorted(os.listdir('/sys/block'))
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(f'/sys/block/{name}/dev') as _fd:
+                majmin = _fd.read().strip()
+            with open(f'/sys/block/{name}/size') as _fd:
+                size = _fd.read().strip()
+        except (IOError, OSError):
+            continue
+        signature.append((name, majmin, size, _mtime(f'{_UDEV_DB}/b{majmin}')))
+    try:
+        backups = sorted(os.listdir(_LVM_BACKUP))
+    except OSError:
+        backups = []
+    for name in backups:
+        signature.append((name, _mtime(os.path.join(_LVM_BACKUP, name))))
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+
+def _cache_file() -> str:
+    """ Location of the inventory cache """
+    return os.path.join(
+        __opts__.get('cachedir', '/var/cache/salt/minion'), 'deepsea',
+        'cephdisks.json')
+
+
+def _read_cache() -> dict:
+    """ Load the inventory cache, empty if missing or corrupt """
+    try:
+        with open(_cache_file()) as _fd:
+            return json.load(_fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache: dict) -> None:
+    """ Atomically replace the inventory cache """
+    filename = _cache_file()
+    tmp = f"{filename}.{os.getpid()}"
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(tmp, 'w') as _fd:
+            json.dump(cache, _fd)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as error:
+        log.warning(f"Could not write the inventory cache: {error}")
+
+
+def _cached(query: str, kwargs: dict, probe):
+    """ Return the cached result of a query or probe the devices
+
+    The result is kept until the ttl expires or the block signature
+    changes. 'cache' is removed from kwargs.
+    """
+    ttl = __opts__.get('cephdisks_cache_ttl', CACHE_TTL)
+    if not kwargs.pop('cache', True) or not ttl:
+        return probe()
+    key = query + json.dumps(
+        {k: v for k, v in kwargs.items() if not k.startswith('__')},
+        sort_keys=True)
+    signature = _block_signature()
+    cache = _read_cache()
+    if cache.get('signature') != signature:
+        cache = dict(signature=signature, entries={})
+    entry = cache['entries'].get(key)
+    now = time.time()
+    if entry and 0 <= now - entry['time'] < ttl:
+        log.debug(f"Using the cached inventory for {key}")
+        return entry['result']
+    result = probe()
+    cache['entries'][key] = dict(time=now, result=result)
+    _write_cache(cache)
+    return result
+
+
+def refresh(**kwargs):
+    """ Drop the cached inventory, the next query probes the devices """
+    try:
+        os.remove(_cache_file())
+    except OSError:
+        pass
+    return True
+
+
 def get_(disk_path):
     """ Get a json report for a given device """
     device = load_ceph_volume_device()
@@ -234,6 +418,12 @@ def find_by_osd_id(osd_id, **kwargs):
 
 def attr_list(**kwargs):
     """ List supported attributes of drives """
+    kwargs.setdefault('prefilter', True)
+    return _cached('attr_list', kwargs, lambda: _attr_list(**kwargs))
+
+
+def _attr_list(**kwargs):
+    """ Probe the attributes of drives """
     report = list()
     default = "Not available"
     for device in Inventory(**kwargs).filter_():
@@ -260,13 +450,19 @@ def all_(**kwargs):
     also exclude root disk by default
     """
     kwargs.update(dict(exclude_root_disk=True))
-    return [x.json_report() for x in Inventory(**kwargs).filter_()]
+    kwargs.setdefault('prefilter', True)
+    return _cached(
+        'all', kwargs,
+        lambda: [x.json_report() for x in Inventory(**kwargs).filter_()])
 
 
 def _list(**kwargs):
     """ List only devices that are used by ceph """
     kwargs.update(dict(exclude_used_by_ceph=False))
-    return [x.json_report() for x in Inventory(**kwargs).filter_()]
+    kwargs.setdefault('prefilter', True)
+    return _cached(
+        'list', kwargs,
+        lambda: [x.json_report() for x in Inventory(**kwargs).filter_()])
 
 
 def used(**kwargs):
@@ -281,12 +477,18 @@ def unused(**kwargs):
             exclude_used_by_ceph=True,
             exclude_unavailable=True,
             exclude_cephdisk_member=True))
-    return [x.json_report() for x in Inventory(**kwargs).filter_()]
+    kwargs.setdefault('prefilter', True)
+    return _cached(
+        'unused', kwargs,
+        lambda: [x.json_report() for x in Inventory(**kwargs).filter_()])
 
 
 def devices(**kwargs):
     """ List device paths"""
-    return [x.path for x in Inventory(**kwargs).filter_() if x.path]
+    kwargs.setdefault('prefilter', True)
+    return _cached(
+        'devices', kwargs,
+        lambda: [x.path for x in Inventory(**kwargs).filter_() if x.path])
 
 
 # pylint: disable=redefined-outer-name
@@ -12,6 +12,7 @@ import re
 import logging
 import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 log = logging.getLogger(__name__)
 try:
@@ -42,6 +43,9 @@ Constructs valid ceph-volume calls based on the drive group specs and returns th
 deploy:
 
 A simple function that calls c_v_commands and executes it on the minion.
+The ceph-volume commands of the DB device groups target disjoint devices and
+run in parallel, one worker per command unless 'deploy_workers' is set in
+the drive group spec.
 
 
 To call from the commandline:
@@ -84,6 +88,7 @@ class Filter(object):
         self.name: str = str(kwargs.get('name', None))
         self.matcher = kwargs.get('matcher', None)
         self.value: str = str(kwargs.get('value', None))
+        self.virtual = kwargs.get('virtual', None)
         self._assign_matchers()
         log.debug("Initializing filter for {} with value {}".format(
             self.name, self.value))
@@ -107,15 +112,15 @@ class Filter(object):
         on `self.name` and returns it.
         """
         if self.name == "size":
-            self.matcher = SizeMatcher(self.name, self.value)
+            self.matcher = SizeMatcher(self.name, self.value, virtual=self.virtual)
         elif self.name == "model":
-            self.matcher = SubstringMatcher(self.name, self.value)
+            self.matcher = SubstringMatcher(self.name, self.value, virtual=self.virtual)
         elif self.name == "vendor":
-            self.matcher = SubstringMatcher(self.name, self.value)
+            self.matcher = SubstringMatcher(self.name, self.value, virtual=self.virtual)
         elif self.name == "rotational":
-            self.matcher = EqualityMatcher(self.name, self.value)
+            self.matcher = EqualityMatcher(self.name, self.value, virtual=self.virtual)
         elif self.name == "all":
-            self.matcher = AllMatcher(self.name, self.value)
+            self.matcher = AllMatcher(self.name, self.value, virtual=self.virtual)
         else:
             log.debug("No suitable matcher for {} could be found.")
 
@@ -125,6 +130,33 @@ class Filter(object):
         return 'Filter<{}>'.format(self.name)
 
 
+class FlatDisk(dict):
+    """ A disk representation flattened into a key->value index
+
+    The output of ceph-volume nests attributes (i.e. 'sys_api'). Matchers
+    look a key up anywhere in the report, the first occurrence in a
+    depth-first walk wins. Walking the report once per disk, instead of once
+    per matcher and disk, makes every lookup a dict access.
+    """
+
+    def __init__(self, disk: dict) -> None:
+        dict.__init__(self)
+        self.disk: dict = disk
+        self._flatten(disk)
+
+    def _flatten(self, node) -> None:
+        """ Record the keys of a node before the keys of its children """
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self.setdefault(key, value)
+            node = node.values()
+        elif not isinstance(node, list):
+            return
+        for value in node:
+            if isinstance(value, (dict, list)):
+                self._flatten(value)
+
+
 # pylint: disable=too-few-public-methods
 class Matcher(object):
     """ The base class to all Matchers
@@ -134,19 +166,22 @@ class Matcher(object):
 
     """
 
-    def __init__(self, key: str, value: str) -> None:
+    def __init__(self, key: str, value: str, virtual=None) -> None:
         """ Initialization of Base class
 
         :param str key: Attribute like 'model, size or vendor'
         :param str value: Value of attribute like 'X123, 5G or samsung'
+        :param bool virtual: Whether the host is virtual, detected if None
         """
         self.key: str = key
         self.value: str = value
         self.fallback_key: str = ''
-        self.virtual: bool = self._virtual()
+        if virtual is None:
+            virtual = self._virtual()
+        self.virtual: bool = virtual
 
-    # pylint: disable=no-self-use
-    def _virtual(self) -> bool:
+    @staticmethod
+    def _virtual() -> bool:
         """ Detect if any of the hosts is virtual
 
         In vagrant(libvirt) environments the 'model' flag is not set.
@@ -173,30 +208,17 @@ class Matcher(object):
         virtual environments. ceph-volume apparently sources its information
         from udev which seems to not populate certain fields on VMs.
 
-        :param dict disk: A disk representation
+        :param dict disk: A disk representation or its FlatDisk
         :raises: A generic Exception when no disk_key could be found.
         :return: A disk value
         :rtype: str
         """
-
-        def findkeys(node, key_val):
-            """ Find keys in non-flat dict recursively """
-            if isinstance(node, list):
-                for i in node:
-                    for key in findkeys(i, key_val):
-                        yield key
-            elif isinstance(node, dict):
-                if key_val in node:
-                    yield node[key_val]
-                for j in node.values():
-                    for key in findkeys(j, key_val):
-                        yield key
-
-        disk_value: str = list(findkeys(disk, self.key))
-        if not disk_value and self.fallback_key:
-            disk_value = list(findkeys(disk, self.fallback_key))
-        if disk_value:
-            return disk_value[0]
+        if not isinstance(disk, FlatDisk):
+            disk = FlatDisk(disk)
+        if self.key in disk:
+            return disk[self.key]
+        if self.fallback_key and self.fallback_key in disk:
+            return disk[self.fallback_key]
         if self.virtual:
             log.info(
                 "Virtual-env detected. Not raising Exception on missing keys."
@@ -221,8 +243,9 @@ class SubstringMatcher(Matcher):
     """ Substring matcher subclass
     """
 
-    def __init__(self, key: str, value: str, fallback_key=None) -> None:
-        Matcher.__init__(self, key, value)
+    def __init__(self, key: str, value: str, fallback_key=None,
+                 virtual=None) -> None:
+        Matcher.__init__(self, key, value, virtual=virtual)
         self.fallback_key = fallback_key
 
     def compare(self, disk: dict) -> bool:
@@ -246,8 +269,9 @@ class AllMatcher(Matcher):
     """ All matcher subclass
     """
 
-    def __init__(self, key: str, value: str, fallback_key=None) -> None:
-        Matcher.__init__(self, key, value)
+    def __init__(self, key: str, value: str, fallback_key=None,
+                 virtual=None) -> None:
+        Matcher.__init__(self, key, value, virtual=virtual)
         self.fallback_key = fallback_key
 
     def compare(self, disk: dict) -> bool:
@@ -272,8 +296,8 @@ class EqualityMatcher(Matcher):
     """ Equality matcher subclass
     """
 
-    def __init__(self, key: str, value: str) -> None:
-        Matcher.__init__(self, key, value)
+    def __init__(self, key: str, value: str, virtual=None) -> None:
+        Matcher.__init__(self, key, value, virtual=virtual)
 
     def compare(self, disk: dict) -> bool:
         """ Overwritten method to match equality
@@ -355,12 +379,12 @@ class SizeMatcher(Matcher, UnitHelper):
     """
 
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, key: str, value: str) -> None:
+    def __init__(self, key: str, value: str, virtual=None) -> None:
         # The 'key' value is overwritten here because
         # the user_defined attribute does not neccessarily
         # correspond to the desired attribute
         # requested from the inventory output
-        Matcher.__init__(self, key, value)
+        Matcher.__init__(self, key, value, virtual=virtual)
         UnitHelper.__init__(self)
         self.key: str = "human_readable_size"
         self.fallback_key: str = "size"
@@ -552,6 +576,9 @@ class DriveGroup(object):
         self._disks = Inventory(cephdisks_mode=cephdisks_mode).disks
         self._wal_devices = None
         self._db_devices = None
+        self._virtual = None
+        self._filters: dict = dict()
+        self._flat_disks: dict = dict()
         self.prop = namedtuple("Property", 'ident can_have_osds devices')
 
     @property
@@ -655,6 +682,14 @@ class DriveGroup(object):
         """
         return self.filter_args.get("osds_per_device", "")
 
+    @property
+    def deploy_workers(self) -> int:
+        """
+        Number of ceph-volume commands deploy runs in parallel, 0 for one
+        worker per command, that is per DB device group
+        """
+        return int(self.filter_args.get("deploy_workers", 0))
+
     @property
     def data_devices(self) -> list:
         """ Filter for (bluestore/filestore) DATA devices
@@ -718,6 +753,36 @@ class DriveGroup(object):
         """
         return self._disks
 
+    @property
+    def virtual(self) -> bool:
+        """ Whether the host is virtual, read once for all matchers
+        """
+        if self._virtual is None:
+            self._virtual = Matcher._virtual()
+        return self._virtual
+
+    def _compile_filters(self, device_filter: dict) -> list:
+        """ Filters of a device filter, with their matchers
+
+        Compiled once per DriveGroup for each device filter.
+        """
+        key = tuple((name, str(val)) for name, val in device_filter.items())
+        if key not in self._filters:
+            self._filters[key] = [
+                Filter(name=name, value=val, virtual=self.virtual)
+                for name, val in device_filter.items()
+            ]
+        return self._filters[key]
+
+    def _flat_disk(self, disk: dict) -> FlatDisk:
+        """ The FlatDisk of an inventory disk, flattened once
+        """
+        flat = self._flat_disks.get(id(disk))
+        if flat is None or flat.disk is not disk:
+            flat = FlatDisk(disk)
+            self._flat_disks[id(disk)] = flat
+        return flat
+
     @staticmethod
     def _limit_reached(device_filter, len_devices: int,
                        disk_path: str) -> bool:
@@ -754,26 +819,35 @@ class DriveGroup(object):
         This currently acts as a OR gate. Should this be a AND gate?
         Question: #############################
 
-        Iterates over all known disk and checks
-        for matches by using the matcher subclasses.
+        Evaluates all filters against the flattened disks in a single
+        pass, then assigns the matching disks filter by filter, in inventory
+        order, which is the order the limit applies in.
+
+        Disks are told apart by their path, a mandatory ident, so keeping
+        track of the assigned and taken disks takes a set lookup instead of
+        a comparison of whole reports.
 
         :param dict device_filter: Device filter as in description above
         :return: Set of devices that matched the filter
         :rtype set:
         """
+        filters = [
+            _filter for _filter in self._compile_filters(device_filter)
+            if _filter.is_matchable
+        ]
+        matches = [[] for _ in filters]
+        for disk in self.disks:
+            flat = self._flat_disk(disk)
+            for idx, _filter in enumerate(filters):
+                matches[idx].append(_filter.matcher.compare(flat))
+
         devices: list = list()
-        for name, val in device_filter.items():
-            _filter = Filter(name=name, value=val)
-            for disk in self.disks:
+        assigned: set = set()
+        for idx, _filter in enumerate(filters):
+            for disk, matched in zip(self.disks, matches[idx]):
                 log.debug("Processing disk {}".format(disk.get('path')))
                 # continue criterias
-                if not _filter.is_matchable:
-                    log.debug(
-                        "Ignoring disk {}. Filter is not matchable".format(
-                            disk.get('path')))
-                    continue
-
-                if not _filter.matcher.compare(disk):
+                if not matched:
                     log.debug("Ignoring disk {}. Filter did not match".format(
                         disk.get('path')))
                     continue
@@ -790,14 +864,17 @@ class DriveGroup(object):
                         disk.get('path')))
                     continue
 
-                if disk not in devices:
+                if disk['path'] not in assigned:
                     log.debug('Adding disk {}'.format(disk.get("path")))
+                    assigned.add(disk['path'])
                     devices.append(disk)
 
         # This disk is already taken and must not be re-assigned.
-        for taken_device in devices:
-            if taken_device in self.disks:
-                self.disks.remove(taken_device)
+        if assigned:
+            self.disks[:] = [
+                disk for disk in self.disks
+                if disk.get('path') not in assigned
+            ]
         # return sorted([x.get('path') for x in devices])
         return sorted([x for x in devices],
                       key=lambda dev: dev.get('path', ''))
@@ -1408,14 +1485,36 @@ Please make sure to have more/equal wal_devices than db_devices"""
             # In this case we have an error dict
             return c_v_command_list
 
-        rets = []
+        commands = []
         for cmd in c_v_command_list:
             if not cmd.startswith("ceph-volume"):
                 if cmd:
                     log.error(cmd)
                 continue
+            commands.append(cmd)
+
+        def _run(cmd):
             log.debug("Running command: {}".format(cmd))
-            rets.append(__salt__['helper.run'](cmd))
+            return __salt__['helper.run'](cmd)
+
+        workers = min(self.dgo.deploy_workers or len(commands), len(commands))
+        if workers > 1 and self.destroyed_osds:
+            # every command gets the same --osd-ids
+            workers = 1
+        if workers > 1:
+            log.info("Running {} ceph-volume commands with {} workers".format(
+                len(commands), workers))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                rets = list(executor.map(_run, commands))
+        else:
+            rets = [_run(cmd) for cmd in commands]
+
+        failed = [
+            cmd for cmd, ret in zip(commands, rets)
+            if isinstance(ret, tuple) and ret[0] != 0
+        ]
+        for cmd in failed:
+            log.error("Command failed: {}".format(cmd))
         log.debug("Returns for dg.deploy: {}".format(rets))
         return rets
 
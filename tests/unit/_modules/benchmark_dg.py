@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the DriveGroup device selection on a synthetic JBOD node, built
+with the InventoryFactory of the unit tests: rotational data disks and a few
+solid state DB and WAL disks.  The previous selection, which compared whole
+disk reports and evaluated filters disk by disk, runs on the same inventory
+for comparison.
+
+    $ python tests/unit/_modules/benchmark_dg.py [disks] [rounds]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../..'))
+# pylint: disable=import-error,wrong-import-position
+from srv.salt._modules import dg
+from tests.unit.helper.factories import InventoryFactory
+
+
+SPEC = {
+    'data_devices': {'rotational': '1', 'size': '1TB:'},
+    'db_devices': {'model': 'nvme', 'limit': 8},
+    'wal_devices': {'model': 'nvme'},
+}
+
+
+def inventory(num_disks):
+    """
+    Returns a node inventory: one solid state disk for every ten disks,
+    rotational disks for the rest
+    """
+    factory = InventoryFactory()
+    fast = max(num_disks // 10, 1)
+    disks = factory.produce(pieces=num_disks - fast, size=4000787030016,
+                            human_readable_size='3.64 TB')
+    disks.extend(factory.produce(pieces=fast, rotational='0', model='nvme',
+                                 size=800166076416, human_readable_size='745.21 GB'))
+    return disks
+
+
+def legacy_filter_devices(drive_group, device_filter):
+    """
+    _filter_devices before the flattened index and the path bookkeeping
+    """
+    devices = list()
+    for name, val in device_filter.items():
+        _filter = dg.Filter(name=name, value=val)
+        for disk in drive_group.disks:
+            if not _filter.is_matchable:
+                continue
+            if not _filter.matcher.compare(disk):
+                continue
+            if not drive_group._has_mandatory_idents(disk):
+                continue
+            if drive_group._limit_reached(device_filter, len(devices),
+                                          disk.get('path')):
+                continue
+            if disk not in devices:
+                devices.append(disk)
+    for taken_device in devices:
+        if taken_device in drive_group.disks:
+            drive_group.disks.remove(taken_device)
+    return sorted(devices, key=lambda dev: dev.get('path', ''))
+
+
+def select(disks, filter_devices):
+    """
+    Assigns the data, DB and WAL devices of a node and returns their paths
+    """
+    dg.__salt__ = {'cephdisks.unused': lambda: list(disks)}
+    drive_group = dg.DriveGroup(SPEC)
+    return [[disk['path'] for disk in filter_devices(drive_group, attrs)]
+            for attrs in (drive_group.data_device_attrs, drive_group.db_device_attrs,
+                          drive_group.wal_device_attrs)]
+
+
+def _time(disks, filter_devices, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        select(disks, filter_devices)
+    return (time.time() - start) / rounds
+
+
+def run(num_disks, rounds):
+    dg.__grains__ = {'virtual': 'physical'}
+    disks = inventory(num_disks)
+    current = dg.DriveGroup._filter_devices
+    assert select(disks, legacy_filter_devices) == select(disks, current)
+
+    t_legacy = _time(disks, legacy_filter_devices, rounds)
+    t_current = _time(disks, current, rounds)
+
+    print("disks={} rounds={}".format(num_disks, rounds))
+    print("  legacy selection:  {:8.2f}ms".format(t_legacy * 1000))
+    print("  indexed selection: {:8.2f}ms".format(t_current * 1000))
+
+
+def main(argv):
+    num_disks = int(argv[1]) if len(argv) > 1 else 200
+    rounds = int(argv[2]) if len(argv) > 2 else 10
+    run(num_disks, rounds)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
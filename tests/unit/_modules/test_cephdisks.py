@@ -1,4 +1,5 @@
 import pytest
+import time
 import sys
 sys.path.insert(0, 'srv/salt/_modules')
 from srv.salt._modules import cephdisks
@@ -48,7 +49,7 @@ class TestInventory(object):
     @patch(
         "srv.salt._modules.cephdisks.open",
         new_callable=mock_open,
-        read_data=b'/dev/sdaa1 / xfs rw,nosuid,nodev,noexec,relatime 0 0\n')
+        read_data=b'23 1 8:1 / / rw,relatime shared:1 - xfs /dev/sdaa1 rw\n')
     def test_find_root_disk(self, open_mock, test_fix):
         ret = test_fix()._find_root_disk()
         assert '/dev/sdaa' == ret
@@ -56,7 +57,7 @@ class TestInventory(object):
     @patch(
         "srv.salt._modules.cephdisks.open",
         new_callable=mock_open,
-        read_data=b'/dev/nvme0n1p1 / xfs rw,nosuid,nodev,noexec,relatime 0 0\n'
+        read_data=b'23 1 259:1 / / rw,relatime shared:1 - xfs /dev/nvme0n1p1 rw\n'
     )
     def test_find_root_disk_vnme(self, open_mock, test_fix):
         ret = test_fix()._find_root_disk()
@@ -66,11 +67,21 @@ class TestInventory(object):
         "srv.salt._modules.cephdisks.open",
         new_callable=mock_open,
         read_data=
-        b'/dev/nvme0n1p1 nope xfs rw,nosuid,nodev,noexec,relatime 0 0\n')
+        b'23 1 259:1 / /nope rw,relatime shared:1 - xfs /dev/nvme0n1p1 rw\n')
     def test_find_root_disk_vnme(self, open_mock, test_fix):
         ret = test_fix()._find_root_disk()
         assert ret is None
 
+    @patch(
+        "srv.salt._modules.cephdisks.open",
+        new_callable=mock_open,
+        read_data=b'1 0 0:1 / / rw - rootfs rootfs rw\n'
+        b'23 1 8:1 / / rw,relatime shared:1 master:2 - xfs /dev/sdb1 rw\n'
+        b'24 23 8:2 / /home rw,relatime - xfs /dev/sdb2 rw\n')
+    def test_find_root_disk_mounted_over(self, open_mock, test_fix):
+        ret = test_fix()._find_root_disk()
+        assert '/dev/sdb' == ret
+
     def test_is_cdrom(self, test_fix):
         inv = test_fix()
         assert inv._is_cdrom('/dev/sr0') is True
@@ -203,3 +214,116 @@ class TestInventory(object):
     @pytest.mark.skip(reason="Offloaded to ceph-volume")
     def test_find_by_osd_id(self):
         pass
+
+
+class TestCache(object):
+    @pytest.fixture
+    def inventory(self, tmpdir):
+        with patch.object(cephdisks, "__opts__", {'cachedir': str(tmpdir)}, create=True), \
+                patch.object(cephdisks, "Inventory") as inventory, \
+                patch.object(cephdisks, "_block_signature",
+                             return_value='sig1') as signature:
+            device = SimpleDevice(dict(path='/dev/sdb'))
+            device.json_report = lambda: {'path': '/dev/sdb'}
+            inventory.return_value.filter_.return_value = [device]
+            inventory.signature = signature
+            yield inventory
+
+    def test_cached(self, inventory):
+        first = cephdisks.unused()
+        second = cephdisks.unused()
+        assert first == second == [{'path': '/dev/sdb'}]
+        assert inventory.call_count == 1
+
+    def test_kwargs_key(self, inventory):
+        cephdisks.all_()
+        cephdisks.unused()
+        cephdisks.unused(__pub_jid='1')
+        assert cephdisks.devices() == ['/dev/sdb']
+        assert inventory.call_count == 3
+
+    def test_bypass(self, inventory):
+        cephdisks.unused()
+        cephdisks.unused(cache=False)
+        assert inventory.call_count == 2
+        assert 'cache' not in inventory.call_args[1]
+
+    def test_ttl(self, inventory):
+        cephdisks.__opts__['cephdisks_cache_ttl'] = 0.1
+        cephdisks.unused()
+        time.sleep(0.2)
+        cephdisks.unused()
+        assert inventory.call_count == 2
+
+    def test_signature_change(self, inventory):
+        cephdisks.unused()
+        inventory.signature.return_value = 'sig2'
+        cephdisks.unused()
+        cephdisks.unused()
+        assert inventory.call_count == 2
+
+    def test_refresh(self, inventory):
+        cephdisks.unused()
+        assert cephdisks.refresh() is True
+        cephdisks.unused()
+        assert inventory.call_count == 2
+
+
+class TestBlockSignature(object):
+    def test_lvm_change(self, tmpdir):
+        backup = tmpdir.mkdir('backup')
+        with patch.object(cephdisks, "_LVM_BACKUP", str(backup)):
+            before = cephdisks._block_signature()
+            backup.join('vg0').write('metadata')
+            after = cephdisks._block_signature()
+        assert before != after
+
+
+class TestPrefilter(object):
+    @pytest.fixture
+    def sys_devices(self):
+        return {
+            '/dev/sda': {'size': 500107862016.0, 'rotational': '1'},
+            '/dev/sdb': {'size': 500107862016.0, 'rotational': '1'},
+            '/dev/sdc': {'size': 1073741824.0, 'rotational': '0'},
+            '/dev/sr0': {'size': 500107862016.0, 'removable': '1'},
+            '/dev/rbd0': {'size': 500107862016.0},
+            '/dev/nvme0n1': {'size': 800166076416.0, 'rotational': '0'},
+        }
+
+    def _inventory(self, sys_devices, **kwargs):
+        with patch.object(cephdisks, "load_ceph_volume_sys_devices",
+                          return_value=sys_devices), \
+                patch.object(cephdisks, "load_ceph_volume_devices") as devices, \
+                patch.object(cephdisks, "load_ceph_volume_device",
+                             return_value=lambda path: SimpleDevice(dict(path=path))), \
+                patch.object(cephdisks.Inventory, "_find_root_disk",
+                             return_value='/dev/sda'):
+            devices.return_value.devices = [
+                SimpleDevice(dict(path=path)) for path in sys_devices or ['/dev/sdx']]
+            return cephdisks.Inventory(**kwargs)
+
+    def test_prefilter(self, sys_devices):
+        inv = self._inventory(sys_devices, prefilter=True)
+        assert [d.path for d in inv.devices] == ['/dev/sdb', '/dev/nvme0n1']
+
+    def test_prefilter_keeps_root_disk(self, sys_devices):
+        inv = self._inventory(sys_devices, prefilter=True, exclude_root_disk=False)
+        assert [d.path for d in inv.devices] == ['/dev/sda', '/dev/sdb', '/dev/nvme0n1']
+
+    def test_no_prefilter(self, sys_devices):
+        inv = self._inventory(sys_devices)
+        assert len(inv.devices) == len(sys_devices)
+
+    def test_prefilter_fallback(self):
+        inv = self._inventory(None, prefilter=True)
+        assert [d.path for d in inv.devices] == ['/dev/sdx']
+
+    def test_queries_prefilter(self):
+        with patch.object(cephdisks, "__opts__", {'cephdisks_cache_ttl': 0}, create=True), \
+                patch.object(cephdisks, "Inventory") as inventory:
+            inventory.return_value.filter_.return_value = []
+            cephdisks.unused()
+            assert inventory.call_args[1]['prefilter'] is True
+            cephdisks.unused(prefilter=False)
+            assert inventory.call_args[1]['prefilter'] is False
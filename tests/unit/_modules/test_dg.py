@@ -1033,6 +1033,86 @@ class TestDriveGroup(object):
         log.error.assert_called_with(c_v_command.return_value[0])
         dg.__salt__['helper.run'].assert_called_with('ceph-volume lvm foo')
 
+    @pytest.fixture
+    def slow_run(self):
+        """ helper.run taking 0.1s, failing for commands with 'fail' """
+        import threading
+        import time
+        state = dict(running=0, concurrent=0)
+        lock = threading.Lock()
+
+        def run(cmd):
+            with lock:
+                state['running'] += 1
+                state['concurrent'] = max(state['concurrent'], state['running'])
+            time.sleep(0.1)
+            with lock:
+                state['running'] -= 1
+            return (1 if 'fail' in cmd else 0, cmd, '')
+
+        state['run'] = run
+        return state
+
+    @patch(
+        "srv.salt._modules.dg.Output.generate_c_v_commands",
+        autospec=True,
+        return_value=['ceph-volume lvm a', 'ceph-volume lvm fail', 'ceph-volume lvm c'])
+    @patch(
+        "srv.salt._modules.dg.Output._check_for_old_profiles",
+        autospec=True,
+        return_value='')
+    @patch("srv.salt._modules.dg.log")
+    def test_deploy_parallel(self, log, error_message, c_v_command, test_fix,
+                             inventory, slow_run):
+        """ commands run in parallel, returns are in command order """
+        test_fix = test_fix()
+        inventory()
+        dg.__salt__['helper.run'] = slow_run['run']
+        ret = dg.Output(filter_args=test_fix.filter_args).deploy()
+        assert [r[1] for r in ret] == c_v_command.return_value
+        assert [r[0] for r in ret] == [0, 1, 0]
+        assert slow_run['concurrent'] == 3
+        log.error.assert_called_with('Command failed: ceph-volume lvm fail')
+
+    @patch(
+        "srv.salt._modules.dg.Output.generate_c_v_commands",
+        autospec=True,
+        return_value=['ceph-volume lvm a', 'ceph-volume lvm b', 'ceph-volume lvm c'])
+    @patch(
+        "srv.salt._modules.dg.Output._check_for_old_profiles",
+        autospec=True,
+        return_value='')
+    def test_deploy_workers(self, error_message, c_v_command, test_fix,
+                            inventory, slow_run):
+        """ deploy_workers bounds the parallelism """
+        test_fix = test_fix()
+        inventory()
+        dg.__salt__['helper.run'] = slow_run['run']
+        filter_args = dict(test_fix.filter_args, deploy_workers=2)
+        ret = dg.Output(filter_args=filter_args).deploy()
+        assert [r[1] for r in ret] == c_v_command.return_value
+        assert slow_run['concurrent'] == 2
+
+    @patch(
+        "srv.salt._modules.dg.Output.generate_c_v_commands",
+        autospec=True,
+        return_value=['ceph-volume lvm a', 'ceph-volume lvm b'])
+    @patch(
+        "srv.salt._modules.dg.Output._check_for_old_profiles",
+        autospec=True,
+        return_value='')
+    def test_deploy_destroyed_osds_serial(self, error_message, c_v_command,
+                                          test_fix, inventory, slow_run):
+        """ commands sharing --osd-ids run one after another """
+        test_fix = test_fix()
+        inventory()
+        dg.__salt__['helper.run'] = slow_run['run']
+        dg.__grains__ = {'host': 'node1', 'virtual': 'kvm'}
+        ret = dg.Output(filter_args=test_fix.filter_args,
+                        destroyed_osds={'node1': [1, 2]}).deploy()
+        assert len(ret) == 2
+        assert slow_run['concurrent'] == 1
+
     def test_check_for_old_profiles(self, test_fix, inventory):
         """ No pillar no bypass"""
         test_fix = test_fix()
@@ -1118,3 +1198,69 @@ class TestPublicMethods(object):
     def test_list(self, report_mock):
         dg.list_()
         report_mock.assert_called_once()
+
+
+class TestFlatDisk(object):
+    def test_first_occurrence(self):
+        """ Keys of a node win over the keys of its children, earlier
+        children win over later ones, like the recursive lookup did
+        """
+        disk = dict(path='/dev/sda',
+                    lvs=[dict(size='1'), dict(model='lv')],
+                    sys_api=dict(size='2', model='disk', vendor='samsung'))
+        flat = dg.FlatDisk(disk)
+        assert flat['path'] == '/dev/sda'
+        assert flat['size'] == '1'
+        assert flat['model'] == 'lv'
+        assert flat['vendor'] == 'samsung'
+        assert flat.disk is disk
+
+    def test_empty(self):
+        assert not dg.FlatDisk({})
+
+    @patch("srv.salt._modules.dg.Matcher._virtual", autospec=True)
+    def test_get_disk_key(self, virtual_mock):
+        virtual_mock.return_value = False
+        disk = dict(path='/dev/sda', sys_api=dict(size='2'))
+        matcher = dg.Matcher('human_readable_size', 'foo')
+        matcher.fallback_key = 'size'
+        assert matcher._get_disk_key(dg.FlatDisk(disk)) == '2'
+        assert matcher._get_disk_key(disk) == '2'
+
+
+class TestCompiledFilters(object):
+    @patch("srv.salt._modules.dg.Matcher._virtual", autospec=True)
+    def test_compiled_once(self, virtual_mock):
+        virtual_mock.return_value = True
+        disks = InventoryFactory().produce(pieces=4)
+        with patch('srv.salt._modules.dg.DriveGroup._check_filter_support'), \
+                patch('srv.salt._modules.dg.Inventory.disks',
+                      new_callable=PropertyMock, return_value=disks):
+            drive_group = dg.DriveGroup({})
+        filters = drive_group._compile_filters(dict(vendor='samsung', limit=1))
+        again = drive_group._compile_filters(dict(vendor='samsung', limit=1))
+        ret = drive_group._filter_devices(dict(rotational='1', vendor='samsung'))
+        assert filters is again
+        assert [f.name for f in filters] == ['vendor', 'limit']
+        assert len(ret) == 4
+        assert virtual_mock.call_count == 1
+
+    @patch("srv.salt._modules.dg.Matcher._virtual", autospec=True)
+    def test_taken_by_path(self, virtual_mock):
+        """ Disks are assigned once per path and taken disks are not
+        assigned to the next device filter
+        """
+        virtual_mock.return_value = True
+        factory = InventoryFactory()
+        disks = factory.produce(pieces=3)
+        disks.extend(factory.produce(pieces=2, rotational='0'))
+        disks.append(dict(disks[0]))
+        with patch('srv.salt._modules.dg.DriveGroup._check_filter_support'), \
+                patch('srv.salt._modules.dg.Inventory.disks',
+                      new_callable=PropertyMock, return_value=disks):
+            drive_group = dg.DriveGroup({})
+        data = drive_group._filter_devices(dict(rotational='1', limit=2))
+        rest = drive_group._filter_devices(dict(all=True))
+        assert [d['path'] for d in data] == ['/dev/sdb', '/dev/sdc']
+        assert [d['path'] for d in rest] == ['/dev/sdd', '/dev/sde', '/dev/sdf']
+        assert drive_group.disks == []
@@ -5,16 +5,21 @@ class InventoryFactory(object):
     def _make_path(self, ident='b'):
         return "/dev/{}{}".format(self.prefix, ident)
 
+    @staticmethod
+    def _ident(cnt):
+        """ Kernel disk naming, starting at 'b': b..z, aa..az, ba.. """
+        cnt += 1
+        ident = ''
+        while True:
+            ident = chr(ord('a') + cnt % 26) + ident
+            cnt = cnt // 26 - 1
+            if cnt < 0:
+                return ident
+
     def _find_new_path(self):
         cnt = 0
-        if len(self.taken_paths) >= 25:
-            raise Exception(
-                "Double-character disks are not implemetend. Maximum amount"
-                "of disks reached.")
-
         while self.path in self.taken_paths:
-            ident = chr(ord('b') + cnt)
-            self.path = "/dev/{}{}".format(self.prefix, ident)
+            self.path = self._make_path(self._ident(cnt))
             cnt += 1
 
     def assemble(self):
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the PillarStack ext_pillar on a synthetic cluster.  It generates
+a /srv/pillar/ceph/stack like tree, using the stack.cfg shipped by DeepSea,
+with global, cluster, role and per minion files, and renders the pillar of
+every minion twice, as two consecutive pillar refreshes of the whole cluster.
+
+    $ python tests/unit/pillar/benchmark_stack.py [minions] [disks per minion]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+PILLAR_DIR = os.path.join(os.path.dirname(__file__), '../../../srv')
+sys.path.insert(0, os.path.join(PILLAR_DIR, 'modules/pillar'))
+# pylint: disable=import-error,wrong-import-position
+import stack
+
+
+CLUSTER = 'ceph'
+
+
+def minion_roles(num_minions):
+    """
+    Returns the roles of each minion: a master, three monitors and managers,
+    two mds and rgw, and storage on the rest
+    """
+    roles = {'admin.ceph': ['master', 'admin']}
+    for idx in range(num_minions - 1):
+        minion_id = 'node{:04d}.ceph'.format(idx)
+        if idx < 3:
+            roles[minion_id] = ['mon', 'mgr', 'admin']
+        elif idx < 5:
+            roles[minion_id] = ['mds', 'rgw']
+        else:
+            roles[minion_id] = ['storage']
+    return roles
+
+
+def _write(basedir, path, obj):
+    filename = os.path.join(basedir, path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as out:
+        yaml.safe_dump(obj, out, default_flow_style=False)
+
+
+def generate_tree(basedir, roles, num_disks):
+    """
+    Writes the stack tree: the defaults as generated by DeepSea and a few
+    customizations on top
+    """
+    shutil.copy(os.path.join(PILLAR_DIR, 'pillar/ceph/stack/stack.cfg'), basedir)
+    _write(basedir, 'default/global.yml', {
+        'time_server': '{{ pillar.get("master_minion") }}',
+        'time_service': 'ntp',
+        'monitoring': {'prometheus': {'retention': '15d'}},
+    })
+    _write(basedir, 'default/{}/cluster.yml'.format(CLUSTER), {
+        'fsid': '2f5a1e3c-0c5c-4b3b-9c3a-8d5e2f0a1b2c',
+        'public_network': '10.0.0.0/16',
+        'cluster_network': '10.1.0.0/16',
+        'available_roles': sorted(set(r for rs in roles.values() for r in rs)),
+    })
+    for role in set(r for rs in roles.values() for r in rs):
+        _write(basedir, 'default/{}/roles/{}.yml'.format(CLUSTER, role), {
+            'role_{}'.format(role): {'keyring': '/etc/ceph/ceph.{}.keyring'.format(role),
+                                     'options': ['opt{}'.format(i) for i in range(20)]},
+        })
+    for idx, minion_id in enumerate(sorted(roles)):
+        minion_roles_ = roles[minion_id]
+        data = {'public_address': '10.0.{}.{}'.format(idx // 256, idx % 256)}
+        if 'storage' in minion_roles_:
+            data['ceph'] = {'storage': {'osds': dict(
+                ('/dev/disk/by-id/wwn-0x5000c500{:08x}'.format(disk),
+                 {'format': 'bluestore', 'db': '/dev/nvme0n1', 'db_size': '60G',
+                  'wal': '/dev/nvme1n1', 'wal_size': '2G', 'encryption': 'dmcrypt'})
+                for disk in range(num_disks))}}
+        _write(basedir, 'default/{}/minions/{}.yml'.format(CLUSTER, minion_id), data)
+    _write(basedir, 'global.yml', {'time_server': 'ntp.example.com'})
+    _write(basedir, '{}/roles/storage.yml'.format(CLUSTER),
+           {'role_storage': {'options': [{'__': 'merge-first'}, 'osd_max_backfills']}})
+
+
+def refresh(cfg, roles):
+    """
+    Renders the pillar of every minion and returns the latencies
+    """
+    latencies = []
+    for minion_id in sorted(roles):
+        pillar = {'cluster': CLUSTER, 'roles': roles[minion_id],
+                  'master_minion': 'admin.ceph'}
+        start = time.time()
+        stack.ext_pillar(minion_id, pillar, cfg)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def _report(name, latencies):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("  {:<13} {:8.1f} minions/s  p50 {:7.2f}ms  p99 {:7.2f}ms  total {:.3f}s".format(
+        name, len(latencies) / total, latencies[len(latencies) // 2] * 1000, p99 * 1000,
+        total))
+
+
+def run(num_minions, num_disks):
+    basedir = tempfile.mkdtemp()
+    try:
+        stack.__opts__ = {'cachedir': basedir}
+        stack.__salt__ = {}
+        stack.__grains__ = {}
+        roles = minion_roles(num_minions)
+        generate_tree(basedir, roles, num_disks)
+        cfg = os.path.join(basedir, 'stack.cfg')
+
+        print("minions={} disks/minion={}".format(num_minions, num_disks))
+        _report("cold refresh", refresh(cfg, roles))
+        _report("warm refresh", refresh(cfg, roles))
+        print("  peak rss      {:.1f}MB".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        shutil.rmtree(basedir)
+
+
+def main(argv):
+    num_minions = int(argv[1]) if len(argv) > 1 else 1000
+    num_disks = int(argv[2]) if len(argv) > 2 else 24
+    run(num_minions, num_disks)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
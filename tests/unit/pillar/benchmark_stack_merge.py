@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the PillarStack merge engine against the previous, in place,
+implementation on a deep and wide pillar tree.
+
+    $ python tests/unit/pillar/benchmark_stack_merge.py [osds] [minions]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import copy
+import os
+import sys
+import time
+
+import six
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../../srv/modules/pillar'))
+# pylint: disable=import-error,wrong-import-position
+import stack
+
+
+def _legacy_cleanup(obj):
+    if obj:
+        if isinstance(obj, dict):
+            obj.pop('__', None)
+            for k, v in six.iteritems(obj):
+                obj[k] = _legacy_cleanup(v)
+        elif isinstance(obj, list) and isinstance(obj[0], dict) \
+                and '__' in obj[0]:
+            del obj[0]
+    return obj
+
+
+def legacy_merge_dict(stack_, obj):
+    """
+    The merge of stack.py before it stopped modifying its inputs
+    """
+    strategy = obj.pop('__', 'merge-last')
+    if strategy == 'overwrite':
+        return _legacy_cleanup(obj)
+    for k, v in six.iteritems(obj):
+        if strategy == 'remove':
+            stack_.pop(k, None)
+            continue
+        if k in stack_:
+            if strategy == 'merge-first':
+                stack_k = stack_[k]
+                stack_[k] = _legacy_cleanup(v)
+                v = stack_k
+            if type(stack_[k]) != type(v):
+                stack_[k] = _legacy_cleanup(v)
+            elif isinstance(v, dict):
+                stack_[k] = legacy_merge_dict(stack_[k], v)
+            elif isinstance(v, list):
+                stack_[k] = legacy_merge_list(stack_[k], v)
+            else:
+                stack_[k] = v
+        else:
+            stack_[k] = _legacy_cleanup(v)
+    return stack_
+
+
+def legacy_merge_list(stack_, obj):
+    strategy = 'merge-last'
+    if obj and isinstance(obj[0], dict) and '__' in obj[0]:
+        strategy = obj[0]['__']
+        del obj[0]
+    if strategy == 'overwrite':
+        return obj
+    elif strategy == 'remove':
+        return [item for item in stack_ if item not in obj]
+    elif strategy == 'merge-first':
+        return obj + stack_
+    return stack_ + obj
+
+
+def synthetic_files(num_osds, minion_id):
+    """
+    Returns the parsed yaml files of a stack: global, cluster, role and minion
+    settings, with num_osds entries in 'storage'
+    """
+    osds = dict(('/dev/disk/by-id/disk-{}'.format(idx),
+                 {'format': 'bluestore', 'db': '/dev/nvme0n1', 'encryption': None,
+                  'options': ['noatime', 'nodiratime']})
+                for idx in range(num_osds))
+    return [
+        {'fsid': 'abc', 'public_network': '10.0.0.0/24', 'storage': {'osds': osds},
+         'roles': ['storage'], 'time_server': ['ntp1']},
+        {'cluster': 'ceph', 'time_server': [{'__': 'merge-first'}, 'ntp0'],
+         'storage': {'osds': {'/dev/disk/by-id/disk-0': {'format': 'filestore'}}}},
+        {'roles': [{'__': 'overwrite'}, 'storage', 'mon'],
+         'ceph': {'__': 'overwrite', 'conf': {'osd': {'osd_max_backfills': 1}}}},
+        {'__': 'merge-last', 'minion_id': minion_id,
+         'storage': {'osds': {'/dev/disk/by-id/disk-1': {'__': 'remove', 'db': None}}}},
+    ]
+
+
+def _time(func, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        func()
+    return time.time() - start
+
+
+def run(num_osds, num_minions):
+    files = synthetic_files(num_osds, 'minion1')
+
+    def merge(merge_dict, inputs):
+        result = {}
+        for obj in inputs:
+            result = merge_dict(result, obj)
+        return result
+
+    # the legacy merge modifies its inputs, so it needs a fresh copy of the
+    # parsed files for every minion, as if they were parsed again
+    copies = [copy.deepcopy(files) for _ in range(num_minions)]
+    assert merge(legacy_merge_dict, copy.deepcopy(files)) == merge(stack._merge_dict, files)
+
+    t_copy = _time(lambda: copy.deepcopy(files), num_minions)
+    t_legacy = _time(lambda: merge(legacy_merge_dict, copies.pop()), num_minions)
+    t_new = _time(lambda: merge(stack._merge_dict, files), num_minions)
+
+    print("osds={} minions={}".format(num_osds, num_minions))
+    print("  legacy merge:             {:.3f}s".format(t_legacy))
+    print("  legacy merge + copy:      {:.3f}s".format(t_legacy + t_copy))
+    print("  non-mutating merge:       {:.3f}s".format(t_new))
+
+
+def main(argv):
+    num_osds = int(argv[1]) if len(argv) > 1 else 10000
+    num_minions = int(argv[2]) if len(argv) > 2 else 20
+    run(num_osds, num_minions)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
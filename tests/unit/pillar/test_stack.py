@@ -0,0 +1,142 @@
+import copy
+import json
+import os
+import sys
+import pytest
+from mock import patch
+sys.path.insert(0, 'srv/modules/pillar')
+import stack
+
+
+class TestStackCache():
+
+    @pytest.fixture
+    def stack_dir(self, tmpdir):
+        sys.modules.pop(stack._CACHE_MODULE, None)
+        stack.__opts__ = {}
+        stack.__salt__ = {}
+        stack.__grains__ = {}
+        tmpdir.join('stack.cfg').write("global.yml\n"
+                                       "minions/{{ minion_id }}.yml\n")
+        tmpdir.join('global.yml').write("roles:\n"
+                                        "- {{ pillar['role'] }}\n"
+                                        "fsid: abc\n")
+        tmpdir.mkdir('minions').join('mon1.yml').write("id: {{ minion_id }}\n")
+        yield tmpdir
+        sys.modules.pop(stack._CACHE_MODULE, None)
+
+    def _render(self, stack_dir, minion_id, role):
+        return stack._process_stack_cfg(str(stack_dir.join('stack.cfg')), {},
+                                        minion_id, {'role': role})
+
+    def test_render(self, stack_dir):
+        assert self._render(stack_dir, 'mon1', 'mon') == \
+            {'roles': ['mon'], 'fsid': 'abc', 'id': 'mon1'}
+        assert self._render(stack_dir, 'osd1', 'storage') == \
+            {'roles': ['storage'], 'fsid': 'abc'}
+
+    def test_compiled_once(self, stack_dir):
+        with patch.object(stack.Environment, 'compile',
+                          autospec=True, side_effect=stack.Environment.compile) as compile_:
+            self._render(stack_dir, 'mon1', 'mon')
+            self._render(stack_dir, 'mon2', 'mon')
+            # stack.cfg, global.yml and minions/mon1.yml
+            assert compile_.call_count == 3
+
+    def test_parsed_once(self, stack_dir):
+        with patch.object(stack.yaml, 'safe_load',
+                          side_effect=stack.yaml.safe_load) as safe_load:
+            first = self._render(stack_dir, 'mon1', 'mon')
+            first['roles'].append('changed')
+            self._render(stack_dir, 'mon2', 'mon')
+            self._render(stack_dir, 'mon3', 'storage')
+            # stack.cfg three times, global.yml once per distinct rendering
+            # and minions/mon1.yml once
+            assert safe_load.call_count == 3 + 2 + 1
+            assert self._render(stack_dir, 'mon1', 'mon')['roles'] == ['mon']
+
+    def test_file_changed(self, stack_dir):
+        self._render(stack_dir, 'mon1', 'mon')
+        global_yml = stack_dir.join('global.yml')
+        global_yml.write("fsid: def\n")
+        os.utime(str(global_yml), (0, 0))
+        assert self._render(stack_dir, 'mon1', 'mon') == {'fsid': 'def', 'id': 'mon1'}
+
+    def test_shared_prefix(self, stack_dir):
+        with patch.object(stack, '_merge_dict', side_effect=stack._merge_dict) as merge:
+            self._render(stack_dir, 'mon1', 'mon')
+            self._render(stack_dir, 'mon2', 'mon')
+            assert merge.call_count == 3
+            # global.yml is shared with the previous minions
+            mon3 = self._render(stack_dir, 'mon3', 'mon')
+            mon4 = self._render(stack_dir, 'mon4', 'mon')
+            assert merge.call_count == 3
+        assert mon3 == {'roles': ['mon'], 'fsid': 'abc'}
+        mon3['roles'].append('changed')
+        assert mon4 == {'roles': ['mon'], 'fsid': 'abc'}
+        assert self._render(stack_dir, 'mon1', 'mon') == \
+            {'roles': ['mon'], 'fsid': 'abc', 'id': 'mon1'}
+
+    def test_refresh_not_shared(self, stack_dir):
+        self._render(stack_dir, 'mon1', 'mon')
+        self._render(stack_dir, 'mon1', 'mon')
+        # the stacks of a single minion are not kept, however often refreshed
+        assert sys.modules[stack._CACHE_MODULE].shared_stacks == {}
+        self._render(stack_dir, 'mon2', 'mon')
+        assert len(sys.modules[stack._CACHE_MODULE].shared_stacks) == 1
+
+
+class TestMerge():
+
+    def test_strategies(self):
+        base = {'users': {'tom': {'uid': 500, 'roles': ['sysadmin']}, 'root': {'uid': 0}},
+                'list': ['tom', 'root']}
+        assert stack._merge_dict(base, {'users': {'__': 'remove', 'tom': None}}) == \
+            {'users': {'root': {'uid': 0}}, 'list': ['tom', 'root']}
+        assert stack._merge_dict(base, {'users': {'__': 'overwrite', 'mat': {'uid': 1}}}) == \
+            {'users': {'mat': {'uid': 1}}, 'list': ['tom', 'root']}
+        assert stack._merge_dict(base, {'users': {'tom': {'roles': ['dev']}}})['users']['tom'] == \
+            {'uid': 500, 'roles': ['sysadmin', 'dev']}
+        assert stack._merge_dict(base, {'list': [{'__': 'merge-first'}, 'mat']})['list'] == \
+            ['mat', 'tom', 'root']
+        assert stack._merge_dict(base, {'list': [{'__': 'remove'}, 'tom']})['list'] == ['root']
+
+    def test_inputs_unchanged(self):
+        base = {'users': {'tom': {'uid': 500}, 'root': {'uid': 0}}, 'list': ['tom']}
+        obj = {'__': 'merge-last', 'users': {'tom': {'__': 'overwrite', 'uid': 1000}},
+               'list': [{'__': 'merge-first'}, 'mat'], 'new': {'__': 'merge-last', 'a': 1}}
+        base_copy = copy.deepcopy(base)
+        obj_copy = copy.deepcopy(obj)
+        merged = stack._merge_dict(base, obj)
+        assert merged == {'users': {'tom': {'uid': 1000}, 'root': {'uid': 0}},
+                          'list': ['mat', 'tom'], 'new': {'a': 1}}
+        assert base == base_copy
+        assert obj == obj_copy
+        # unchanged subtrees are shared
+        assert merged['users']['root'] is base['users']['root']
+
+
+class TestProfile():
+
+    def test_report(self, tmpdir):
+        stack.__opts__ = {}
+        stack.__salt__ = {}
+        stack.__grains__ = {}
+        tmpdir.join('stack.cfg').write("a.yml\nb.yml\n")
+        tmpdir.join('a.yml').write("a: 1\nb: 2")
+        tmpdir.join('b.yml').write("c: 3\n")
+        profile = stack._Profile('mon1')
+        data = stack._Stack(profile=profile)
+        stack._merge_stack_cfg(str(tmpdir.join('stack.cfg')), data, 'mon1', {})
+
+        entry = profile.files[str(tmpdir.join('a.yml'))]
+        assert entry['keys'] == 2
+        assert entry['bytes'] == len("a: 1\nb: 2")
+        assert len(profile.files) == 3
+
+        profile.report(2, str(tmpdir.join('profile')))
+        with open(str(tmpdir.join('profile', 'mon1.json'))) as dump:
+            report = json.load(dump)
+        assert report['minion_id'] == 'mon1'
+        assert len(report['files']) == 2
+        assert set(report['totals']) == set(['render', 'parse', 'merge'])
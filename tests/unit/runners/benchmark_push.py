@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of push.proposal merging a synthetic proposals tree: the previous
+serial merge with the pure python yaml loader and dumper, the serial merge
+with the libyaml bindings, and the worker pool.
+
+    $ python tests/unit/runners/benchmark_push.py [minions] [workers]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+from mock import patch
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '../../..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'srv/modules/pillar'))
+# pylint: disable=wrong-import-position
+from srv.modules.runners import push
+
+
+class _PythonDumper(yaml.SafeDumper):
+    # pylint: disable=unused-argument
+    def ignore_aliases(self, data):
+        return True
+
+
+def synthetic_common(proposals_dir, num_minions):
+    """
+    Writes the proposal files of a cluster of num_minions storage minions and
+    returns them organized by output pathname
+    """
+    common = {}
+    for idx in range(num_minions):
+        minion_id = 'node{:04d}.ceph'.format(idx)
+        files = []
+        for profile, contents in [
+                ('cluster-ceph/cluster', {'cluster': 'ceph'}),
+                ('role-storage/cluster', {'roles': ['storage']}),
+                ('profile-default/stack/default/ceph/minions',
+                 {'ceph': {'storage': {'osds': dict(
+                     ('/dev/disk/by-id/wwn-0x5000c500{:08x}'.format(disk),
+                      {'format': 'bluestore', 'db': '/dev/nvme0n1', 'db_size': '60G'})
+                     for disk in range(24))}}})]:
+            path = os.path.join(proposals_dir, profile)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            filename = os.path.join(path, '{}.sls'.format(minion_id))
+            with open(filename, 'w') as out:
+                yaml.safe_dump(contents, out)
+            files.append(filename)
+        common['cluster/{}.sls'.format(minion_id)] = files[:2]
+        common['stack/default/ceph/minions/{}.yml'.format(minion_id)] = files[2:]
+    return common
+
+
+def _output(pillar_dir, common, workers):
+    p_d = push.PillarData(False, workers)
+    p_d.pillar_dir = pillar_dir
+    p_d.manifest_file = os.path.join(pillar_dir, '.push_manifest.json')
+    start = time.time()
+    p_d.output(common)
+    elapsed = time.time() - start
+    shutil.rmtree(pillar_dir)
+    return elapsed
+
+
+def run(num_minions, workers):
+    basedir = tempfile.mkdtemp()
+    try:
+        common = synthetic_common(os.path.join(basedir, 'proposals'), num_minions)
+        pillar_dir = os.path.join(basedir, 'pillar')
+
+        with patch.object(push, '_Loader', yaml.SafeLoader), \
+                patch.object(push, '_FriendlyDumper', _PythonDumper):
+            t_python = _output(pillar_dir, common, 1)
+        t_serial = _output(pillar_dir, common, 1)
+        t_pool = _output(pillar_dir, common, workers)
+
+        print("minions={} output files={} workers={}".format(num_minions, len(common),
+                                                             workers))
+        print("  serial, python yaml:  {:.3f}s".format(t_python))
+        print("  serial, libyaml:      {:.3f}s".format(t_serial))
+        print("  worker pool, libyaml: {:.3f}s".format(t_pool))
+    finally:
+        shutil.rmtree(basedir)
+
+
+def main(argv):
+    num_minions = int(argv[1]) if len(argv) > 1 else 1000
+    workers = int(argv[2]) if len(argv) > 2 else 4
+    run(num_minions, workers)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
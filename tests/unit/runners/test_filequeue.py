@@ -164,3 +164,230 @@ class TestFileQueue():
 
 
 
+
+class TestLock():
+    '''
+    This class tests the Lock class for the salt runner
+    '''
+
+    def test_lock(self, dirpath):
+        '''
+        Verify that the holder is recorded and cleared on release
+        '''
+        settings = {'root_dir': dirpath, 'queue': 'default'}
+        with filequeue.Lock(settings):
+            with open("{}/.default.flock".format(dirpath)) as lockfile:
+                holder = lockfile.read()
+        with open("{}/.default.flock".format(dirpath)) as lockfile:
+            released = lockfile.read()
+        shutil.rmtree(dirpath)
+        assert holder.startswith("{} ".format(os.getpid()))
+        assert released == ""
+        assert settings['lock']['contended'] == False
+
+    def test_lock_timeout(self, dirpath):
+        '''
+        Verify that a held lock times out and reports the holder
+        '''
+        settings = {'root_dir': dirpath, 'queue': 'default', 'lock_timeout': 0.1}
+        with filequeue.Lock({'root_dir': dirpath, 'queue': 'default'}):
+            start = time.time()
+            with pytest.raises(filequeue.LockTimeout) as err:
+                with filequeue.Lock(settings):
+                    pass
+            elapsed = time.time() - start
+        shutil.rmtree(dirpath)
+        assert 0.1 <= elapsed < 1
+        assert str(os.getpid()) in str(err.value)
+
+    def test_lock_contended(self, dirpath):
+        '''
+        Verify that the wait and the holder are recorded
+        '''
+        import threading
+        first = filequeue.Lock({'root_dir': dirpath, 'queue': 'default'})
+        first.__enter__()
+        timer = threading.Timer(0.2, first.__exit__, (None, None, None))
+        timer.start()
+        settings = {'root_dir': dirpath, 'queue': 'default'}
+        with filequeue.Lock(settings):
+            pass
+        timer.join()
+        shutil.rmtree(dirpath)
+        assert settings['lock']['contended'] == True
+        assert settings['lock']['wait'] >= 0.1
+        assert settings['lock']['holder'].startswith(str(os.getpid()))
+
+    def test_symlink_lock_untouched(self, dirpath):
+        '''
+        Verify that the symlink lock of previous versions is left alone
+        '''
+        os.symlink("/dev/null", "{}/.default.lock".format(dirpath))
+        with filequeue.Lock({'root_dir': dirpath, 'queue': 'default'}):
+            pass
+        islink = os.path.islink("{}/.default.lock".format(dirpath))
+        shutil.rmtree(dirpath)
+        assert islink == True
+
+class TestJournalQueue():
+    '''
+    This class tests the JournalQueue class for the salt runner
+    '''
+
+    @pytest.fixture(autouse=True)
+    def fire_event(self):
+        with patch('srv.modules.runners.filequeue.FileQueue._fire_event', autospec=True) as fire:
+            yield fire
+
+    @pytest.fixture(autouse=True)
+    def journals(self):
+        filequeue._journal_cache().journals.clear()
+
+    def test_backend(self, dirpath):
+        '''
+        Verify that backend selects the journal
+        '''
+        fq = filequeue._queue(root_dir=dirpath, backend='journal')
+        shutil.rmtree(dirpath)
+        assert isinstance(fq, filequeue.JournalQueue)
+
+    def test_order(self, dirpath):
+        '''
+        Verify that items keep the insertion order and touching moves them
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        for item in ["red", "blue", "green", "red"]:
+            fq.touch(item)
+        items = fq.items()
+        ls = fq.ls()
+        oldest, newest = fq.oldest(), fq.newest()
+        shutil.rmtree(dirpath)
+        assert items == ['blue', 'green', 'red']
+        assert ls == ['blue', 'green', 'red']
+        assert (oldest, newest) == ('blue', 'red')
+
+    def test_duplicate_fail(self, dirpath):
+        '''
+        Verify that touch fails for a present item with duplicate_fail
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath, duplicate_fail=True)
+        first = fq.touch("red")
+        second = fq.touch("red")
+        shutil.rmtree(dirpath)
+        assert first == True and second == False
+
+    def test_remove_check_empty(self, dirpath):
+        '''
+        Verify that remove, check and empty work
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.touch("red")
+        fq.touch("blue")
+        ret = [fq.remove('red'), fq.remove('red'), fq.check('blue'), fq.check('red'),
+               fq.empty(), fq.vacate('blue'), fq.empty()]
+        shutil.rmtree(dirpath)
+        assert ret == [True, False, True, False, False, True, True]
+
+    def test_journal_not_an_item(self, dirpath):
+        '''
+        Verify that the journal is not listed by the files backend
+        '''
+        filequeue.JournalQueue(root_dir=dirpath).touch("red")
+        items = filequeue.FileQueue(root_dir=dirpath).items()
+        shutil.rmtree(dirpath)
+        assert items == []
+
+    @pytest.mark.parametrize("backend", ['files', 'journal'])
+    def test_empty_queue(self, dirpath, backend):
+        '''
+        Verify that both backends fail the same way on an empty queue
+        '''
+        fq = filequeue._queue(root_dir=dirpath, backend=backend)
+        with pytest.raises(IndexError):
+            fq.oldest()
+        with pytest.raises(IndexError):
+            fq.newest()
+        shutil.rmtree(dirpath)
+
+    def test_replay(self, dirpath):
+        '''
+        Verify that another process sees the same queue
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.touch("red")
+        fq.touch("blue")
+        fq.remove("red")
+        filequeue._journal_cache().journals.clear()
+        items = filequeue.JournalQueue(root_dir=dirpath).items()
+        shutil.rmtree(dirpath)
+        assert items == ['blue']
+
+    def test_incremental(self, dirpath):
+        '''
+        Verify that records appended by another process are picked up
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.touch("red")
+        with open("{}/.default.journal".format(dirpath), "a") as journal:
+            journal.write('["+", "blue"]\n')
+        items = fq.items()
+        shutil.rmtree(dirpath)
+        assert items == ['red', 'blue']
+
+    def test_torn_record(self, dirpath):
+        '''
+        Verify that a partial record is ignored and overwritten
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.touch("red")
+        with open("{}/.default.journal".format(dirpath), "a") as journal:
+            journal.write('["+", "bl')
+        before = fq.items()
+        fq.touch("green")
+        filequeue._journal_cache().journals.clear()
+        after = filequeue.JournalQueue(root_dir=dirpath).items()
+        shutil.rmtree(dirpath)
+        assert before == ['red']
+        assert after == ['red', 'green']
+
+    def test_compact(self, dirpath):
+        '''
+        Verify that the journal is compacted once mostly removals
+        '''
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.touch("keep")
+        for idx in range(600):
+            fq.touch(str(idx))
+            fq.remove(str(idx))
+        with open("{}/.default.journal".format(dirpath)) as journal:
+            lines = journal.readlines()
+        filequeue._journal_cache().journals.clear()
+        items = filequeue.JournalQueue(root_dir=dirpath).items()
+        shutil.rmtree(dirpath)
+        assert len(lines) < 1024
+        assert items == ['keep']
+
+    def test_inode_reused(self, dirpath):
+        '''
+        Verify that a cached index is not resumed on a compacted journal
+        that reused its inode
+        '''
+        journal = "{}/.default.journal".format(dirpath)
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        for item in ["red", "blue"]:
+            fq.touch(item)
+        stale = filequeue._journal_cache().journals.pop(journal)
+        # another process compacts twice
+        fq = filequeue.JournalQueue(root_dir=dirpath)
+        fq.remove("red")
+        for _ in range(2):
+            for idx in range(600):
+                fq.touch(str(idx))
+                fq.remove(str(idx))
+        fq.touch("green")
+        filequeue._journal_cache().journals.clear()
+        stale.inode = os.stat(journal).st_ino
+        filequeue._journal_cache().journals[journal] = stale
+        items = filequeue.JournalQueue(root_dir=dirpath).items()
+        shutil.rmtree(dirpath)
+        assert items == ['blue', 'green']
@@ -1,9 +1,11 @@
+import os
+import pytest
 from pyfakefs import fake_filesystem as fake_fs
-from pyfakefs import fake_filesystem_glob as fake_glob
 from mock import patch, mock_open, MagicMock
 import sys
 sys.path.insert(0, 'srv/modules/pillar')
 from srv.modules.runners import push
+from srv.modules.utils import proposals
 
 fs = fake_fs.FakeFilesystem()
 proposal_dir = '/srv/pillar/ceph/proposals/cluster-ceph/cluster'
@@ -24,7 +26,7 @@ nodes = [
 
 for node in nodes:
     fs.CreateFile('{}/{}.sls'.format(proposal_dir,
-                                     node))
+                                     node), contents='cluster: ceph\n')
 fs.CreateFile('policy.cfg', contents='cluster-ceph/cluster/*.sls')
 fs.CreateFile('policy.cfg_commented1',
               contents='cluster-ceph/cluster/*.sls # with a comment')
@@ -44,41 +46,20 @@ fs.CreateFile('policy.cfg_trailing_and_leading_whitespace_and_leading_comment',
 fs.CreateFile('policy.cfg_trailing_and_leading_whitespace_and_trailing_comment',
               contents=(' cluster-ceph/cluster/*.sls #'))
 
-f_glob = fake_glob.FakeGlobModule(fs)
 f_os = fake_fs.FakeOsModule(fs)
 f_open = fake_fs.FakeFileOpen(fs)
 
 
 class TestPush():
 
-    @patch('glob.glob', new=f_glob.glob)
-    def test_parse(self):
+    @pytest.fixture(autouse=True)
+    def utils(self):
+        push.__utils__ = {'proposals.index': proposals.index}
 
-        parsed = push._parse('{}/*.sls'.format(proposal_dir))
-        assert len(parsed) == len(nodes)
-
-        parsed = push._parse('{}/mon*.sls'.format(proposal_dir))
-        assert len(parsed) == len([n for n in nodes if n.startswith('mon')])
-
-        parsed = push._parse('{}/mon[1,2].sls'.format(proposal_dir))
-        assert len(parsed) == 2
-
-        parsed = push._parse('{}/*.sls slice=[2:5]'.format(proposal_dir))
-        assert len(parsed) == 3
-
-        parsed = push._parse(r'{}/*.sls re=.*1\.sls$'.format(proposal_dir))
-        assert len(parsed) == len([n for n in nodes if '1' in n])
-
-        parsed = push._parse(r'{}/*.sls FOO=.*1\.sls$'.format(proposal_dir))
-        assert len(parsed) == len(nodes)
-
-    @patch('glob.glob', new=f_glob.glob)
+    @patch('os.scandir', new=f_os.scandir)
     @patch('os.path.isfile', new=f_os.path.isfile)
     @patch('builtins.open', new=f_open)
-    @patch('os.stat')
-    def test_organize(self, mock_stat):
-        # make sure all out faked files have content
-        mock_stat.return_value = MagicMock(st_size=1)
+    def test_organize(self):
         p_d = push.PillarData(False)
 
         organized = p_d.organize('policy.cfg')
@@ -115,8 +96,85 @@ class TestPush():
 
     @patch('os.path.isfile', new=f_os.path.isfile)
     @patch('builtins.open', new=f_open)
-    def test_organize_function(self):
+    @patch('os.scandir', side_effect=OSError)
+    def test_organize_function(self, scandir):
         result = push.organize('policy.cfg')
         assert result == {}
 
 
+class TestPillarDataOutput():
+
+    @pytest.fixture
+    def pillar_data(self, tmpdir):
+        p_d = push.PillarData(False)
+        p_d.pillar_dir = str(tmpdir.mkdir('pillar'))
+        p_d.manifest_file = "{}/.push_manifest.json".format(p_d.pillar_dir)
+        proposals = tmpdir.mkdir('proposals')
+        proposals.join('cluster.yml').write("fsid: abc\n")
+        proposals.join('mon1.sls').write("cluster: ceph\n")
+        proposals.join('roles.yml').write("roles:\n- mon\n")
+        common = {
+            'stack/default/ceph/cluster.yml': [str(proposals.join('cluster.yml'))],
+            'stack/default/ceph/minions/mon1.yml': [str(proposals.join('roles.yml'))],
+            'cluster/mon1.sls': [str(proposals.join('mon1.sls'))],
+        }
+        yield p_d, common, proposals
+
+    def _run(self, p_d, common):
+        p_d.changes = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
+        p_d.output(common)
+        return dict((key, sorted(f.replace(p_d.pillar_dir + '/', '') for f in files))
+                    for key, files in p_d.changes.items())
+
+    def test_first_run(self, pillar_data):
+        p_d, common, _ = pillar_data
+        changes = self._run(p_d, common)
+        assert changes['added'] == sorted(common)
+        assert changes['changed'] == []
+        with open("{}/stack/default/ceph/cluster.yml".format(p_d.pillar_dir)) as cluster:
+            assert cluster.read() == "fsid: abc\n"
+
+    def test_unchanged(self, pillar_data):
+        p_d, common, proposals = pillar_data
+        self._run(p_d, common)
+        changes = self._run(p_d, common)
+        assert changes['added'] == [] and changes['changed'] == []
+        assert changes['unchanged'] == sorted(common)
+
+        proposals.join('cluster.yml').write("fsid: def\n")
+        changes = self._run(p_d, common)
+        assert changes['changed'] == ['stack/default/ceph/cluster.yml']
+
+    def test_output_modified(self, pillar_data):
+        p_d, common, _ = pillar_data
+        self._run(p_d, common)
+        with open("{}/cluster/mon1.sls".format(p_d.pillar_dir), "w") as sls:
+            sls.write("cluster: unassigned\n")
+        changes = self._run(p_d, common)
+        assert changes['changed'] == ['cluster/mon1.sls']
+
+    def test_orphans_removed(self, pillar_data):
+        p_d, common, _ = pillar_data
+        self._run(p_d, common)
+        del common['stack/default/ceph/minions/mon1.yml']
+        changes = self._run(p_d, common)
+        assert changes['removed'] == ['stack/default/ceph/minions/mon1.yml']
+        assert not os.path.exists("{}/stack/default/ceph/minions".format(p_d.pillar_dir))
+        # the custom files are never removed
+        assert os.path.exists("{}/stack/ceph/minions/mon1.yml".format(p_d.pillar_dir))
+
+    def test_workers(self, pillar_data):
+        p_d, common, _ = pillar_data
+        self._run(p_d, common)
+        serial = {}
+        for pathname in common:
+            with open("{}/{}".format(p_d.pillar_dir, pathname)) as output:
+                serial[pathname] = output.read()
+
+        os.remove(p_d.manifest_file)
+        p_d.workers = 2
+        changes = self._run(p_d, common)
+        assert changes['changed'] == sorted(common)
+        for pathname in common:
+            with open("{}/{}".format(p_d.pillar_dir, pathname)) as output:
+                assert output.read() == serial[pathname]
@@ -0,0 +1,113 @@
+import threading
+
+import pytest
+from mock import patch, MagicMock
+from srv.modules.runners import select
+
+
+class TestSelectCache():
+
+    @pytest.fixture
+    def opts(self, tmpdir):
+        saved = getattr(select, '__opts__', None)
+        select.__opts__ = {'cachedir': str(tmpdir)}
+        yield select.__opts__
+        if saved is None:
+            del select.__opts__
+        else:
+            select.__opts__ = saved
+
+    @pytest.fixture
+    def local(self):
+        with patch('salt.client.LocalClient') as mock_client:
+            local = MagicMock()
+            local.cmd.return_value = {'mon1': 'mon1', 'mon2': 'mon2'}
+            mock_client.return_value = local
+            yield local
+
+    def test_search_normalized(self):
+        assert (select._search({'roles': 'mon', 'cluster': 'ceph'}) ==
+                select._search({'cluster': 'ceph', 'roles': 'mon'}))
+
+    def test_search_skips_private(self):
+        assert select._search({'roles': 'mon', '__pub_user': 'root'}) == "I@roles:mon"
+
+    def test_no_scope_no_cache(self, opts, local):
+        select.minions(roles='mon')
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 2
+
+    def test_scope_caches(self, opts, local):
+        select.cache_begin()
+        assert select.minions(roles='mon', cluster='ceph') == ['mon1', 'mon2']
+        assert select.minions(cluster='ceph', roles='mon') == ['mon1', 'mon2']
+        assert select.first(roles='mon', cluster='ceph') == 'mon1'
+        assert local.cmd.call_count == 1
+
+    def test_scope_expires(self, opts, local):
+        opts['deepsea_select_cache_ttl'] = 0
+        select.cache_begin()
+        select.minions(roles='mon')
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 2
+
+    def test_cache_clear_criteria(self, opts, local):
+        select.cache_begin()
+        select.minions(roles='mon')
+        select.minions(roles='mgr')
+        select.cache_clear(roles='mon')
+        select.minions(roles='mon')
+        select.minions(roles='mgr')
+        assert local.cmd.call_count == 3
+
+    def test_cache_clear(self, opts, local):
+        select.cache_begin()
+        select.minions(roles='mon')
+        select.cache_clear()
+        select.minions(roles='mon')
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 3
+
+    def test_format_applied_to_cached(self, opts, local):
+        select.cache_begin()
+        select.minions(roles='mon')
+        assert select.minions(roles='mon', format='{}.ceph') == ['mon1.ceph', 'mon2.ceph']
+        assert local.cmd.call_count == 1
+
+    def test_scope_closed(self, opts, local):
+        scope = select.cache_begin()
+        select.minions(roles='mon')
+        select.cache_clear(scope=scope)
+        select.minions(roles='mon')
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 3
+
+    def _in_thread(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+    def test_scope_other_thread(self, opts, local):
+        select.cache_begin()
+        select.minions(roles='mon')
+        self._in_thread(lambda: select.minions(roles='mon'))
+        self._in_thread(lambda: select.minions(roles='mon'))
+        assert local.cmd.call_count == 3
+
+    def test_scope_per_call(self, opts, local):
+        def other():
+            select.cache_begin()
+            select.minions(roles='mgr')
+            select.minions(roles='mgr')
+        select.cache_begin()
+        select.minions(roles='mon')
+        self._in_thread(other)
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 2
+
+    def test_scope_close_keeps_other_scopes(self, opts, local):
+        select.cache_begin()
+        select.minions(roles='mon')
+        self._in_thread(lambda: select.cache_clear(scope=select.cache_begin()))
+        select.minions(roles='mon')
+        assert local.cmd.call_count == 1
@@ -0,0 +1,67 @@
+import os
+import pytest
+from srv.modules.utils import proposals
+
+nodes = [
+    'master',
+    'mon1',
+    'mon2',
+    'mon3',
+    'mds1',
+    'mds2',
+    'osd1',
+    'osd2',
+    'osd3',
+    'osd4',
+    'osd5',
+    'rgw1',
+]
+
+
+class TestProposalIndex():
+
+    @pytest.fixture
+    def index(self, tmpdir):
+        cluster = tmpdir.mkdir('cluster-ceph').mkdir('cluster')
+        for node in nodes:
+            cluster.join('{}.sls'.format(node)).write('cluster: ceph\n')
+        cluster.join('.hidden.sls').write('cluster: ceph\n')
+        tmpdir.mkdir('role-mon').mkdir('cluster')
+        tmpdir.join('role-mon', 'cluster', 'empty.sls').write('')
+        yield proposals.ProposalIndex(str(tmpdir))
+
+    def _path(self, index, line):
+        return '{}/cluster-ceph/cluster/{}'.format(index.root, line)
+
+    def test_parse(self, index):
+        parsed = index.parse(self._path(index, '*.sls'))
+        assert len(parsed) == len(nodes)
+
+        parsed = index.parse(self._path(index, 'mon*.sls'))
+        assert len(parsed) == len([n for n in nodes if n.startswith('mon')])
+
+        parsed = index.parse(self._path(index, 'mon[1,2].sls'))
+        assert len(parsed) == 2
+
+        parsed = index.parse(self._path(index, '*.sls slice=[2:5]'))
+        assert len(parsed) == 3
+
+        parsed = index.parse(self._path(index, r'*.sls re=.*1\.sls$'))
+        assert len(parsed) == len([n for n in nodes if '1' in n])
+
+        parsed = index.parse(self._path(index, r'*.sls FOO=.*1\.sls$'))
+        assert len(parsed) == len(nodes)
+
+    def test_glob_like_glob(self, index):
+        import glob
+        for pattern in ['*/cluster/*.sls', '*', 'role-*/cluster', 'cluster-ceph/cluster/.h*',
+                        'cluster-ceph/cluster/mon1.sls', 'cluster-ceph/missing/*.sls']:
+            pattern = '{}/{}'.format(index.root, pattern)
+            assert index.glob(pattern) == sorted(glob.glob(pattern))
+
+    def test_files(self, index):
+        empty = '{}/role-mon/cluster/empty.sls'.format(index.root)
+        assert index.isfile(empty)
+        assert index.size(empty) == 0
+        assert index.size(self._path(index, 'mon1.sls')) == len('cluster: ceph\n')
+        assert not index.isfile('{}/role-mon/cluster'.format(index.root))